@@ -23,16 +23,29 @@ import os
 import pysam as ps
 import pybedtools as bt
 import numpy as np
+import multiprocessing as mp
+from circlemap.depth_index import load_depth, base_events
+
+# merged intervals closer than this share the reads fetched for their coverage
+COVERAGE_FETCH_GAP = 10000
 
 
 class coverage:
     """Class for managing the coverage metrics of circle-map"""
 
-    def __init__(self,sorted_bam,eccdna_bed,extension,mapq,inside_length,directory):
+    def __init__(self,sorted_bam,eccdna_bed,extension,mapq,inside_length,directory,depth_index=False):
 
+        self.sorted_bam = sorted_bam
+        self.directory = directory
         self.bam = ps.AlignmentFile(directory + "/" + sorted_bam, "rb")
         self.bed = eccdna_bed
 
+        #merged intervals of the circles, computed once
+        self.merged = None
+
+        #circles, searched for every merged interval
+        self.circles = None
+
         #length of out
         self.ext = extension
         self.mapq = mapq
@@ -40,14 +53,52 @@ class coverage:
         #length of the region for the ratio
         self.ilen = inside_length
 
+        #per base depth served from the depth index of the sorted bam, built once and reused by later runs
+        self.depth = load_depth(directory + "/" + sorted_bam, mapq, directory) if depth_index else None
+
         def print_parameters(self):
             print("Running coverage computations \n")
 
 
 
-    def get_wg_coverage(self):
+    def window_depth(self,chrom,windows,fetch=None):
+        """Function that takes as input a contig and a sorted list of (start,end) windows, and returns the depth of every
+        window as a uint32 numpy array. The reads are fetched once for all the windows, or from the fetch region if one
+        is given, and every aligned block of the reads adds one to a difference array, whose cumulative sum is the depth.
+        As in count_coverage, only the A,C,G,T bases with at least the quality threshold are counted. A window without end
+        goes until the last base of the fetched reads"""
+
+        if fetch is None:
+            fetch = (windows[0][0], max(end for start, end in windows))
+
+        plus = []
+        minus = []
+        for read in self.bam.fetch(contig=chrom, start=fetch[0], stop=fetch[1]):
+            base_events(read, plus, minus, self.mapq)
+
+        plus = np.sort(np.array(plus, dtype=np.int64))
+        minus = np.sort(np.array(minus, dtype=np.int64))
+
+        depths = []
+        for start, end in windows:
+            if end is None:
+                end = max(start, int(minus[-1])) if len(minus) > 0 else start
+            # depth at the window start, and the changes within the window
+            first_plus, last_plus = np.searchsorted(plus, [start, end], side='left')
+            first_minus, last_minus = np.searchsorted(minus, [start, end], side='left')
+            changes = np.bincount(plus[first_plus:last_plus] - start, minlength=end - start) - \
+                      np.bincount(minus[first_minus:last_minus] - start, minlength=end - start)
+            if end > start:
+                changes[0] += first_plus - first_minus
+            depths.append(np.uint32(np.cumsum(changes)))
+
+        return(depths)
+
+
+    def get_wg_coverage(self,chrom=None):
         """Generator that takes as input a sorted bam and a merged bam of the circles in the whole genome and returns a numpy
-        array for every interval with the coverage"""
+        array for every interval with the coverage, together with the interval and the start of the array. If a contig
+        is given, only its intervals are returned"""
 
 
 
@@ -57,32 +108,50 @@ class coverage:
         for reference in reference_contigs:
             header_dict[reference['SN']] = reference['LN']
 
-        merged_bed = self.bed.sort().merge()
-
-        for interval in merged_bed:
-
-            coverage_dict = {}
-            if interval.start - self.ext < 0:
-                start = 0
-
+        if self.merged is None:
+            self.merged = self.bed.sort().merge()
+
+        # every merged interval is extended by the flanks used for the coverage ratios. count_coverage ignores end=, so
+        # the reads overlapping the interval were counted after its end, until their last base, unless the flank
+        # reaches the contig end
+        windows = []
+        for interval in self.merged:
+            if chrom is not None and interval.chrom != chrom:
+                continue
+            start = max(interval.start - self.ext, 0)
+            end = min(interval.end + self.ext, header_dict[interval.chrom])
+            if header_dict[interval.chrom] < (interval.end + self.ext):
+                core_end = end
             else:
-                start = interval.start - self.ext
+                core_end = interval.end
+            windows.append((interval, start, core_end, end))
+
+        # nearby windows of a contig are computed from the same reads
+        groups = []
+        for window in windows:
+            if len(groups) > 0 and groups[-1][-1][0].chrom == window[0].chrom and \
+                    window[1] - groups[-1][-1][3] <= COVERAGE_FETCH_GAP:
+                groups[-1].append(window)
+            else:
+                groups.append([window])
 
-            if header_dict[interval.chrom] < (interval.end + self.ext):
-                end = interval.end + self.ext
+        for group in groups:
+
+            chrom = group[0][0].chrom
+            if self.depth is not None:
+                depths = [self.depth.region(chrom, start, core_end) for interval, start, core_end, end in group]
             else:
-                end = interval.end
+                depths = self.window_depth(chrom, [(start, core_end) for interval, start, core_end, end in group])
 
-            cov = self.bam.count_coverage(contig=interval.chrom, start=start, end=end, quality_threshold=self.mapq)
-            summarized_cov = np.array([cov[0], cov[1], cov[2], cov[3]]).sum(axis=0)
+            for (interval, start, core_end, end), summ_cov in zip(group, depths):
 
-            # save memory, convert to uint32.
-            summ_cov = np.uint32(summarized_cov)
+                if core_end < header_dict[chrom]:
+                    flank = self.window_depth(chrom, [(core_end, None)], fetch=(core_end - 1, core_end))[0]
+                    summ_cov = np.concatenate((summ_cov, flank))
 
-            print("Computing coverage on interval %s:%s-%s" % (interval.chrom,interval.start,interval.end))
-            coverage_dict[bt.Interval(interval.chrom, start, end)] = summ_cov
+                print("Computing coverage on interval %s:%s-%s" % (interval.chrom,interval.start,interval.end))
 
-            yield(coverage_dict,header_dict)
+                yield(interval,start,summ_cov,header_dict)
 
 
     def compute_coverage(self,cov_generator):
@@ -94,80 +163,142 @@ class coverage:
         print("Computing the coverage of the identified eccDNA")
         print("Merging intervals for coverage computation")
 
-        output = []
-        for cov_dict,header_dict in cov_generator:
-            for key,value in cov_dict.items():
-
+        return(bt.BedTool(self.coverage_statistics(cov_generator)))
 
-                overlaps = bt.BedTool(self.bed.all_hits(key))
 
+    def coverage_statistics(self,cov_generator):
+        """Function that takes as input generator returning coverage numpy arrays and returns a list with the circles
+        overlapping every extended merged interval, with the summarized statistics of their coverage. The circles are
+        selected with the bedtools all_hits search, and their statistics are computed from the prefix sums of the
+        coverage array of the interval, with the numpy slicing rules of the array"""
 
-                for interval in overlaps:
+        if self.circles is None:
+            # the circles are read once and searched with the bins of bedtools for every interval
+            if not isinstance(self.bed.fn, str):
+                self.bed = self.bed.saveas()
+            self.circles = bt.IntervalFile(self.bed.fn)
 
-                    # compute array slicing indices
-                    start = interval.start -key.start
-                    end = interval.end - key.start
-
-
-                    if start - self.ext < 0:
-                        ext_start = 0
-                    else:
-                        ext_start = start - self.ext
-
-                    if header_dict[interval.chrom] < (end+ self.ext):
-                        ext_end = header_dict[interval.chrom]
-                    else:
-                        ext_end = end + self.ext
-
-                    # slice extended array and coverage array
-                    ext_array = value[ext_start:ext_end]
-                    region_array = value[start:end]
-
-
-
-
-
-
-                    try:
-
-                        mean = np.mean(region_array)
-                        sd = np.std(region_array)
+        output = []
+        for interval, window_start, window, header_dict in cov_generator:
 
-                        interval.append(str(mean))
-                        interval.append(str(sd))
+            # the extended interval the circles are searched in. Past the end of the contig when the flank reaches it
+            if header_dict[interval.chrom] < (interval.end + self.ext):
+                window_end = interval.end + self.ext
+            else:
+                window_end = interval.end
+
+            # the array is sliced as the count_coverage array was, which reached the end of the contig. The depth
+            # after the reads of the interval is 0
+            depth = window.astype(np.int64)
+            length = header_dict[interval.chrom] - window_start
+            cumulative = np.concatenate(([0], np.cumsum(depth)))
+            squares = np.concatenate(([0], np.cumsum(depth * depth)))
+            zeros = np.concatenate(([0], np.cumsum(depth == 0)))
+
+            def total(prefix, bounds):
+                return(int(prefix[min(bounds[1], len(depth))] - prefix[min(bounds[0], len(depth))]))
+
+            def bases(bounds):
+                return(np.float64(total(cumulative, bounds)))
+
+            def sub(bounds, begin, end):
+                # bounds of array[bounds[0]:bounds[1]][begin:end], negative and out of range indices included
+                first, last, step = slice(begin, end).indices(bounds[1] - bounds[0])
+                return(bounds[0] + first, bounds[0] + max(first, last))
+
+            for circle in self.circles.all_hits(bt.Interval(interval.chrom, window_start, window_end)):
+
+                # array coordinates of the circle and its flanks
+                start = circle.start - window_start
+                end = circle.end - window_start
+                ext_start = max(start - self.ext, 0)
+                if header_dict[circle.chrom] < (end + self.ext):
+                    ext_end = header_dict[circle.chrom]
+                else:
+                    ext_end = end + self.ext
+
+                region = sub((0, length), start, end)
+                ext_region = sub((0, length), ext_start, ext_end)
+                n = region[1] - region[0]
+
+                # as np.mean and np.std of an empty array, the mean and sd of an empty region are nan. The variance is
+                # exact, from the integer sums of the region
+                if n > 0:
+                    region_bases = total(cumulative, region)
+                    mean = region_bases / n
+                    sd = np.sqrt((n * total(squares, region) - region_bases * region_bases) / (n * n))
+                else:
+                    mean = np.nan
+                    sd = np.nan
+
+                # ratios of the coverage inside and around the breakpoints. 0/0 is nan and x/0 is inf
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    start_coverage_ratio = bases(sub(region, 0, self.ilen)) / \
+                                           bases(sub(ext_region, 0, self.ilen + self.ext))
+                    end_coverage_ratio = bases(sub(region, -self.ilen, None)) / \
+                                         bases(sub(ext_region, -(self.ilen + self.ext), None))
+
+                zero_bases = total(zeros, region) + max(region[1], len(depth)) - max(region[0], len(depth))
+                zero_frac = zero_bases / n if n > 0 else 'NA'
+
+                output.append(bt.create_interval_from_list(
+                    circle.fields + [str(mean), str(sd), str(start_coverage_ratio), str(end_coverage_ratio),
+                                     str(zero_frac)]))
+
+        return(output)
+
+
+    def parallel_coverage(self,processes):
+        """Function that computes the summarized coverage statistics of the circles of every contig in a process pool.
+        Every process opens the bam once, and the statistics are returned in genomic order, as compute_coverage does"""
+
+        if processes <= 1:
+            return(self.compute_coverage(self.get_wg_coverage()))
 
-                    except:
+        print("Computing the coverage of the identified eccDNA")
+        print("Merging intervals for coverage computation")
 
-                        interval.append('NA')
-                        interval.append('NA')
+        # the processes read the circles and the merged intervals from disk
+        self.bed = self.bed.saveas()
+        self.merged = self.bed.sort().merge()
 
+        contigs = []
+        for interval in self.merged:
+            if len(contigs) == 0 or contigs[-1] != interval.chrom:
+                contigs.append(interval.chrom)
 
-                    # compute ratios
+        if len(contigs) == 0:
+            return(bt.BedTool([]))
 
-                    try:
+        pool = mp.Pool(processes=min(processes, len(contigs)), initializer=open_coverage,
+                       initargs=(self.sorted_bam, self.bed.fn, self.merged.fn, self.ext, self.mapq, self.ilen,
+                                 self.directory, self.depth is not None))
 
-                        start_coverage_ratio = np.sum(region_array[0:self.ilen]) / np.sum(
-                            ext_array[0:(self.ilen + self.ext)])
-                        end_coverage_ratio = np.sum(region_array[-self.ilen:]) / np.sum(ext_array[-(self.ilen + self.ext):])
+        output = []
+        for fields in pool.imap(contig_coverage, contigs):
+            output.extend(bt.create_interval_from_list(interval) for interval in fields)
 
-                        interval.append(str(start_coverage_ratio))
-                        interval.append(str(end_coverage_ratio))
+        pool.close()
+        pool.join()
 
-                    except:
+        return(bt.BedTool(output))
 
-                        interval.append('NA')
-                        interval.append('NA')
 
-                    try:
+#coverage object of every process of the coverage pool
+worker_coverage = {}
 
 
-                        zero_frac = np.count_nonzero(region_array == 0) / len(region_array)
-                        interval.append(str(zero_frac))
+def open_coverage(sorted_bam,bed,merged,extension,mapq,inside_length,directory,depth_index):
+    """Function that opens the sorted bam, the circles and their merged intervals once for every process. It is used as
+    the initializer of the coverage pool"""
 
-                    except:
+    worker_coverage['coverage'] = coverage(sorted_bam, bt.BedTool(bed), extension, mapq, inside_length, directory,
+                                           depth_index)
+    worker_coverage['coverage'].merged = bt.BedTool(merged)
 
-                        interval.append('NA')
-                    output.append(interval)
 
+def contig_coverage(chrom):
+    """Function that takes as input a contig and returns the fields of its circles with their coverage statistics"""
 
-        return(bt.BedTool(output))
+    contig = worker_coverage['coverage']
+    return([interval.fields for interval in contig.coverage_statistics(contig.get_wg_coverage(chrom))])
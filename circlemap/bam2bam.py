@@ -25,17 +25,22 @@ from __future__ import division
 
 import os
 import sys
-from Bio.Seq import Seq
 import time
 from circlemap.utils import *
+from circlemap.genome_index import open_reference, interval_cache
 import pandas as pd
 import traceback
+import copy
 import multiprocessing as mp
 import warnings
 import datetime
 
 
 
+#bam and fasta files opened once by every process of the bam2bam pool
+worker_files = {}
+
+
 class bam2bam:
     """Class for managing the realignment and eccDNA indetification of circle-map"""
 
@@ -44,7 +49,7 @@ class bam2bam:
     def __init__(self, input_bam,output,qname_bam,genome_fasta,directory,mapq_cutoff,insert_size_mapq,std_extension,
                  insert_size_sample_size,gap_open,gap_ext,n_hits,prob_cutoff,min_soft_clipped_length,
                  interval_p_cut,ncores,locker,verbose,pid,edit_distance_frac,
-                 remap_splits,only_discordants,score,insert_size,manager):
+                 remap_splits,only_discordants,score,insert_size,manager,interval_cache_size):
         #I/O
         self.edit_distance_frac = edit_distance_frac
         self.ecc_dna_str = input_bam
@@ -87,6 +92,9 @@ class bam2bam:
 
         self.pid = pid
 
+        #realignment intervals cached by every process
+        self.interval_cache_size = interval_cache_size * 1024 * 1024
+
         #parallel enviroment
         self.read_list = manager.list()
         self.read_count = manager.Value('i', 0)
@@ -135,15 +143,32 @@ class bam2bam:
 
 
 
+    @staticmethod
+    def open_files(ecc_dna_str,genome_fa,interval_cache_size):
+        """Function that opens the bam and fasta files, together with their indexes, once for every process. It is used
+        as the initializer of the bam2bam pool, so that the handles are reused across the chunks"""
+
+        worker_files['genome_fa'] = interval_cache(open_reference(genome_fa),interval_cache_size)
+        worker_files['ecc_dna'] = ps.AlignmentFile(ecc_dna_str, "rb")
+
+    def initargs(self):
+        """Arguments for the pool initializer"""
+        return((self.ecc_dna_str,self.genome_fa,self.interval_cache_size))
+
+
+
     def realign(self,peaks):
         """Function that will iterate trough the bam file containing reads indicating eccDNA structural variants and
         will output a bed file containing the soft-clipped reads, the discordant and the coverage within the interval"""
 
-        #open files for every process
+        #files are opened once by every process
         try:
+            if len(worker_files) == 0:
+                self.open_files(*self.initargs())
+
             peaks_pd = pd.DataFrame.from_records(peaks,columns=['chrom', 'start', 'end'])
-            genome_fa = ps.FastaFile(self.genome_fa)
-            ecc_dna = ps.AlignmentFile(self.ecc_dna_str,"rb")
+            genome_fa = worker_files['genome_fa']
+            ecc_dna = worker_files['ecc_dna']
 
             begin = time.time()
 
@@ -195,6 +220,11 @@ class bam2bam:
 
 
 
+                        #the reads of the peak are fetched and decoded once, and evaluated against every mate interval.
+                        #The alignments are kept apart to be written out
+                        alignments = []
+                        peak_reads = get_peak_reads(ecc_dna,interval,self.mapq_cutoff,alignments)
+
                         iteration_results = []
                         for index,mate_interval in realignment_interval_extended.iterrows():
 
@@ -205,31 +235,22 @@ class bam2bam:
                             #sample realignment intervals
                             #fasta file fetch is 1 based that why I do +1
 
-                            plus_coding_interval = genome_fa.fetch(str(mate_interval['chrom']),int(int(mate_interval['start'])+1),int(int(mate_interval['end'])+1)).upper()
-                            interval_length = len(plus_coding_interval)
-                            minus_coding_interval = str(Seq(plus_coding_interval).complement())
-
-                            # precompute the denominators of the error model. They will be constants for every interval
-                            plus_base_freqs = background_freqs(plus_coding_interval)
-
-                            minus_base_freqs = {'T':plus_base_freqs['A'],'A':plus_base_freqs['T'],
-                                                'C':plus_base_freqs['G'],'G':plus_base_freqs['C']}
-
-                            minus_base_freqs = np.array([plus_base_freqs['T'],plus_base_freqs['A'],plus_base_freqs['G'],plus_base_freqs['C']])
-                            plus_base_freqs = np.array([plus_base_freqs['A'],plus_base_freqs['T'],plus_base_freqs['C'],plus_base_freqs['G']])
+                            realignment_interval = genome_fa.entry(
+                                str(mate_interval['chrom']),int(int(mate_interval['start'])+1),int(int(mate_interval['end'])+1))
+                            interval_length = len(realignment_interval['plus_codes'])
 
 
                             #note that I am getting the reads of the interval. Not the reads of the mates
 
-                            for read in ecc_dna.fetch(interval['chrom'],int(interval['start']),int(interval['end']),multiple_iterators=True):
+                            for read in peak_reads:
 
 
-                                if is_soft_clipped(read):
+                                if read.soft_clipped:
 
                                     if read.mapq >= self.mapq_cutoff:
 
                                         # no need to realignment
-                                        if read.has_tag('SA') and self.remap != True:
+                                        if read.sa != None and self.remap != True:
 
                                             # check realignment from SA tag
                                             support = circle_from_SA(read, self.mapq_cutoff, mate_interval)
@@ -240,7 +261,7 @@ class bam2bam:
                                             else:
 
                                                 if support['support'] == True:
-                                                    self.queue.put(read.to_string())
+                                                    self.queue.put(alignments[read.index].to_string())
 
                                                 else:
                                                     # uninformative read
@@ -250,17 +271,26 @@ class bam2bam:
 
                                         else:
                                             #sc length
-                                            sc_len = len(get_longest_soft_clipped_bases(read)['seq'])
+                                            sc_len = read.sc_len
 
 
-                                            if non_colinearity(int(read.cigar[0][0]),int(read.cigar[-1][0]),int(read.pos),
+                                            if non_colinearity(read.cigar_start,read.cigar_end,read.reference_start,
                                                                int(mate_interval.start),int(mate_interval.end)) == True:
                                                 if sc_len >= self.min_sc_length:
                                                     edits_allowed = adaptative_myers_k(sc_len, self.edit_distance_frac)
+                                                #q-gram filter
+
+                                                    seeded = seed_filter(read.sc_codes,
+                                                                         interval_seeds(realignment_interval,read.is_reverse),
+                                                                         edits_allowed)
                                                 #realignment
 
-                                                    realignment_dict = realign(read,self.n_hits,plus_coding_interval,minus_coding_interval,
-                                                                               plus_base_freqs,minus_base_freqs,self.gap_open,self.gap_ext,self.verbose,edits_allowed)
+                                                    if seeded == False:
+                                                        realignment_dict = None
+                                                    else:
+                                                        realignment_dict = realign(read,self.n_hits,realignment_interval['plus_codes'],realignment_interval['minus_codes'],
+                                                                                   realignment_interval['plus_freqs'],realignment_interval['minus_freqs'],
+                                                                                   self.gap_open,self.gap_ext,self.verbose,edits_allowed)
 
 
                                                     if realignment_dict == None:
@@ -275,7 +305,7 @@ class bam2bam:
                                                             # here I have to retrieve the nucleotide mapping positions. Which should be the
                                                             # the left sampling pysam coordinate - edlib coordinates
 
-                                                            read_end = rightmost_from_read(read)
+                                                            read_end = read.read_end
 
                                                             #aln start on the reference
                                                             soft_clip_start = int(mate_interval['start'])+ int(realignment_dict['alignments'][1][0][0])
@@ -295,9 +325,9 @@ class bam2bam:
                                                                                                   soft_clip_start)
 
 
-                                                                    #read.tags += [('SA', sa_tag)]
+                                                                    #alignments[read.index].tags += [('SA', sa_tag)]
 
-                                                                    self.queue.put(read.to_string())
+                                                                    self.queue.put(alignments[read.index].to_string())
 
 
 
@@ -310,9 +340,11 @@ class bam2bam:
                                                                                                            'chrom'],
                                                                                                        soft_clip_start)
 
-                                                                read.tags += [('SA', sa_tag)]
+                                                                # the read is shared by all the mate intervals of the peak
+                                                                segment = copy.copy(alignments[read.index])
+                                                                segment.tags += [('SA', sa_tag)]
 
-                                                                self.queue.put(read.to_string())
+                                                                self.queue.put(segment.to_string())
 
                                                             else:
                                                                 # uninformative read
@@ -342,16 +374,10 @@ class bam2bam:
 
 
 
-            ecc_dna.close()
-            genome_fa.close()
-
         except:
             print("Failed on cluster:")
             print(traceback.print_exc(file=sys.stdout))
             return([1,1])
 
-        genome_fa.close()
-        ecc_dna.close()
-
 
         return([0,0])
\ No newline at end of file
@@ -0,0 +1,232 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import os
+import zlib
+import struct
+import numpy as np
+
+# gzip member header of a BGZF block: ID1, ID2, CM=deflate and FLG=FEXTRA
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+# largest BGZF block, compressed or not
+BGZF_BLOCK = 65536
+
+# fixed fields of a bam record, from block_size to tlen
+RECORD = struct.Struct('<iiiBBHHHIiii')
+
+# consecutive records that have to parse for a candidate offset to be taken as a record start. Long reads are taken
+# earlier, once the records parsed span RECORD_SPAN uncompressed bytes
+RECORD_CHAIN = 16
+RECORD_SPAN = 4 * BGZF_BLOCK
+
+
+def block_size(header):
+    """Function that takes as input the first bytes of a gzip member and returns the size of the BGZF block, or None if
+    they are not the header of a BGZF block"""
+
+    if len(header) < 18 or header[:4] != BGZF_MAGIC:
+        return(None)
+
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    extra = header[12:12 + xlen]
+    if len(extra) < xlen:
+        return(None)
+
+    # look for the BC subfield holding the block size minus one
+    field = 0
+    while field + 4 <= xlen:
+        slen = struct.unpack_from('<H', extra, field + 2)[0]
+        if extra[field:field + 2] == b'BC' and slen == 2 and field + 6 <= xlen:
+            return(struct.unpack_from('<H', extra, field + 4)[0] + 1)
+        field += 4 + slen
+
+    return(None)
+
+
+def next_block(handle, offset, file_size):
+    """Function that takes as input a BGZF file handle and a byte offset, and returns the offset of the first BGZF block
+    starting at or after it. A candidate is only taken when the next block starts where it ends"""
+
+    while offset < file_size:
+        handle.seek(offset)
+        window = handle.read(2 * BGZF_BLOCK + 18)
+
+        hit = window.find(BGZF_MAGIC)
+        while hit != -1:
+            size = block_size(window[hit:hit + 18 + 256])
+            if size is not None:
+                if offset + hit + size == file_size:
+                    return(offset + hit)
+                handle.seek(offset + hit + size)
+                if block_size(handle.read(18 + 256)) is not None:
+                    return(offset + hit)
+            hit = window.find(BGZF_MAGIC, hit + 1)
+
+        offset += max(len(window) - 18, 1)
+
+    return(None)
+
+
+def read_block(handle, offset):
+    """Function that takes as input a BGZF file handle and the offset of a block, and returns its uncompressed data and
+    the offset of the next block"""
+
+    handle.seek(offset)
+    header = handle.read(18 + 256)
+    size = block_size(header)
+    handle.seek(offset)
+    block = handle.read(size)
+    xlen = struct.unpack_from('<H', block, 10)[0]
+
+    return(zlib.decompressobj(-15).decompress(block[12 + xlen:size - 8]), offset + size)
+
+
+def is_record(data, at, n_references):
+    """Function that takes as input uncompressed bam data and an offset in it, and returns the size of the record
+    starting there if its fixed fields and read name are consistent, 0 if they are not and None if the data ends before
+    the read name"""
+
+    if at + RECORD.size > len(data):
+        return(None)
+
+    size, ref, pos, l_name, mapq, bin, n_cigar, flag, l_seq, mate_ref, mate_pos, tlen = RECORD.unpack_from(data, at)
+
+    if (not -1 <= ref < n_references or not -1 <= mate_ref < n_references or pos < -1 or mate_pos < -1 or l_name < 2
+            or size < 32 + l_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq):
+        return(0)
+
+    name = data[at + RECORD.size:at + RECORD.size + l_name]
+    if len(name) < l_name:
+        return(None)
+    if name[-1] != 0 or any(char < 33 or char > 126 for char in name[:-1]):
+        return(0)
+
+    return(size + 4)
+
+
+def words(data, offset, count):
+    """Function that takes as input uncompressed data and returns the little endian unsigned 32 bit integers starting at
+    count consecutive bytes from the offset"""
+
+    data = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    return(data[offset:offset + count] | data[offset + 1:offset + 1 + count] << 8 |
+           data[offset + 2:offset + 2 + count] << 16 | data[offset + 3:offset + 3 + count] << 24)
+
+
+def record_candidates(data, count, n_references):
+    """Function that takes as input uncompressed bam data and returns the offsets, among the first count bytes, whose
+    references, positions and first read name character could start a record"""
+
+    count = min(count, len(data) - RECORD.size)
+    if count <= 0:
+        return([])
+
+    ref = words(data, 4, count)
+    pos = words(data, 8, count)
+    mate_ref = words(data, 24, count)
+    mate_pos = words(data, 28, count)
+    values = np.frombuffer(data, dtype=np.uint8)
+    l_name = values[12:12 + count]
+    name = values[RECORD.size:RECORD.size + count]
+
+    # -1 is 0xffffffff
+    candidates = (((ref < n_references) | (ref == 0xffffffff)) & ((mate_ref < n_references) | (mate_ref == 0xffffffff))
+                  & ((pos < 0x80000000) | (pos == 0xffffffff)) & ((mate_pos < 0x80000000) | (mate_pos == 0xffffffff))
+                  & (l_name >= 2) & (name >= 33) & (name <= 126))
+
+    return(np.flatnonzero(candidates).tolist())
+
+
+def first_record(handle, offset, file_size, n_references):
+    """Function that takes as input a bam file handle and a byte offset, and returns the virtual offset of the first
+    record starting in a BGZF block at or after it. Records span blocks, so the record start is found by parsing the
+    uncompressed data from the candidate offsets of the block until RECORD_CHAIN consecutive records are consistent"""
+
+    block = next_block(handle, offset, file_size)
+
+    while block is not None and block < file_size:
+        data, following = read_block(handle, block)
+        data = bytearray(data)
+        first = len(data)
+        end = following
+
+        # records starting at the end of the block are screened with the data of the next block
+        if end < file_size:
+            more, end = read_block(handle, end)
+            data += more
+
+        for at in record_candidates(data, first, n_references):
+            chained = 0
+            record = at
+            while chained < RECORD_CHAIN and not (chained > 1 and record - at >= RECORD_SPAN):
+                size = is_record(data, record, n_references)
+                if size is None or (size and record + size > len(data)):
+                    # the chain needs more data
+                    if end >= file_size:
+                        break
+                    more, end = read_block(handle, end)
+                    data += more
+                    continue
+                if size == 0:
+                    break
+                record += size
+                chained += 1
+
+            if (chained == RECORD_CHAIN or (chained > 1 and record - at >= RECORD_SPAN) or
+                    (chained > 0 and record == len(data) and end >= file_size)):
+                return((block << 16) | at)
+
+        block = following if following < file_size else None
+
+    return(None)
+
+
+def bam_partitions(bam, partitions):
+    """Function that takes as input a bam file and a number of partitions, and returns the virtual offsets of the
+    records where every partition starts. The partitions split the compressed file in byte ranges of equal size, and
+    every one starts at the first record of the first BGZF block of its range. Partitions without records are dropped"""
+
+    import pysam as ps
+
+    with ps.AlignmentFile(bam, "rb") as handle:
+        starts = [handle.tell()]
+        n_references = handle.nreferences
+
+    file_size = os.path.getsize(bam)
+
+    with open(bam, 'rb') as handle:
+        for partition in range(1, partitions):
+            # never inside the block holding the end of the header
+            offset = max(file_size * partition // partitions, (starts[0] >> 16) + 1)
+            start = first_record(handle, offset, file_size, n_references)
+            if start is not None and start > starts[-1]:
+                starts.append(start)
+
+    return(starts)
+
+
+def is_bgzf(bam):
+    """Function that returns True if the file starts with a BGZF block, so it can be partitioned"""
+
+    with open(bam, 'rb') as handle:
+        return(block_size(handle.read(18 + 256)) is not None)
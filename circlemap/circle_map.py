@@ -23,26 +23,14 @@
 
 import argparse
 import sys
-from functools import partial
 import os
 import time
-import pandas as pd
-import pysam as ps
-from circlemap.extract_circle_SV_reads import readExtractor
-from circlemap.realigner import realignment
-from circlemap.bam2bam import bam2bam
-from circlemap.repeats import repeat
-from circlemap.utils import merge_final_output, filter_by_ratio, start_realign, start_simulate, mutate, insert_size_dist
-from circlemap.Coverage import coverage
-import multiprocessing as mp
-import pybedtools as bt
-from circlemap.simulations import sim_ecc_reads
-import subprocess as sp
-import glob
-from tqdm import *
 from circlemap.__version__ import __version__ as cm_version
 import datetime
 
+# every subcommand imports the modules it needs, so that the short subcommands and the help do not pay for the
+# import of the heavy ones. tests/test_import_budget.py checks the modules imported by every subcommand
+
 class circle_map:
 
     def __getpid__(self):
@@ -67,6 +55,7 @@ Commands:
    bam2bam         Realign circular DNA read candidates and report them on a new BAM file
    Repeats         Identify circular DNA from repetitive regions
    Simulate        Simulate circular DNA
+   Index           Pack the reference genome into a 2-bit index for the realignment
 
 ''' % cm_version)
         subparsers = self.parser.add_subparsers()
@@ -109,6 +98,14 @@ Commands:
 
         )
 
+        self.index = subparsers.add_parser(
+            name="Index",
+            description='Pack the reference genome into a 2-bit index for the realignment',
+            prog="Circle-Map Index",
+            usage='''Circle-Map Index [options]'''
+
+        )
+
         if len(sys.argv) <= 1:
             self.parser.print_help()
             time.sleep(0.01)
@@ -119,6 +116,7 @@ Commands:
         else:
             if sys.argv[1] == "ReadExtractor":
 
+                from circlemap.extract_circle_SV_reads import readExtractor
 
                 self.subprogram = self.args_readextractor()
                 self.args = self.subprogram.parse_args(sys.argv[2:])
@@ -126,15 +124,32 @@ Commands:
                 object = readExtractor(self.args.i, self.args.output, self.args.directory, self.args.quality,
                                        self.args.nodiscordant,
                                        self.args.nohardclipped, self.args.nosoftclipped, self.args.verbose,
-                                       self.subprogram)
+                                       self.subprogram, self.args.threads, self.args.processes,
+                                       self.args.max_memory)
                 object.extract_sv_circleReads()
 
             elif sys.argv[1] == "Realign":
+                launch = time.time()
+
+                import multiprocessing as mp
+                from tqdm import tqdm
+                from circlemap.realigner import realignment
+                from circlemap.utils import merge_final_output, filter_by_ratio, start_realign, insert_size_dist, \
+                    report_balance, report_cache, report_seeds, report_memory, warm_up_kernels, report_latency
+                from circlemap.Coverage import coverage
+                from circlemap.genome_index import index_files, warm_up_minimizers, update_index
+                from circlemap.depth_index import load_depth
+
                 self.subprogram = self.args_realigner()
                 self.args = self.subprogram.parse_args(sys.argv[2:])
 
+                if self.args.lonely_soft_clipped and not os.path.isfile(index_files(self.args.fasta)['minimizer_meta']):
+                    sys.stderr.write("\nThe option --lonely_soft_clipped needs the minimizer index of the reference. Run "
+                                     "'Circle-Map Index -fasta %s -mm' first\nExiting\n" % self.args.fasta)
+                    sys.exit(0)
+
                 # get clusters
-                splitted, sorted_bam, begin = start_realign(self.args.i, self.args.output, self.args.threads,
+                splitted, sorted_bam, begin, chunk_costs = start_realign(self.args.i, self.args.output, self.args.threads,
                                                             self.args.verbose, self.__getpid__(),
                                                             self.args.clustering_dist)
 
@@ -146,11 +161,7 @@ Commands:
                 metrics = insert_size_dist(self.args.sample_size, self.args.insert_mapq, self.args.qbam)
 
 
-                # pool based parallel of religment
-                m = mp.Manager()
-
-                lock = m.Lock()
-
+                # pool based parallel of religment. Every process writes its results to its own shard
                 object = realignment(self.args.i, self.args.qbam, self.args.sbam, self.args.fasta,
                                      self.args.directory,
                                      self.args.mapq,
@@ -158,32 +169,64 @@ Commands:
                                      self.args.gap_open,
                                      self.args.gap_ext, self.args.nhits, self.args.cut_off, self.args.min_sc,
                                      self.args.merge_fraction, self.args.interval_probability, self.args.output,
-                                     self.args.threads, self.args.allele_frequency, lock, self.args.split,
+                                     self.args.threads, self.args.allele_frequency, self.args.split,
                                      self.args.ratio, self.args.verbose, self.__getpid__(),
                                      self.args.edit_distance_fraction, self.args.remap_splits,
                                      self.args.only_discordants, self.args.split,
-                                     self.args.split_quality, metrics,self.args.number_of_discordants)
+                                     self.args.split_quality, metrics,self.args.number_of_discordants,
+                                     self.args.interval_cache, self.args.lonely_soft_clipped,
+                                     self.args.max_memory, self.args.depth_index)
+
+                # a stale reference index is rebuilt once, before the workers open it
+                update_index(self.args.fasta)
+
+                # the depth index is built once, before the workers open it
+                if self.args.depth_index:
+                    load_depth(self.args.sbam, None, self.args.directory)
 
+                # the kernels are compiled once and inherited by the processes of the pool
+                warm_up = warm_up_kernels()
+                if self.args.lonely_soft_clipped:
+                    warm_up += warm_up_minimizers()
 
-                pool = mp.Pool(processes=self.args.threads)
+                #every process of the pool opens the bam and fasta files once
+                pool_start = time.time()
+                pool = mp.Pool(processes=self.args.threads,initializer=object.open_files,initargs=object.initargs())
+                first_result = None
 
 
+                #time spent by the workers in every chunk
+                chunk_stats = []
+
                 #progress bar
                 with tqdm(total=len(splitted)) as pbar:
                     for i,exits in tqdm(enumerate(pool.imap_unordered(object.realign, splitted))):
                         pbar.update()
                         #kill if process returns 1,1
-                        if exits == [1,1]:
+                        if exits[:2] == [1,1]:
                             pool.close()
                             pool.terminate()
                             pbar.close()
                             print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
                                   "An error happenend during execution. Exiting")
                             sys.exit()
+                        if first_result is None:
+                            first_result = time.time()
+                        chunk_stats.append(exits[2])
 
                 pbar.close()
                 pool.close()
                 pool.join()
+
+                if self.args.verbose > 2:
+                    report_balance(chunk_costs, chunk_stats, self.args.threads)
+                    report_cache(chunk_stats)
+                    report_seeds(chunk_stats)
+                    if self.args.verbose > 3:
+                        report_memory(chunk_stats)
+                    if first_result is not None:
+                        report_latency(warm_up, launch, pool_start, first_result, chunk_stats)
+
                 output = merge_final_output(self.args.sbam, self.args.output, begin, self.args.split,
                                             self.args.directory,
                                             self.args.merge_fraction, self.__getpid__())
@@ -193,10 +236,10 @@ Commands:
 
                     coverage_object = coverage(self.args.sbam, output,
                                                self.args.bases, self.args.cmapq, self.args.extension,
-                                               self.args.directory)
+                                               self.args.directory, self.args.depth_index)
 
-                    #Generator function for the coverage calculations
-                    output = coverage_object.compute_coverage(coverage_object.get_wg_coverage())
+                    #coverage of every contig computed by its own process
+                    output = coverage_object.parallel_coverage(self.args.threads)
                     filtered_output = filter_by_ratio(output, self.args.ratio)
                     filtered_output.to_csv(r'%s' % self.args.output, header=None, index=None, sep='\t', mode='w')
 
@@ -204,11 +247,19 @@ Commands:
                     output.saveas("%s" % self.args.output)
 
             elif sys.argv[1] == "bam2bam":
+
+                import multiprocessing as mp
+                import pysam as ps
+                from tqdm import tqdm
+                from circlemap.bam2bam import bam2bam
+                from circlemap.utils import start_realign, insert_size_dist, warm_up_kernels
+                from circlemap.genome_index import update_index
+
                 self.subprogram = self.args_bam2bam()
                 self.args = self.subprogram.parse_args(sys.argv[2:])
 
                 # get clusters
-                splitted, sorted_bam, begin = start_realign(self.args.i, self.args.output, self.args.threads,
+                splitted, sorted_bam, begin, chunk_costs = start_realign(self.args.i, self.args.output, self.args.threads,
                                                             self.args.verbose, self.__getpid__(),
                                                             self.args.clustering_dist)
 
@@ -242,12 +293,19 @@ Commands:
                                      self.args.verbose, self.__getpid__(),
                                      self.args.edit_distance_fraction, self.args.remap_splits,
                                      self.args.only_discordants,
-                                     self.args.split_quality, metrics,manager)
+                                     self.args.split_quality, metrics,manager,self.args.interval_cache)
 
                 object.beta_version_warning()
 
+                # a stale reference index is rebuilt once, before the workers open it
+                update_index(self.args.fasta)
+
+                # the kernels are compiled once and inherited by the processes of the pool
+                warm_up_kernels()
 
-                pool = mp.Pool(processes=self.args.threads)
+
+                #every process of the pool opens the bam and fasta files once
+                pool = mp.Pool(processes=self.args.threads,initializer=object.open_files,initargs=object.initargs())
                 # create writer process
 
                 writer_p =  mp.Process(target=object.listener_writer, args=(circle_sv_reads,))
@@ -279,6 +337,10 @@ Commands:
 
             elif sys.argv[1] == "Repeats":
 
+                from circlemap.repeats import repeat
+                from circlemap.utils import filter_by_ratio
+                from circlemap.Coverage import coverage
+
                 self.subprogram = self.args_repeats()
                 self.args = self.subprogram.parse_args(sys.argv[2:])
 
@@ -290,17 +352,36 @@ Commands:
 
                 coverage_object = coverage(self.args.i, bed,
                                            self.args.bases, self.args.cmapq, self.args.extension,
-                                           self.args.directory)
+                                           self.args.directory, self.args.depth_index)
 
-                output = coverage_object.compute_coverage(coverage_object.get_wg_coverage())
+                #coverage of every contig computed by its own process
+                output = coverage_object.parallel_coverage(self.args.threads)
 
                 filtered_output = filter_by_ratio(output, self.args.ratio)
                 filtered_output.to_csv(r'%s' % self.args.output, header=None, index=None, sep='\t', mode='w')
 
 
 
+            elif sys.argv[1] == "Index":
+
+                from circlemap.genome_index import build_index, build_minimizer_index
+
+                self.subprogram = self.args_index()
+                self.args = self.subprogram.parse_args(sys.argv[2:])
+
+                build_index(self.args.fasta)
+
+                if self.args.minimizers:
+                    build_minimizer_index(self.args.fasta, self.args.kmer, self.args.window)
+
+
             elif sys.argv[1] == "Simulate":
 
+                import multiprocessing as mp
+                import pybedtools as bt
+                from circlemap.utils import start_simulate, mutate
+                from circlemap.simulations import sim_ecc_reads
+
                 self.subprogram = self.args_simulate()
                 self.args = self.subprogram.parse_args(sys.argv[2:])
 
@@ -366,12 +447,14 @@ Commands:
         # prefixing the argument with -- means it's optional
         # input and output
 
-        required.add_argument('-i', metavar='', help="Input: query name sorted bam file")
+        required.add_argument('-i', metavar='', help="Input: query name sorted bam file. '-' reads SAM or BAM grouped by read name from stdin, as the aligner writes it. Coordinate sorted bams are read directly, and by contig with -p when they are indexed")
 
         if "-i" in sys.argv:
+            # a stream is written to stdout by default
+            input_bam = sys.argv[sys.argv.index("-i") + 1]
             optional.add_argument('-o', '--output', metavar='',
-                                  help="Ouput: Reads indicating circular DNA structural variants",
-                                  default="circle_%s" % sys.argv[sys.argv.index("-i") + 1])
+                                  help="Ouput: Reads indicating circular DNA structural variants. '-' writes them to stdout",
+                                  default="-" if input_bam == "-" else "circle_%s" % input_bam)
 
             optional.add_argument('-dir', '--directory', metavar='',
                                   help="Working directory, default is the working directory",
@@ -401,9 +484,23 @@ Commands:
                                   help='Verbose level, 1=error,2=warning, 3=message',
                                   choices=[1, 2, 3], default=3)
 
+            # BGZF compression and decompression threads
+            optional.add_argument('-t', '--threads', type=int, metavar='',
+                                  help="Number of threads used by htslib to decompress the input and compress the output bam. Default 1",
+                                  default=1)
+
+            optional.add_argument('-p', '--processes', type=int, metavar='',
+                                  help="Number of processes extracting partitions of the input bam, or its contigs when it is coordinate sorted and indexed. Default 1",
+                                  default=1)
+
+            optional.add_argument('-M', '--max_memory', type=int, metavar='',
+                                  help="Memory (MB) of reads waiting for their mates kept by every process when the "
+                                       "input bam is coordinate sorted, before they are spilled to disk. Default: 1000",
+                                  default=1000)
+
         else:
             optional.add_argument('-o', '--output', metavar='',
-                                  help="Ouput: Reads indicating circular DNA structural variants")
+                                  help="Ouput: Reads indicating circular DNA structural variants. '-' writes them to stdout")
 
             optional.add_argument('-dir', '--directory', metavar='',
                                   help="Working directory, default is the working directory",
@@ -432,6 +529,20 @@ Commands:
                                   help='Verbose level, 1=error,2=warning, 3=message. Default=3',
                                   choices=[1, 2, 3], default=3)
 
+            # BGZF compression and decompression threads
+            optional.add_argument('-t', '--threads', type=int, metavar='',
+                                  help="Number of threads used by htslib to decompress the input and compress the output bam. Default 1",
+                                  default=1)
+
+            optional.add_argument('-p', '--processes', type=int, metavar='',
+                                  help="Number of processes extracting partitions of the input bam, or its contigs when it is coordinate sorted and indexed. Default 1",
+                                  default=1)
+
+            optional.add_argument('-M', '--max_memory', type=int, metavar='',
+                                  help="Memory (MB) of reads waiting for their mates kept by every process when the "
+                                       "input bam is coordinate sorted, before they are spilled to disk. Default: 1000",
+                                  default=1000)
+
             parser.print_help()
 
             time.sleep(0.01)
@@ -467,7 +578,7 @@ Commands:
                                 help="Input: bam file containing the reads extracted by ReadExtractor")
         io_options.add_argument('-qbam', metavar='', help="Input: query name sorted bam file")
         io_options.add_argument('-sbam', metavar='', help="Input: coordinate sorted bam file")
-        io_options.add_argument('-fasta', metavar='', help="Input: Reference genome fasta file")
+        io_options.add_argument('-fasta', metavar='', help="Input: Reference genome fasta file. The Circle-Map Index of the fasta is used when present")
 
         if "-i" and "-qbam" and "-fasta" in sys.argv:
             # output
@@ -511,6 +622,11 @@ Commands:
             alignment_options.add_argument('-R', '--remap_splits', help="Remap probabilistacally the split reads",
                                            action='store_true')
 
+            alignment_options.add_argument('-L', '--lonely_soft_clipped', help="Realign the soft-clipped reads without SA tag "
+                                           "whose only prior is the whole contig to the hits of their minimizers. Needs "
+                                           "'Circle-Map Index -mm'",
+                                           action='store_true')
+
             # insert size
 
             i_size_estimate.add_argument('-iq', '--insert_mapq', type=int, metavar='',
@@ -569,6 +685,13 @@ Commands:
                                           help="Minimum mapping quality treshold for coverage computation. Default: 0",
                                           default=0)
 
+            coverage_metrics.add_argument('-di', '--depth_index', help="Store the read depth of the sorted bam in a "
+                                                                       "run-length encoded index next to it, and compute "
+                                                                       "the allele frequency and the coverage metrics from "
+                                                                       "it. The index is reused by later runs on the same "
+                                                                       "bam",
+                                          action='store_true')
+
             coverage_metrics.add_argument('-E', '--extension', type=int, metavar='',
                                           help="Number of bases inside the eccDNA breakpoint coordinates to compute the ratio. Default: 100",
                                           default=100)
@@ -579,13 +702,22 @@ Commands:
                                  help="Number of threads to use.Default 1",
                                  default=1)
 
+            running.add_argument('-ic', '--interval_cache', type=int, metavar='',
+                                 help="Memory (MB) of realignment intervals cached by every process. Default: 200",
+                                 default=200)
+
+            running.add_argument('-M', '--max_memory', type=int, metavar='',
+                                 help="Memory (MB) of realignment evidence kept by every process before it is merged and "
+                                      "written to disk. Default: 1000",
+                                 default=1000)
+
             running.add_argument('-dir', '--directory', metavar='',
                                  help="Working directory, default is the working directory",
                                  default=os.getcwd())
 
             running.add_argument('-v', '--verbose', type=int, metavar='',
-                                 help='Verbose level, 1=error,2=warning, 3=message',
-                                 choices=[1, 2, 3], default=3)
+                                 help='Verbose level, 1=error,2=warning, 3=message, 4=debug',
+                                 choices=[1, 2, 3, 4], default=3)
 
 
 
@@ -629,6 +761,11 @@ Commands:
             alignment_options.add_argument('-R', '--remap_splits', help="Remap probabilistacally bwa-mem split reads",
                                            action='store_true')
 
+            alignment_options.add_argument('-L', '--lonely_soft_clipped', help="Realign the soft-clipped reads without SA tag "
+                                           "whose only prior is the whole contig to the hits of their minimizers. Needs "
+                                           "'Circle-Map Index -mm'",
+                                           action='store_true')
+
             # insert size
 
             i_size_estimate.add_argument('-iq', '--insert_mapq', type=int, metavar='',
@@ -687,6 +824,13 @@ Commands:
                                           help="Minimum mapping quality treshold for coverage computation. Default: 0",
                                           default=0)
 
+            coverage_metrics.add_argument('-di', '--depth_index', help="Store the read depth of the sorted bam in a "
+                                                                       "run-length encoded index next to it, and compute "
+                                                                       "the allele frequency and the coverage metrics from "
+                                                                       "it. The index is reused by later runs on the same "
+                                                                       "bam",
+                                          action='store_true')
+
             coverage_metrics.add_argument('-E', '--extension', type=int, metavar='',
                                           help="Number of bases inside the eccDNA breakpoint coordinates to compute the ratio. Default: 100",
                                           default=100)
@@ -697,13 +841,22 @@ Commands:
                                  help="Number of threads to use.Default 1",
                                  default=1)
 
+            running.add_argument('-ic', '--interval_cache', type=int, metavar='',
+                                 help="Memory (MB) of realignment intervals cached by every process. Default: 200",
+                                 default=200)
+
+            running.add_argument('-M', '--max_memory', type=int, metavar='',
+                                 help="Memory (MB) of realignment evidence kept by every process before it is merged and "
+                                      "written to disk. Default: 1000",
+                                 default=1000)
+
             running.add_argument('-dir', '--directory', metavar='',
                                  help="Working directory, default is the working directory",
                                  default=os.getcwd())
 
             running.add_argument('-v', '--verbose', type=int, metavar='',
-                                 help='Verbose level, 1=error,2=warning, 3=message',
-                                 choices=[1, 2, 3], default=3)
+                                 help='Verbose level, 1=error,2=warning, 3=message, 4=debug',
+                                 choices=[1, 2, 3, 4], default=3)
 
             # find out which arguments are missing
 
@@ -737,7 +890,7 @@ Commands:
         io_options.add_argument('-i', metavar='',
                                 help="Input: bam file containing the reads extracted by ReadExtractor")
         io_options.add_argument('-qbam', metavar='', help="Input: query name sorted bam file")
-        io_options.add_argument('-fasta', metavar='', help="Input: Reference genome fasta file")
+        io_options.add_argument('-fasta', metavar='', help="Input: Reference genome fasta file. The Circle-Map Index of the fasta is used when present")
         io_options.add_argument('-o', '--output', metavar='', help="Output BAM name")
 
         if "-i" and "-qbam" and "-fasta" and "-o" in sys.argv:
@@ -817,6 +970,10 @@ Commands:
                                  help="Number of threads to use.Default 1",
                                  default=1)
 
+            running.add_argument('-ic', '--interval_cache', type=int, metavar='',
+                                 help="Memory (MB) of realignment intervals cached by every process. Default: 200",
+                                 default=200)
+
             running.add_argument('-dir', '--directory', metavar='',
                                  help="Working directory, default is the working directory",
                                  default=os.getcwd())
@@ -898,6 +1055,10 @@ Commands:
                                  help="Number of threads to use.Default 1",
                                  default=1)
 
+            running.add_argument('-ic', '--interval_cache', type=int, metavar='',
+                                 help="Memory (MB) of realignment intervals cached by every process. Default: 200",
+                                 default=200)
+
             running.add_argument('-dir', '--directory', metavar='',
                                  help="Working directory, default is the working directory",
                                  default=os.getcwd())
@@ -958,6 +1119,12 @@ Commands:
                                   help="Minimum mapping quality treshold for coverage computation. Default: 0",
                                   default=0)
 
+            optional.add_argument('-di', '--depth_index', help="Store the read depth of the input bam in a run-length "
+                                                               "encoded index next to it, and compute the coverage "
+                                                               "metrics from it. The index is reused by later runs on "
+                                                               "the same bam",
+                                  action='store_true')
+
             optional.add_argument('-E', '--extension', type=int, metavar='',
                                   help="Number of bases inside the eccDNA coordinates to compute the ratio. Default: 100",
                                   default=100)
@@ -974,6 +1141,10 @@ Commands:
                                   help="Minimum number of reads required to output",
                                   default=20)
 
+            optional.add_argument('-t', '--threads', type=int, metavar='',
+                                  help="Number of processes used to compute the coverage metrics. Default 1",
+                                  default=1)
+
 
 
         else:
@@ -1000,6 +1171,12 @@ Commands:
                                   help="Minimum mapping quality treshold for coverage computation. Default: 0",
                                   default=0.6)
 
+            optional.add_argument('-di', '--depth_index', help="Store the read depth of the input bam in a run-length "
+                                                               "encoded index next to it, and compute the coverage "
+                                                               "metrics from it. The index is reused by later runs on "
+                                                               "the same bam",
+                                  action='store_true')
+
             optional.add_argument('-E', '--extension', type=int, metavar='',
                                   help="Number of bases inside the eccDNA coordinates to compute the ratio. Default: 100",
                                   default=100)
@@ -1016,6 +1193,10 @@ Commands:
                                   help="Minimum number of reads required to output",
                                   default=20)
 
+            optional.add_argument('-t', '--threads', type=int, metavar='',
+                                  help="Number of processes used to compute the coverage metrics. Default 1",
+                                  default=1)
+
             parser.print_help()
 
             time.sleep(0.01)
@@ -1159,6 +1340,53 @@ Commands:
 
 
 
+        return (parser)
+
+    def args_index(self):
+
+        parser = self.index
+
+        parser._action_groups.pop()
+        required = parser.add_argument_group('required arguments')
+        optional = parser.add_argument_group('optional arguments')
+
+        if "-fasta" in sys.argv:
+
+            required.add_argument('-fasta', metavar='',
+                                  help="Input: Reference genome fasta file. The index files will be written next to the fasta")
+
+            optional.add_argument('-mm', '--minimizers', help="Also store the minimizers of every contig, used by "
+                                                              "'Circle-Map Realign --lonely_soft_clipped'",
+                                  action='store_true')
+
+            optional.add_argument('-k', '--kmer', type=int, metavar='', choices=range(8, 17),
+                                  help="Length of the minimizer k-mers, at most 16. Default: 16", default=16)
+
+            optional.add_argument('-w', '--window', type=int, metavar='',
+                                  help="Number of consecutive k-mers sampled by every minimizer. Default: 12", default=12)
+
+        else:
+
+            required.add_argument('-fasta', metavar='',
+                                  help="Input: Reference genome fasta file. The index files will be written next to the fasta")
+
+            optional.add_argument('-mm', '--minimizers', help="Also store the minimizers of every contig, used by "
+                                                              "'Circle-Map Realign --lonely_soft_clipped'",
+                                  action='store_true')
+
+            optional.add_argument('-k', '--kmer', type=int, metavar='', choices=range(8, 17),
+                                  help="Length of the minimizer k-mers, at most 16. Default: 16", default=16)
+
+            optional.add_argument('-w', '--window', type=int, metavar='',
+                                  help="Number of consecutive k-mers sampled by every minimizer. Default: 12", default=12)
+
+            parser.print_help()
+
+            time.sleep(0.01)
+            sys.stderr.write("\nNo input input given to Index, be sure that you are providing the flag '-fasta'"
+                             "\nExiting\n")
+            sys.exit(0)
+
         return (parser)
 
 def main():
@@ -0,0 +1,340 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import os
+import zlib
+import json
+import tempfile
+import time
+import datetime
+import numpy as np
+import pysam as ps
+
+# bases per checkpoint of the run table. A query only searches the runs of its block
+DEPTH_BLOCK = 65536
+
+# depth changes buffered before they are turned into runs when the index is built
+FLUSH_EVENTS = 1048576
+
+# reads that count_coverage(read_callback='all') does not count: unmapped, secondary, qc fail and duplicates
+COVERAGE_FILTER = 0x4 | 0x100 | 0x200 | 0x400
+
+ACGT = np.zeros(256, dtype=bool)
+for base in 'ACGT':
+    ACGT[ord(base)] = True
+
+
+def depth_track(quality=None):
+    """Function that takes as input a base quality threshold and returns the name of the depth track. The 'reads' track
+    counts the reads overlapping every position, as bam.count(read_callback='nofilter') does. The 'bases' tracks count
+    the aligned A,C,G,T bases with at least the given quality, as bam.count_coverage does"""
+
+    if quality is None:
+        return('reads')
+    else:
+        return('bases%g' % quality)
+
+
+def depth_files(bam, track, directory=None):
+    """Function that takes as input the coordinate sorted bam, a depth track and the directory holding the index, and
+    returns the name of the depth index files. Without directory, the index is next to the bam. Away from the bam, the
+    names hold a checksum of the path of the bam, so that bams with the same name do not share an index"""
+
+    if directory is None:
+        prefix = "%s.cmd.%s" % (bam, track)
+    else:
+        prefix = "%s/%s.%08x.cmd.%s" % (directory, os.path.basename(bam),
+                                        zlib.crc32(os.path.abspath(bam).encode()), track)
+    return({'starts': "%s.starts.npy" % prefix, 'values': "%s.values.npy" % prefix, 'blocks': "%s.blocks.npy" % prefix,
+            'meta': "%s.json" % prefix})
+
+
+def index_directories(bam, directory=None):
+    """Function that takes as input the coordinate sorted bam and the working directory, and returns where the depth
+    index can be: next to the bam (None), or in the working directory, or the temporary directory without one, for the
+    bams in directories that can not be written"""
+
+    return([None, directory if directory is not None else tempfile.gettempdir()])
+
+
+def bam_signature(bam):
+    """Function that takes as input a bam file and returns its size and modification time. An index built from a
+    different signature is stale"""
+
+    stat = os.stat(bam)
+    return([stat.st_size, int(stat.st_mtime)])
+
+
+def read_events(read, plus, minus):
+    """Function that takes as input an alignment and appends the positions where it starts and stops counting to the
+    read depth, using the span htslib gives it when fetching"""
+
+    start = read.reference_start
+    end = read.reference_end
+    plus.append(start)
+    minus.append(start + 1 if end is None or end <= start else end)
+
+
+def base_events(read, plus, minus, quality):
+    """Function that takes as input an alignment and appends the positions where its aligned bases start and stop
+    counting to the base depth. Only A,C,G,T bases with a quality of at least the threshold are counted"""
+
+    if read.flag & COVERAGE_FILTER or read.cigartuples is None:
+        return
+
+    sequence = read.query_sequence
+    if sequence is None:
+        return
+
+    counted = ACGT[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    qualities = read.query_qualities
+    if quality > 0 and qualities is not None:
+        counted &= np.asarray(qualities) >= quality
+    every_base = counted.all()
+
+    query_position = 0
+    reference_position = read.reference_start
+    for operation, length in read.cigartuples:
+        if operation in (0, 7, 8):
+            if every_base:
+                plus.append(reference_position)
+                minus.append(reference_position + length)
+            else:
+                positions = (reference_position + np.flatnonzero(counted[query_position:query_position + length])).tolist()
+                plus.extend(positions)
+                minus.extend([position + 1 for position in positions])
+            query_position += length
+            reference_position += length
+        elif operation in (1, 4):
+            query_position += length
+        elif operation in (2, 3):
+            reference_position += length
+
+
+def events_to_runs(plus, minus, begin, end, depth):
+    """Function that takes as input the depth changes buffered for a contig, the positions [begin,end) where the depth
+    is final and the depth at begin. It returns the starts and values of the runs of equal depth in [begin,end), the
+    changes after end, and the depth at end"""
+
+    plus = np.array(plus, dtype=np.int64)
+    minus = np.array(minus, dtype=np.int64)
+
+    positions = np.concatenate((plus[plus < end], minus[minus < end]))
+    changes = np.concatenate((np.ones(np.count_nonzero(plus < end), dtype=np.int64),
+                              -np.ones(np.count_nonzero(minus < end), dtype=np.int64)))
+
+    positions, inverse = np.unique(positions, return_inverse=True)
+    changes = np.bincount(inverse, weights=changes, minlength=len(positions)).astype(np.int64)
+    positions = positions[changes != 0]
+    changes = changes[changes != 0]
+
+    values = depth + np.cumsum(changes)
+    starts = positions
+
+    # the first run of the contig starts at 0. Later runs continue the last run of the previous flush
+    if begin == 0 and (len(starts) == 0 or starts[0] > 0):
+        starts = np.concatenate(([0], starts))
+        values = np.concatenate(([depth], values))
+
+    next_depth = int(values[-1]) if len(values) > 0 else depth
+
+    return(starts, values, plus[plus >= end].tolist(), minus[minus >= end].tolist(), next_depth)
+
+
+def build_depth_index(bam, quality=None, directory=None):
+    """Function that takes as input a coordinate sorted bam and writes the depth of every contig as memory mappable
+    runs of equal depth, with a checkpoint into the runs every DEPTH_BLOCK bases. The index is stored next to the bam,
+    or in the working directory if the directory of the bam can not be written, and it is reused until the bam
+    changes"""
+
+    begin = time.time()
+
+    track = depth_track(quality)
+    if os.access(os.path.dirname(os.path.abspath(bam)), os.W_OK):
+        files = depth_files(bam, track)
+    else:
+        files = depth_files(bam, track, index_directories(bam, directory)[1])
+    alignments = ps.AlignmentFile(bam, "rb")
+
+    starts_tmp = "%s.tmp" % files['starts']
+    values_tmp = "%s.tmp" % files['values']
+
+    contigs = {}
+    total = 0
+    with open(starts_tmp, 'wb') as starts_out, open(values_tmp, 'wb') as values_out:
+        for contig, length in zip(alignments.references, alignments.lengths):
+
+            print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"), "Computing the %s depth of %s" % (track, contig))
+
+            first = total
+            plus = []
+            minus = []
+            flushed = 0
+            depth = 0
+
+            for read in alignments.fetch(contig=contig):
+
+                # the depth before the start of the read is final
+                if len(plus) + len(minus) >= FLUSH_EVENTS and read.reference_start > flushed:
+                    starts, values, plus, minus, depth = events_to_runs(plus, minus, flushed, read.reference_start, depth)
+                    starts.astype(np.uint32).tofile(starts_out)
+                    values.astype(np.uint32).tofile(values_out)
+                    total += len(starts)
+                    flushed = read.reference_start
+
+                if quality is None:
+                    read_events(read, plus, minus)
+                else:
+                    base_events(read, plus, minus, quality)
+
+            starts, values, plus, minus, depth = events_to_runs(plus, minus, flushed, length, depth)
+            starts.astype(np.uint32).tofile(starts_out)
+            values.astype(np.uint32).tofile(values_out)
+            total += len(starts)
+
+            contigs[contig] = {'length': length, 'runs': [first, total]}
+
+    alignments.close()
+
+    # checkpoints: the run holding the first base of every block
+    checkpoints = 0
+    for contig in contigs.values():
+        contig['blocks'] = checkpoints
+        checkpoints += contig['length'] // DEPTH_BLOCK + 1
+
+    run_starts = np.memmap(starts_tmp, dtype=np.uint32, mode='r', shape=(total,)) if total > 0 else np.zeros(0, dtype=np.uint32)
+    blocks = np.lib.format.open_memmap(files['blocks'], mode='w+', dtype=np.int64, shape=(checkpoints,))
+    for contig in contigs.values():
+        first, last = contig['runs']
+        block_starts = np.arange(0, contig['length'] + 1, DEPTH_BLOCK, dtype=np.int64)[:contig['length'] // DEPTH_BLOCK + 1]
+        blocks[contig['blocks']:contig['blocks'] + len(block_starts)] = \
+            first + np.searchsorted(run_starts[first:last], block_starts, side='right') - 1
+    blocks.flush()
+    del run_starts, blocks
+
+    for tmp, final in [(starts_tmp, files['starts']), (values_tmp, files['values'])]:
+        runs = np.memmap(tmp, dtype=np.uint32, mode='r', shape=(total,)) if total > 0 else np.zeros(0, dtype=np.uint32)
+        index = np.lib.format.open_memmap(final, mode='w+', dtype=np.uint32, shape=(total,))
+        for start in range(0, total, FLUSH_EVENTS):
+            index[start:start + FLUSH_EVENTS] = runs[start:start + FLUSH_EVENTS]
+        index.flush()
+        del runs, index
+        os.remove(tmp)
+
+    with open(files['meta'], 'w') as meta:
+        json.dump({'bam': os.path.basename(bam), 'signature': bam_signature(bam), 'track': track,
+                   'block_size': DEPTH_BLOCK, 'contigs': contigs}, meta)
+
+    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+          "Stored %s depth runs in %s seconds" % (total, round(time.time() - begin, 2)))
+
+
+class depth_index:
+    """Class for serving the read depth of a coordinate sorted bam from the memory mapped runs of its depth index. The
+    pages of the index are shared by all the processes reading it"""
+
+    def __init__(self, files):
+
+        with open(files['meta']) as meta:
+            meta = json.load(meta)
+
+        self.block_size = meta['block_size']
+        self.contigs = meta['contigs']
+
+        self.starts = np.load(files['starts'], mmap_mode='r')
+        self.values = np.load(files['values'], mmap_mode='r')
+        self.blocks = np.load(files['blocks'], mmap_mode='r')
+
+    def runs(self, chrom, positions):
+        """Function that takes as input a contig and an array of positions within it, and returns the index of the run
+        holding every position"""
+
+        contig = self.contigs[chrom]
+        first, last = contig['runs']
+        block = positions // self.block_size
+        n_blocks = contig['length'] // self.block_size + 1
+
+        # a position is in the runs between the checkpoint of its block and the checkpoint of the next block
+        lower = np.asarray(self.blocks[contig['blocks'] + block])
+        upper = np.where(block + 1 < n_blocks, self.blocks[contig['blocks'] + np.minimum(block + 1, n_blocks - 1)] + 1, last)
+
+        runs = np.empty(len(positions), dtype=np.int64)
+        for i, (position, low, up) in enumerate(zip(positions.tolist(), lower.tolist(), upper.tolist())):
+            runs[i] = low + np.searchsorted(self.starts[low:up], position, side='right') - 1
+        return(runs)
+
+    def depth(self, chrom, positions):
+        """Function that takes as input a contig and an array of positions, and returns the depth at every position.
+        Positions outside of the contig are not in the index, and raise a ValueError"""
+
+        positions = np.asarray(positions, dtype=np.int64)
+        if chrom not in self.contigs:
+            raise ValueError("%s is not in the depth index" % chrom)
+        if len(positions) > 0 and (positions.min() < 0 or positions.max() >= self.contigs[chrom]['length']):
+            raise ValueError("positions out of %s" % chrom)
+
+        return(np.asarray(self.values[self.runs(chrom, positions)], dtype=np.int64))
+
+    def region(self, chrom, start, end):
+        """Function that takes as input a contig and a region, and returns the depth of every base of the region as a
+        numpy array. As in count_coverage, the region is clipped to the end of the contig"""
+
+        stop = min(end, self.contigs[chrom]['length'])
+        coverage = np.zeros(max(stop - start, 0), dtype=np.uint32)
+        if start >= stop:
+            return(coverage)
+
+        first, last = self.runs(chrom, np.array([start, stop - 1], dtype=np.int64))
+        run_starts = np.maximum(np.asarray(self.starts[first:last + 1], dtype=np.int64), start)
+        run_ends = np.append(run_starts[1:], stop)
+        coverage[:] = np.repeat(np.asarray(self.values[first:last + 1]), run_ends - run_starts)
+        return(coverage)
+
+
+def open_depth(bam, quality=None, directory=None):
+    """Function that takes as input a coordinate sorted bam, the base quality of the track and the working directory,
+    and returns its depth index, or None if the bam was not indexed or it changed after the index was built"""
+
+    for location in index_directories(bam, directory):
+
+        files = depth_files(bam, depth_track(quality), location)
+        if not os.path.isfile(files['meta']):
+            continue
+
+        with open(files['meta']) as meta:
+            signature = json.load(meta)['signature']
+
+        if signature == bam_signature(bam):
+            return(depth_index(files))
+
+    return(None)
+
+
+def load_depth(bam, quality=None, directory=None):
+    """Function that takes as input a coordinate sorted bam, the base quality of the track and the working directory,
+    and returns its depth index, building it first if it is missing or stale"""
+
+    index = open_depth(bam, quality, directory)
+    if index is None:
+        build_depth_index(bam, quality, directory)
+        index = open_depth(bam, quality, directory)
+    return(index)
@@ -0,0 +1,96 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import numpy as np
+
+# columns of the split read evidence of a peak: contig id, coordinates, read id, iteration (mate interval) and score
+SPLIT_COLUMNS = [('chrom', np.int32), ('start', np.int32), ('end', np.int32), ('read', np.int32),
+                 ('iteration', np.int32), ('score', np.float32)]
+
+# columns of the discordant read evidence. For merged discordant intervals, read holds the number of reads
+DISCORDANT_COLUMNS = [('chrom', np.int32), ('start', np.int32), ('end', np.int32), ('read', np.int32)]
+
+# columns of the circular intervals of a peak, with the number of split reads and discordant reads supporting them
+CIRCLE_COLUMNS = [('chrom', np.int32), ('start', np.int32), ('end', np.int32), ('read', np.int32),
+                  ('iteration', np.int32), ('score', np.float32), ('discordants', np.int32)]
+
+
+class evidence_buffer:
+    """Class for accumulating realignment evidence in typed columns. Contigs are stored as ids of the contigs list and
+    the columns grow by doubling, so that appending is amortized constant time"""
+
+    def __init__(self, columns, contigs, capacity=256):
+
+        self.contigs = contigs
+        self.names = [name for name, dtype in columns]
+        self.arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in columns}
+        self.capacity = capacity
+        self.size = 0
+
+    def __len__(self):
+
+        return(self.size)
+
+    def __getitem__(self, name):
+
+        return(self.arrays[name][:self.size])
+
+    def reserve(self, size):
+        """Function that grows the columns to hold at least size records"""
+
+        capacity = len(self.arrays[self.names[0]])
+        if size > capacity:
+            capacity = max(size, capacity * 2)
+            for name in self.names:
+                grown = np.empty(capacity, dtype=self.arrays[name].dtype)
+                grown[:self.size] = self.arrays[name][:self.size]
+                self.arrays[name] = grown
+
+    def append(self, *values):
+        """Function that appends a record, with a value for every column"""
+
+        self.reserve(self.size + 1)
+        for name, value in zip(self.names, values):
+            self.arrays[name][self.size] = value
+        self.size += 1
+
+    def extend(self, columns):
+        """Function that takes as input a dictionary with an array for every column and appends its records"""
+
+        n_records = len(columns[self.names[0]])
+        self.reserve(self.size + n_records)
+        for name in self.names:
+            self.arrays[name][self.size:self.size + n_records] = columns[name]
+        self.size += n_records
+
+    def clear(self, shrink=False):
+        """Function that empties the buffer. With shrink, the columns go back to their initial capacity, so that the
+        memory taken by a large peak is released"""
+
+        self.size = 0
+        if shrink and len(self.arrays[self.names[0]]) > self.capacity:
+            self.arrays = {name: np.empty(self.capacity, dtype=array.dtype) for name, array in self.arrays.items()}
+
+    def nbytes(self):
+        """Function that returns the bytes allocated by the columns of the buffer, filled or not"""
+
+        return(sum([array.nbytes for array in self.arrays.values()]))
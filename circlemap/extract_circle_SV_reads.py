@@ -26,12 +26,19 @@ from circlemap.utils import *
 import time
 import sys
 import warnings
+import contextlib
+from circlemap.bgzf import bam_partitions, is_bgzf
+from circlemap.mate_cache import mate_cache, is_complete, plain_secondaries
+
+
+# partitions of the input bam for every extraction process, so that slow partitions do not hold the pool
+PARTITIONS_PER_PROCESS = 4
 
 
 class readExtractor:
     """Class for managing the read extracting part of circle map"""
     def __init__(self,sorted_bam,output_bam,working_dir,mapq_cutoff,extract_discordant,extract_soft_clipped,extract_hard_clipped,
-                 verbose,parser
+                 verbose,parser,threads=1,processes=1,max_memory=1000
                  ):
         #input-output
         self.sorted_bam = sorted_bam
@@ -50,27 +57,63 @@ class readExtractor:
 
         #verbose level
         self.verbose = int(verbose)
+        #BGZF (de)compression threads of htslib for the input and the output bam
+        self.threads = threads
+        #processes extracting partitions of the input bam
+        self.processes = processes
+        #memory (MB) of reads waiting for their mates kept by every process when the input bam is coordinate sorted
+        self.max_memory = max_memory * 1024 * 1024
         #parser options
         self.parser = parser
+        #secondary alignments without SA tag of every read name of a coordinate sorted bam
+        self.secondaries = None
+
+    def bam_path(self,bam):
+        """Function that takes as input the name of the input or output bam and returns its path. '-' is stdin or
+        stdout"""
+
+        if bam == '-':
+            return(bam)
+        return(self.working_dir + "/" + bam)
 
     def extract_sv_circleReads(self):
 
         """Function that extracts Structural Variant reads that indicate circular DNA,
         The programme with extract soft-clipped reads and R2F1 (<- ->) oriented reads"""
 
+        if self.output_bam == '-':
+            # stdout carries the output bam, so the messages go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                return(self.extract_reads())
+
+        return(self.extract_reads())
+
+    def extract_reads(self):
+        """Function that reads the queryname sorted or grouped alignments from the input bam, or from a SAM or BAM
+        stream on stdin, and writes the ones indicating circular DNA to the output bam"""
+
         os.chdir(self.working_dir)
 
-        #input
-        raw_bam = ps.AlignmentFile(self.working_dir + "/" + self.sorted_bam, "rb")
+        #input. The format of stdin is detected by htslib, so it can be the SAM output of the aligner
+        if self.sorted_bam == '-':
+            raw_bam = ps.AlignmentFile(self.sorted_bam, "r", threads=self.threads)
+        else:
+            raw_bam = ps.AlignmentFile(self.bam_path(self.sorted_bam), "rb", threads=self.threads)
 
-        #HD the tag for the header line. SO indicates sorting order of the alignements
+        #HD the tag for the header line. SO indicates sorting order of the alignements. GO:query is the order of
+        #aligners that group the alignments of every read name, as queryname sorting does
+        coordinate_sorted = False
         if 'HD' in raw_bam.header:
 
-            if raw_bam.header['HD']['SO'] != 'queryname':
+            if raw_bam.header['HD'].get('SO') == 'coordinate':
+                #the mates are matched by read name while reading the bam, so it does not need to be sorted by queryname
+                coordinate_sorted = True
+
+            elif raw_bam.header['HD'].get('SO') != 'queryname' and raw_bam.header['HD'].get('GO') != 'query':
                 sys.stderr.write(
-                    "The input bam header says that bam is not sorted by queryname. It is sorted by %s\n\n" % (raw_bam.header['HD']['SO']))
+                    "The input bam header says that bam is not sorted by queryname. It is sorted by %s\n\n" % (raw_bam.header['HD'].get('SO')))
                 sys.stderr.write(
-                    "Sort your bam file queryname with the following command:\n\n\tsamtools sort -n -o output.bam input.bam")
+                    "Sort your bam file queryname with the following command, or by coordinate:\n\n\tsamtools sort -n -o output.bam input.bam")
 
                 time.sleep(0.01)
 
@@ -85,41 +128,81 @@ class readExtractor:
 
 
 
-        circle_sv_reads = ps.AlignmentFile(self.working_dir + "/" + self.output_bam , "wb", template=raw_bam)
-
-
-        #modify the tag to unsorted
-        if 'HD' in raw_bam.header == True:
-            circle_sv_reads.header['HD']['SO'] = 'unsorted'
-
         if self.verbose >=3:
             print("Extracting circular structural variants")
 
         #timing
         begin = time.time()
 
+        input_bam = self.bam_path(self.sorted_bam)
+        partitions = []
+        # a stream cannot be partitioned
+        if coordinate_sorted == False and self.processes > 1 and input_bam != '-' and is_bgzf(input_bam):
+            partitions = bam_partitions(input_bam, self.processes * PARTITIONS_PER_PROCESS)
+
+        if coordinate_sorted:
+
+            processed_reads = self.coordinate_extraction(raw_bam, begin)
+
+        elif len(partitions) > 1:
+
+            raw_bam.close()
+            processed_reads = self.parallel_extraction(partitions)
+
+        else:
+
+            circle_sv_reads = ps.AlignmentFile(self.bam_path(self.output_bam), "wb", template=raw_bam,
+                                               threads=self.threads)
+
+
+            #modify the tag to unsorted
+            if 'HD' in raw_bam.header == True:
+                circle_sv_reads.header['HD']['SO'] = 'unsorted'
+
+            processed_reads = self.classify_reads(raw_bam, circle_sv_reads, begin)
+
+            circle_sv_reads.close()
+
+        end = time.time()
+
+
+
+        if self.verbose >=3:
+
+
+            print("finished extracting reads. Elapsed time:", (end - begin) / 60, "mins")
+
+            print("Throughput: %s reads/s using %s processes with %s BGZF threads" %
+                  (round(processed_reads / max(end - begin, 1e-9)), self.processes, self.threads))
+
+            print("Thanks for using Circle-Map")
+
+    def classify_reads(self,reads,circle_sv_reads,begin,progress=True):
+        """Function that takes as input queryname sorted reads and writes the ones indicating circular DNA to the output
+        bam. It returns the number of reads processed"""
 
         #cache read1. operate in read2. this speed-ups the search
-        read1 = ''
+        read1 = None
 
         #counter for processed reads
         processed_reads = 0
 
-        for read in raw_bam:
+        for read in reads:
 
-            if self.verbose >=3:
-                processed_reads +=1
+            processed_reads +=1
 
+            if self.verbose >=3 and progress:
 
                 if (processed_reads/1000000).is_integer() == True:
                     partial_timer = time.time()
                     partial_time = (partial_timer - begin)/60
-                    print("Processed %s reads in %s mins" % (processed_reads,round(partial_time,3)))
+                    print("Processed %s reads in %s mins (%s reads/s)" % (processed_reads,round(partial_time,3),
+                                                                           round(processed_reads/(partial_time*60))))
 
             if read.is_read1:
                 read1 = read
             else:
-                if read.is_read2 and read.qname == read1.qname:
+                if read.is_read2 and read1 is not None and read.qname == read1.qname:
                     # both reads in memory
                     read2 = read
 
@@ -210,16 +293,312 @@ class readExtractor:
                     # reads are not queryname sorted and cannot be processed in paired mode
                     warnings.warn("Unpaired reads found. Is your bam file queryname sorted?")
 
+        return(processed_reads)
 
-        end = time.time()
+    def parallel_extraction(self,starts):
+        """Function that takes as input the virtual offsets where the partitions of the input bam start, and extracts the
+        reads of every partition in a process pool. The shards of the partitions are concatenated in order, so the
+        output is the same as the one of the serial extraction"""
+
+        import multiprocessing as mp
+
+        partitions = [(index, start, starts[index + 1] if index + 1 < len(starts) else None)
+                      for index, start in enumerate(starts)]
+        shards = [extraction_shard(self.working_dir, self.output_bam, index) for index in range(len(partitions))]
+
+        if self.verbose >=3:
+            print("Extracting from %s partitions of the input bam using %s processes" % (len(partitions), self.processes))
+
+        pool = mp.Pool(processes=min(self.processes, len(partitions)), initializer=open_extractor,
+                       initargs=(self.sorted_bam, self.output_bam, self.working_dir, self.mapq_cutoff,
+                                 self.no_discordants, self.no_soft_clipped, self.no_hard_clipped, self.verbose,
+                                 self.threads))
+
+        processed_reads = sum(pool.imap(extract_partition, partitions))
+
+        pool.close()
+        pool.join()
+
+        self.join_shards(shards)
+
+        return(processed_reads)
+
+    def coordinate_extraction(self,raw_bam,begin):
+        """Function that takes as input the opened coordinate sorted bam and extracts its reads indicating circular DNA.
+        The alignments of every read name are held in a mate cache until all of them have been read, and are then
+        classified in the order of a queryname sorted bam. With more than one process and an indexed bam, every contig
+        is extracted by its own process, and the read names with alignments in other contigs are matched at the end. It
+        returns the number of reads processed"""
+
+        # no SA tag lists the secondary alignments without SA tag, so they are counted before the mates are matched. A
+        # stream is only read once
+        if self.sorted_bam != '-':
+            self.secondaries = plain_secondaries(self.bam_path(self.sorted_bam),
+                                                 mate_spill(self.working_dir, self.output_bam, 'secondaries'),
+                                                 self.threads)
+        elif self.verbose >=2:
+            warnings.warn("WARNING:The secondary alignments without SA tag of a stream can not be counted in advance. "
+                          "The ones found after the other alignments of their read name are classified on their own")
+
+        if self.sorted_bam == '-' or self.processes <= 1 or raw_bam.has_index() == False:
+
+            if self.verbose >=3:
+                print("The input bam is coordinate sorted. Matching the mates of every read name")
+
+            circle_sv_reads = ps.AlignmentFile(self.bam_path(self.output_bam), "wb", template=raw_bam,
+                                               threads=self.threads)
+
+            cache = mate_cache(raw_bam.header, mate_spill(self.working_dir, self.output_bam, 'all'), self.max_memory,
+                               self.secondaries)
+            processed_reads = self.classify_reads(matched_reads(raw_bam, cache), circle_sv_reads, begin)
+
+            circle_sv_reads.close()
+            raw_bam.close()
+
+            spills = cache.spills
+
+        else:
+
+            import multiprocessing as mp
+
+            contigs = [raw_bam.get_tid(stats.contig) for stats in raw_bam.get_index_statistics() if stats.total > 0]
+
+            if self.verbose >=3:
+                print("The input bam is coordinate sorted. Matching the mates of every read name in %s contigs using "
+                      "%s processes" % (len(contigs), self.processes))
+
+            pool = mp.Pool(processes=max(1, min(self.processes, len(contigs))), initializer=open_extractor,
+                           initargs=(self.sorted_bam, self.output_bam, self.working_dir, self.mapq_cutoff,
+                                     self.no_discordants, self.no_soft_clipped, self.no_hard_clipped, self.verbose,
+                                     self.threads, self.max_memory // (1024 * 1024), self.secondaries))
+
+            processed_reads = 0
+            spills = 0
+            for contig_reads, contig_spills in pool.imap(extract_contig, contigs):
+                processed_reads += contig_reads
+                spills += contig_spills
 
-        circle_sv_reads.close()
+            pool.close()
+            pool.join()
 
+            # the read names with alignments in more than one contig, or with a mate without coordinate
+            shards = [extraction_shard(self.working_dir, self.output_bam, contig) for contig in contigs]
+            shards.append(extraction_shard(self.working_dir, self.output_bam, 'crossing'))
 
+            circle_sv_reads = ps.AlignmentFile(shards[-1], "wb", template=raw_bam, threads=self.threads)
+
+            cache = mate_cache(raw_bam.header, mate_spill(self.working_dir, self.output_bam, 'crossing'),
+                               self.max_memory, self.secondaries)
+            processed_reads += self.classify_reads(matched_reads(crossing_reads(raw_bam, contigs, self.working_dir,
+                                                                                self.output_bam), cache),
+                                                   circle_sv_reads, begin, progress=False)
+
+            circle_sv_reads.close()
+            raw_bam.close()
+
+            spills += cache.spills
+
+            self.join_shards(shards)
 
         if self.verbose >=3:
+            print("Mate cache spilled to disk %s times" % spills)
 
+        return(processed_reads)
 
-            print("finished extracting reads. Elapsed time:", (end - begin) / 60, "mins")
+    def join_shards(self,shards):
+        """Function that concatenates the output shards of the extraction processes, in order, into the output bam and
+        removes them"""
+
+        # pysam captures the stdout of samtools, so the shards are written to the stdout of the process by name
+        output = "/dev/stdout" if self.output_bam == '-' else self.bam_path(self.output_bam)
+        ps.cat("--no-PG", "-o", output, *shards)
+        for shard in shards:
+            os.remove(shard)
+
+
+#extractor of every process of the extraction pool
+worker_extractor = {}
+
+
+def open_extractor(sorted_bam,output_bam,working_dir,mapq_cutoff,extract_discordant,extract_soft_clipped,
+                   extract_hard_clipped,verbose,threads,max_memory=1000,secondaries=None):
+    """Function that creates the read extractor once for every process. It is used as the initializer of the extraction
+    pool"""
+
+    worker_extractor['extractor'] = readExtractor(sorted_bam, output_bam, working_dir, mapq_cutoff, extract_discordant,
+                                                  extract_soft_clipped, extract_hard_clipped, verbose, None, threads, 1,
+                                                  max_memory)
+    worker_extractor['extractor'].secondaries = secondaries
+
+
+def extraction_shard(working_dir,output_bam,index):
+    """Function that returns the name of the output shard of a partition of the input bam"""
+
+    return("%s/%s.part%s" % (working_dir, "stdout" if output_bam == '-' else output_bam, index))
+
+
+def partition_reads(bam,start,end,resync):
+    """Function that takes as input a queryname sorted bam, the virtual offset where a partition starts and the one where
+    the next partition starts, and yields the reads of the read name groups of the partition. The group holding the
+    first record of a partition belongs to the previous partition, so a partition resyncs at the first complete group
+    after its start, and finishes the group holding the first record of the next partition"""
+
+    bam.seek(start)
+
+    group = None
+    skipping = False
+
+    while True:
+
+        position = bam.tell()
+        try:
+            read = next(bam)
+        except StopIteration:
+            return
+
+        if read.query_name != group:
+            if group is None and resync:
+                skipping = True
+            else:
+                skipping = False
+                if end is not None and position > end:
+                    return
+            group = read.query_name
+
+        if not skipping:
+            yield read
+
+
+def extract_partition(partition):
+    """Function that takes as input the index of a partition of the input bam and the virtual offsets where it and the
+    next partition start, and writes its reads indicating circular DNA to the shard of the partition. It returns the
+    number of reads processed"""
+
+    extractor = worker_extractor['extractor']
+    index, start, end = partition
+
+    raw_bam = ps.AlignmentFile(extractor.bam_path(extractor.sorted_bam), "rb", threads=extractor.threads)
+    shard = ps.AlignmentFile(extraction_shard(extractor.working_dir, extractor.output_bam, index), "wb",
+                             template=raw_bam, threads=extractor.threads)
+
+    processed_reads = extractor.classify_reads(partition_reads(raw_bam, start, end, index > 0), shard, time.time(),
+                                               progress=False)
+
+    shard.close()
+    raw_bam.close()
+
+    return(processed_reads)
+
+
+def mate_spill(working_dir,output_bam,name):
+    """Function that returns the prefix of the spill files of a mate cache"""
+
+    return("%s/%s.mates.%s" % (working_dir, "stdout" if output_bam == '-' else output_bam, name))
+
+
+def crossing_shard(working_dir,output_bam,contig):
+    """Function that returns the name of the shard holding the alignments of a contig whose read names have alignments
+    in other contigs"""
+
+    return("%s/%s.crossing%s" % (working_dir, "stdout" if output_bam == '-' else output_bam, contig))
+
+
+def on_contig(read,contig,contig_name):
+    """Function that takes as input an alignment of a contig and returns True if its mate and the alignments listed in
+    its SA tag are in the same contig"""
+
+    if read.is_paired and read.next_reference_id != contig:
+        return(False)
+
+    if read.has_tag('SA'):
+        for alignment in read.get_tag('SA').split(';'):
+            if alignment != '' and alignment.split(',')[0] != contig_name:
+                return(False)
+
+    return(True)
+
+
+def matched_reads(reads,cache):
+    """Function that takes as input coordinate sorted alignments and a mate cache, and yields the alignments of every
+    read name in queryname order once all of them have been added to the cache. The read names left in the cache at
+    the end, with mates missing from the bam, are yielded last"""
+
+    for read in reads:
+        matched = cache.add(read)
+        if matched is not None:
+            for mate in matched:
+                yield mate
+
+    for matched in cache.pending():
+        for mate in matched:
+            yield mate
+
+
+def crossing_reads(bam,contigs,working_dir,output_bam):
+    """Function that yields the alignments written to the crossing shards of the contigs, in contig order, followed by
+    the alignments without coordinate whose mate is mapped. The crossing shards are removed once read"""
+
+    for contig in contigs:
+        shard_name = crossing_shard(working_dir, output_bam, contig)
+        with ps.AlignmentFile(shard_name, "rb", check_sq=False) as shard:
+            for read in shard:
+                yield read
+        os.remove(shard_name)
+
+    # pairs without coordinate are both unmapped, and indicate nothing
+    for read in bam.fetch('*'):
+        if read.is_paired and read.mate_is_unmapped == False:
+            yield read
+
+
+def contig_reads(bam,contig,contig_name,cache,crossing):
+    """Function that takes as input the coordinate sorted bam, a contig, a mate cache and the crossing shard of the
+    contig, and yields the alignments of the read names whose alignments are all in the contig, in queryname order. The
+    alignments of the other read names are written to the crossing shard"""
+
+    for read in bam.fetch(contig_name):
+        if on_contig(read, contig, contig_name):
+            matched = cache.add(read)
+            if matched is not None:
+                for mate in matched:
+                    yield mate
+        else:
+            crossing.write(read)
+
+    # the names spilled to disk can be complete, the others have alignments in other contigs
+    for matched in cache.pending():
+        if is_complete(matched, cache.secondaries):
+            for mate in matched:
+                yield mate
+        else:
+            for mate in matched:
+                crossing.write(mate)
+
+
+def extract_contig(contig):
+    """Function that takes as input the index of a contig of the coordinate sorted bam, and writes the reads indicating
+    circular DNA of the read names whose alignments are all in the contig to the shard of the contig. The alignments of
+    the other read names are written to the crossing shard of the contig. It returns the number of reads processed and
+    the times the mate cache spilled to disk"""
+
+    extractor = worker_extractor['extractor']
+
+    raw_bam = ps.AlignmentFile(extractor.bam_path(extractor.sorted_bam), "rb", threads=extractor.threads)
+    contig_name = raw_bam.get_reference_name(contig)
+
+    shard = ps.AlignmentFile(extraction_shard(extractor.working_dir, extractor.output_bam, contig), "wb",
+                             template=raw_bam, threads=extractor.threads)
+    crossing = ps.AlignmentFile(crossing_shard(extractor.working_dir, extractor.output_bam, contig), "wbu",
+                                template=raw_bam)
+
+    cache = mate_cache(raw_bam.header, mate_spill(extractor.working_dir, extractor.output_bam, contig),
+                       extractor.max_memory, extractor.secondaries)
+
+    processed_reads = extractor.classify_reads(contig_reads(raw_bam, contig, contig_name, cache, crossing), shard,
+                                               time.time(), progress=False)
+
+    crossing.close()
+    shard.close()
+    raw_bam.close()
 
-            print("Thanks for using Circle-Map")
\ No newline at end of file
+    return(processed_reads, cache.spills)
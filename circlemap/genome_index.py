@@ -0,0 +1,591 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import os
+import json
+import time
+import datetime
+import numpy as np
+import pysam as ps
+from collections import OrderedDict
+from Bio.Seq import Seq
+from circlemap.lazy import jit
+from circlemap.utils import background_freqs
+
+# bases per checkpoint of the base composition tables
+BLOCK_SIZE = 1024
+
+# the reference is read in pieces of this size when the index is built
+BUILD_CHUNK = 1048576
+
+# 2-bit codes. Anything that is not A, C, G or T is stored as A and masked as N
+CODES = np.full(256, 0, dtype=np.uint8)
+ACGT = np.zeros(256, dtype=bool)
+for code, base in enumerate('ACGT'):
+    CODES[ord(base)] = code
+    CODES[ord(base.lower())] = code
+    ACGT[ord(base)] = True
+    ACGT[ord(base.lower())] = True
+
+# every packed byte holds 4 bases, from the most significant bits to the least significant ones
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+UNPACK = ((np.arange(256, dtype=np.uint8)[:, None] >> SHIFTS) & 3).astype(np.uint8)
+
+PLUS_ASCII = np.frombuffer(b'ACGTN', dtype=np.uint8)
+MINUS_ASCII = np.frombuffer(b'TGCAN', dtype=np.uint8)
+
+# k-mer length and window of the minimizers of the seed index. k-mers are hashed into 32 bits, so k is at most 16
+MINIMIZER_K = 16
+MINIMIZER_W = 12
+
+# minimizers found more often than this in a contig come from repeats, and are not used as seeds
+MAX_OCCURRENCES = 256
+
+# hash of the k-mers with ambiguous bases, bigger than any 32 bit hash
+NO_HASH = 1 << 40
+
+
+def index_files(fasta):
+    """Function that takes as input the reference fasta and returns the name of the Circle-Map index files"""
+
+    return({'seq': "%s.cmi.seq.npy" % fasta, 'counts': "%s.cmi.counts.npy" % fasta, 'meta': "%s.cmi.json" % fasta,
+            'minimizer_hashes': "%s.cmi.mm.hashes.npy" % fasta, 'minimizer_positions': "%s.cmi.mm.positions.npy" % fasta,
+            'minimizer_meta': "%s.cmi.mm.json" % fasta})
+
+
+def fasta_signature(fasta):
+    """Function that takes as input the reference fasta and returns its size, modification time and contig lengths. An
+    index built from a different signature is stale"""
+
+    stat = os.stat(fasta)
+    with ps.FastaFile(fasta) as genome_fa:
+        lengths = [[contig, length] for contig, length in zip(genome_fa.references, genome_fa.lengths)]
+    return([stat.st_size, int(stat.st_mtime), lengths])
+
+
+def index_is_current(fasta, meta):
+    """Function that takes as input the reference fasta and an index metadata file, and returns whether the index
+    exists and was built from the current fasta"""
+
+    if not os.path.isfile(meta):
+        return(False)
+
+    with open(meta) as handle:
+        signature = json.load(handle).get('signature')
+
+    return(signature == fasta_signature(fasta))
+
+
+def build_index(fasta):
+    """Function that takes as input a fasta file and packs it into a 2-bit memory mappable index. The index stores the
+    positions of the N bases and the cumulative A,C,G,T counts every BLOCK_SIZE bases"""
+
+    begin = time.time()
+
+    files = index_files(fasta)
+    signature = fasta_signature(fasta)
+    genome_fa = ps.FastaFile(fasta)
+
+    contigs = []
+    packed_size = 0
+    checkpoints = 0
+    for contig, length in zip(genome_fa.references, genome_fa.lengths):
+        # every contig starts on a new byte
+        contigs.append({'name': contig, 'length': length, 'offset': packed_size, 'counts': checkpoints,
+                        'n_starts': [], 'n_ends': []})
+        packed_size += (length + 3) // 4
+        checkpoints += length // BLOCK_SIZE + 1
+
+    packed = np.lib.format.open_memmap(files['seq'], mode='w+', dtype=np.uint8, shape=(packed_size,))
+    counts = np.lib.format.open_memmap(files['counts'], mode='w+', dtype=np.int64, shape=(checkpoints, 4))
+
+    for contig in contigs:
+
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"), "Indexing %s" % contig['name'])
+
+        total = np.zeros(4, dtype=np.int64)
+        counts[contig['counts']] = total
+        in_n = False
+        # BUILD_CHUNK is a multiple of 4 and BLOCK_SIZE, so pieces start on a new byte and on a new block
+        for start in range(0, contig['length'], BUILD_CHUNK):
+
+            end = min(start + BUILD_CHUNK, contig['length'])
+            seq = np.frombuffer(genome_fa.fetch(contig['name'], start, end).encode(), dtype=np.uint8)
+
+            codes = CODES[seq]
+            is_acgt = ACGT[seq]
+
+            # N runs
+            changes = np.flatnonzero(np.diff(np.concatenate(([in_n], ~is_acgt))))
+            for change in changes:
+                if in_n:
+                    contig['n_ends'].append(start + int(change))
+                else:
+                    contig['n_starts'].append(start + int(change))
+                in_n = not in_n
+
+            # cumulative base counts at the end of every block of the piece
+            one_hot = np.zeros((len(seq), 4), dtype=np.int64)
+            one_hot[np.flatnonzero(is_acgt), codes[is_acgt]] = 1
+            block_ends = np.arange(BLOCK_SIZE, len(seq) + 1, BLOCK_SIZE)
+            cumulative = np.cumsum(one_hot, axis=0)
+            first_block = contig['counts'] + start // BLOCK_SIZE + 1
+            counts[first_block:first_block + len(block_ends)] = total + cumulative[block_ends - 1]
+            total = total + cumulative[-1]
+
+            # pack 4 bases per byte
+            padded = np.zeros(((len(codes) + 3) // 4) * 4, dtype=np.uint8)
+            padded[:len(codes)] = codes
+            padded = padded.reshape(-1, 4) << SHIFTS
+            packed[contig['offset'] + start // 4:contig['offset'] + (start + len(padded) * 4) // 4] = \
+                padded[:, 0] | padded[:, 1] | padded[:, 2] | padded[:, 3]
+
+        if in_n:
+            contig['n_ends'].append(contig['length'])
+
+    packed.flush()
+    counts.flush()
+    genome_fa.close()
+
+    with open(files['meta'], 'w') as meta:
+        json.dump({'fasta': os.path.basename(fasta), 'signature': signature, 'block_size': BLOCK_SIZE,
+                   'contigs': contigs}, meta)
+
+    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+          "Indexed %s contigs in %s seconds" % (len(contigs), round(time.time() - begin, 2)))
+
+
+@jit(nopython=True, cache=True)
+def kmer_hash(code):
+    """Invertible 32 bit hash of a k-mer code, so that the minimizers are not biased towards poly-A k-mers"""
+
+    code = ((code >> 16) ^ code) * 0x45d9f3b & 0xFFFFFFFF
+    code = ((code >> 16) ^ code) * 0x45d9f3b & 0xFFFFFFFF
+    return((code >> 16) ^ code)
+
+
+@jit(nopython=True, cache=True)
+def minimizers(codes, k, w):
+    """Function that takes as input a sequence as 2-bit codes (4 for the N bases), the k-mer length and the window, and
+    returns the hashes and the positions of the (w,k)-minimizers of the sequence. The leftmost smallest hash of every
+    window of w consecutive k-mers is selected. Sequences shorter than a window use all their k-mers as one window"""
+
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    mask = (1 << (2 * k)) - 1
+    hashes = np.empty(n_kmers, dtype=np.int64)
+    code = 0
+    last_n = -1
+    for i in range(len(codes)):
+        if codes[i] > 3:
+            last_n = i
+            code = (code << 2) & mask
+        else:
+            code = ((code << 2) | codes[i]) & mask
+        if i >= k - 1:
+            if last_n > i - k:
+                hashes[i - k + 1] = NO_HASH
+            else:
+                hashes[i - k + 1] = kmer_hash(code)
+
+    w = min(w, n_kmers)
+    minimizer_hashes = np.empty(n_kmers, dtype=np.int64)
+    minimizer_positions = np.empty(n_kmers, dtype=np.int64)
+    found = 0
+    best = -1
+    for end in range(w - 1, n_kmers):
+        first = end - w + 1
+        if best < first:
+            # the minimizer left the window
+            best = first
+            for j in range(first + 1, end + 1):
+                if hashes[j] < hashes[best]:
+                    best = j
+        elif hashes[end] < hashes[best]:
+            best = end
+
+        if hashes[best] != NO_HASH and (found == 0 or minimizer_positions[found - 1] != best):
+            minimizer_hashes[found] = hashes[best]
+            minimizer_positions[found] = best
+            found += 1
+
+    return(minimizer_hashes[:found], minimizer_positions[:found])
+
+
+def warm_up_minimizers():
+    """Function that compiles the minimizer kernels, or loads them from the numba cache on disk, before the pool forks.
+    It returns the seconds it took"""
+
+    begin = time.time()
+    minimizers(np.zeros(MINIMIZER_K, dtype=np.uint8), MINIMIZER_K, 1)
+    return(time.time() - begin)
+
+
+def sequence_codes(sequence):
+    """Function that takes as input a sequence as an array of characters and returns its 2-bit codes, using 4 for
+    anything that is not A, C, G or T"""
+
+    return(np.where(ACGT[sequence], CODES[sequence], 4).astype(np.uint8))
+
+
+def build_minimizer_index(fasta, k=MINIMIZER_K, w=MINIMIZER_W):
+    """Function that takes as input a fasta file indexed with build_index and writes the minimizers of every contig,
+    sorted by hash, into memory mappable arrays. They are the seed index used to find the realignment intervals of the
+    soft-clipped reads whose only prior is the whole contig"""
+
+    begin = time.time()
+
+    files = index_files(fasta)
+    signature = fasta_signature(fasta)
+    reference = genome_index(fasta)
+
+    # the minimizers of every contig are appended to temporary files, and copied to the index once the size is known
+    hashes_tmp = "%s.tmp" % files['minimizer_hashes']
+    positions_tmp = "%s.tmp" % files['minimizer_positions']
+
+    contigs = {}
+    total = 0
+    with open(hashes_tmp, 'wb') as hashes_out, open(positions_tmp, 'wb') as positions_out:
+        for name, contig in reference.contigs.items():
+
+            print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"), "Computing the minimizers of %s" % name)
+
+            contig_hashes = []
+            contig_positions = []
+            # the pieces overlap so that every window starting in a piece is complete
+            for start in range(0, contig['length'], BUILD_CHUNK):
+                end = min(start + BUILD_CHUNK + k + w - 2, contig['length'])
+                piece_hashes, piece_positions = minimizers(reference.decode(contig, start, end), k, w)
+                contig_hashes.append(piece_hashes.astype(np.uint32))
+                contig_positions.append((piece_positions + start).astype(np.uint32))
+
+            contig_hashes = np.concatenate(contig_hashes) if len(contig_hashes) > 0 else np.zeros(0, dtype=np.uint32)
+            contig_positions = np.concatenate(contig_positions) if len(contig_positions) > 0 else np.zeros(0, dtype=np.uint32)
+
+            # consecutive pieces can select the same minimizer
+            unique = np.concatenate(([True], np.diff(contig_positions.astype(np.int64)) != 0)) if len(contig_positions) > 0 \
+                else np.zeros(0, dtype=bool)
+            contig_hashes = contig_hashes[unique]
+            contig_positions = contig_positions[unique]
+
+            order = np.argsort(contig_hashes, kind='stable')
+            contig_hashes[order].tofile(hashes_out)
+            contig_positions[order].tofile(positions_out)
+
+            contigs[name] = [total, total + len(order)]
+            total += len(order)
+
+    for tmp, final in [(hashes_tmp, files['minimizer_hashes']), (positions_tmp, files['minimizer_positions'])]:
+        values = np.memmap(tmp, dtype=np.uint32, mode='r', shape=(total,)) if total > 0 else np.zeros(0, dtype=np.uint32)
+        index = np.lib.format.open_memmap(final, mode='w+', dtype=np.uint32, shape=(total,))
+        for start in range(0, total, BUILD_CHUNK):
+            index[start:start + BUILD_CHUNK] = values[start:start + BUILD_CHUNK]
+        index.flush()
+        del values, index
+        os.remove(tmp)
+
+    with open(files['minimizer_meta'], 'w') as meta:
+        json.dump({'fasta': os.path.basename(fasta), 'signature': signature, 'k': k, 'w': w, 'contigs': contigs}, meta)
+
+    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+          "Stored %s minimizers in %s seconds" % (total, round(time.time() - begin, 2)))
+
+
+class genome_index:
+    """Class for serving realignment intervals from the memory mapped 2-bit index. The pages of the index are shared by
+    all the processes reading it"""
+
+    def __init__(self, fasta):
+
+        files = index_files(fasta)
+
+        with open(files['meta']) as meta:
+            meta = json.load(meta)
+
+        self.block_size = meta['block_size']
+        self.contigs = {}
+        for contig in meta['contigs']:
+            contig['n_starts'] = np.array(contig['n_starts'], dtype=np.int64)
+            contig['n_ends'] = np.array(contig['n_ends'], dtype=np.int64)
+            self.contigs[contig['name']] = contig
+
+        self.packed = np.load(files['seq'], mmap_mode='r')
+        self.counts = np.load(files['counts'], mmap_mode='r')
+
+    def decode(self, contig, start, end):
+        """Function that takes as input a contig and an interval and returns the 2-bit codes of the interval, using 4
+        for the N bases"""
+
+        first = contig['offset'] + start // 4
+        last = contig['offset'] + (end + 3) // 4
+        codes = UNPACK[self.packed[first:last]].reshape(-1)[start % 4:start % 4 + end - start]
+
+        # mask the N runs overlapping the interval
+        runs = slice(np.searchsorted(contig['n_ends'], start, side='right'),
+                     np.searchsorted(contig['n_starts'], end, side='left'))
+        for n_start, n_end in zip(contig['n_starts'][runs], contig['n_ends'][runs]):
+            codes[max(n_start, start) - start:min(n_end, end) - start] = 4
+
+        return(codes)
+
+    def base_counts(self, contig, start, end):
+        """Function that takes as input a contig and an interval and returns the A,C,G,T counts of the interval from
+        the block checkpoints, decoding at most one block on every side"""
+
+        return(self.prefix_counts(contig, end) - self.prefix_counts(contig, start))
+
+    def prefix_counts(self, contig, position):
+        """Function that returns the A,C,G,T counts of the contig before position"""
+
+        block = position // self.block_size
+        counts = np.array(self.counts[contig['counts'] + block], dtype=np.int64)
+
+        if position > block * self.block_size:
+            counts += np.bincount(self.decode(contig, block * self.block_size, position), minlength=5)[:4]
+
+        return(counts)
+
+    def interval(self, chrom, start, end):
+        """Function that takes as input an interval, with the same coordinates as pysam FastaFile.fetch, and returns the
+        plus and the minus (complement) strand sequences as arrays of characters, decoded from the packed bytes, and
+        their A,T,C,G and T,A,G,C background frequencies"""
+
+        contig = self.contigs[chrom]
+
+        if start < 0:
+            raise ValueError("start out of range (%s)" % start)
+        if start > end:
+            raise ValueError("invalid coordinates: start (%s) > stop (%s)" % (start, end))
+
+        end = min(end, contig['length'])
+        start = min(start, end)
+        length = end - start
+
+        codes = self.decode(contig, start, end)
+        plus = PLUS_ASCII[codes]
+        minus = MINUS_ASCII[codes]
+
+        a, c, g, t = [int(count) for count in self.base_counts(contig, start, end)]
+
+        plus_base_freqs = np.array([a / length, t / length, c / length, g / length])
+        minus_base_freqs = np.array([t / length, a / length, g / length, c / length])
+
+        return(plus, minus, plus_base_freqs, minus_base_freqs)
+
+    def close(self):
+        pass
+
+
+class fasta_reference:
+    """Class for serving realignment intervals from the fasta file, when the reference is not indexed"""
+
+    def __init__(self, fasta):
+
+        self.genome_fa = ps.FastaFile(fasta)
+
+    def interval(self, chrom, start, end):
+        """Function that takes as input an interval and returns the plus and the minus (complement) strand sequences as
+        arrays of characters and their A,T,C,G and T,A,G,C background frequencies"""
+
+        plus_coding_interval = self.genome_fa.fetch(str(chrom), start, end).upper()
+        minus_coding_interval = str(Seq(plus_coding_interval).complement())
+
+        # precompute the denominators of the error model. They will be constants for every interval
+        plus_base_freqs = background_freqs(plus_coding_interval)
+
+        minus_base_freqs = np.array([plus_base_freqs['T'], plus_base_freqs['A'], plus_base_freqs['G'], plus_base_freqs['C']])
+        plus_base_freqs = np.array([plus_base_freqs['A'], plus_base_freqs['T'], plus_base_freqs['C'], plus_base_freqs['G']])
+
+        return(np.frombuffer(plus_coding_interval.encode(), dtype=np.uint8),
+               np.frombuffer(minus_coding_interval.encode(), dtype=np.uint8), plus_base_freqs, minus_base_freqs)
+
+    def close(self):
+        self.genome_fa.close()
+
+
+def entry_bytes(entry):
+    """Function that takes as input a cache entry and returns the bytes taken by its arrays, including the tables
+    stored on it"""
+
+    total = 0
+    for value in entry.values():
+        if isinstance(value, dict):
+            total += entry_bytes(value)
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+    return(total)
+
+
+class interval_cache:
+    """Class for caching the realignment intervals of a reference, up to max_bytes bytes. The least recently used
+    intervals are dropped when the cache is full"""
+
+    def __init__(self, reference, max_bytes):
+
+        self.reference = reference
+        self.max_bytes = max_bytes
+        self.intervals = OrderedDict()
+        self.bytes = {}
+        self.total = 0
+        self.last = None
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, key):
+        """Function that updates the bytes taken by a cached interval, which grow when tables are stored on it"""
+
+        if key in self.intervals:
+            size = entry_bytes(self.intervals[key])
+            self.total += size - self.bytes.get(key, 0)
+            self.bytes[key] = size
+
+    def evict(self):
+        """Function that drops the least recently used intervals until the cache fits in max_bytes. The most recently
+        used one is always kept"""
+
+        while self.total > self.max_bytes and len(self.intervals) > 1:
+            key, entry = self.intervals.popitem(last=False)
+            self.total -= self.bytes.pop(key)
+
+    def entry(self, chrom, start, end):
+        """Function that takes as input an interval and returns its cache entry, a dictionary holding the plus and minus
+        strand sequences as arrays of characters and the background frequencies. Tables derived from the interval can
+        be stored on the entry, and are counted in the size of the cache"""
+
+        key = (chrom, start, end)
+
+        # the tables built on the last entry returned
+        self.count(self.last)
+        self.last = key
+
+        if key in self.intervals:
+            self.hits += 1
+            self.intervals.move_to_end(key)
+            self.evict()
+            return(self.intervals[key])
+
+        self.misses += 1
+        plus_codes, minus_codes, plus_base_freqs, minus_base_freqs = self.reference.interval(chrom, start, end)
+        entry = {'plus_codes': plus_codes, 'minus_codes': minus_codes, 'plus_freqs': plus_base_freqs,
+                 'minus_freqs': minus_base_freqs}
+
+        if self.max_bytes > 0:
+            self.intervals[key] = entry
+            self.count(key)
+            self.evict()
+
+        return(entry)
+
+    def close(self):
+        self.reference.close()
+
+
+class minimizer_index:
+    """Class for finding the seed hits of the soft-clipped reads on a whole contig, using the memory mapped minimizers
+    of the reference"""
+
+    def __init__(self, fasta):
+
+        files = index_files(fasta)
+
+        with open(files['minimizer_meta']) as meta:
+            meta = json.load(meta)
+
+        self.k = meta['k']
+        self.w = meta['w']
+        self.contigs = meta['contigs']
+
+        self.hashes = np.load(files['minimizer_hashes'], mmap_mode='r')
+        self.positions = np.load(files['minimizer_positions'], mmap_mode='r')
+
+    def diagonals(self, chrom, sequence, complement):
+        """Function that takes as input a contig and a read as an array of characters, and returns the diagonals
+        (contig position - read position) of the read k-mers that are minimizers of the contig. Every k-mer of the read
+        is looked up, so that reads shorter than a window still hit. If complement is True the complement of the read is
+        searched, which is what is realigned to the minus strand"""
+
+        if chrom not in self.contigs:
+            return(np.zeros(0, dtype=np.int64))
+
+        codes = sequence_codes(sequence)
+        if complement:
+            codes = np.where(codes < 4, 3 - codes, 4).astype(np.uint8)
+
+        read_hashes, read_positions = minimizers(codes, self.k, 1)
+
+        first, last = self.contigs[chrom]
+        table = self.hashes[first:last]
+        lower = np.searchsorted(table, read_hashes.astype(np.uint32), side='left')
+        upper = np.searchsorted(table, read_hashes.astype(np.uint32), side='right')
+        occurrences = upper - lower
+
+        # repeated minimizers do not tell where the read comes from
+        seeds = (occurrences > 0) & (occurrences <= MAX_OCCURRENCES)
+
+        diagonals = [np.array(self.positions[first + start:first + end], dtype=np.int64) - position
+                     for start, end, position in zip(lower[seeds], upper[seeds], read_positions[seeds])]
+
+        if len(diagonals) == 0:
+            return(np.zeros(0, dtype=np.int64))
+
+        return(np.concatenate(diagonals))
+
+
+def open_minimizers(fasta):
+    """Function that takes as input the reference fasta and returns its minimizer index, or None if the reference was
+    not indexed with Circle-Map Index -mm or it changed after the index was built"""
+
+    if index_is_current(fasta, index_files(fasta)['minimizer_meta']):
+        return(minimizer_index(fasta))
+    else:
+        return(None)
+
+
+def open_reference(fasta):
+    """Function that takes as input the reference fasta and returns the Circle-Map index if the reference was indexed
+    with Circle-Map Index and did not change after that, and the fasta file otherwise"""
+
+    if index_is_current(fasta, index_files(fasta)['meta']):
+        return(genome_index(fasta))
+    else:
+        return(fasta_reference(fasta))
+
+
+def update_index(fasta):
+    """Function that takes as input the reference fasta and rebuilds its Circle-Map index files, if there are any, when
+    the fasta changed after they were built. It is called once, before the workers open the index"""
+
+    files = index_files(fasta)
+
+    if os.path.isfile(files['meta']) and not index_is_current(fasta, files['meta']):
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "The reference changed after it was indexed. Rebuilding the index")
+        build_index(fasta)
+
+    if os.path.isfile(files['minimizer_meta']) and not index_is_current(fasta, files['minimizer_meta']):
+        with open(files['minimizer_meta']) as meta:
+            meta = json.load(meta)
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "The reference changed after its minimizers were indexed. Rebuilding the minimizer index")
+        build_minimizer_index(fasta, meta['k'], meta['w'])
@@ -0,0 +1,66 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import sys
+import functools
+
+
+class lazy_kernel:
+    """Class for numba kernels that are compiled the first time they are called, so that numba is only imported by the
+    subcommands that run a kernel"""
+
+    def __init__(self, function, options):
+
+        self.function = function
+        self.options = options
+        self.dispatcher = None
+        functools.update_wrapper(self, function)
+
+    def compile(self):
+        """Function that compiles every lazy kernel of the module of the kernel, and replaces them in the module by
+        their numba dispatchers, so that kernels calling other kernels find the dispatchers in the module globals when
+        they are compiled. The lazy kernels imported by name in other modules, as the ones doing
+        from circlemap.utils import *, call the dispatcher they keep"""
+
+        from numba import jit
+
+        module = sys.modules[self.function.__module__]
+        for name, value in list(vars(module).items()):
+            if isinstance(value, lazy_kernel) and value.dispatcher is None:
+                value.dispatcher = jit(**value.options)(value.function)
+                setattr(module, name, value.dispatcher)
+
+    def __call__(self, *args, **kwargs):
+
+        if self.dispatcher is None:
+            self.compile()
+        return(self.dispatcher(*args, **kwargs))
+
+
+def jit(**options):
+    """Decorator with the options of numba.jit, that defers importing numba and creating the kernel until it is
+    called"""
+
+    def decorator(function):
+        return(lazy_kernel(function, options))
+
+    return(decorator)
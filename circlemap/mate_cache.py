@@ -0,0 +1,206 @@
+#MIT License
+#
+#Copyright (c) 2019 Iñigo Prada Luengo
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import os
+import zlib
+import pysam as ps
+
+# bytes taken in memory by an alignment besides its sequence and qualities
+READ_OVERHEAD = 300
+
+# files the reads spilled to disk are hashed into by read name. Every file is read back into memory on its own
+SPILL_FILES = 64
+
+
+def counted_alignments(read):
+    """Function that takes as input an alignment and returns how many alignments its read has, as the primary alignment
+    and the supplementary alignments listed in the SA tag. Secondary alignments are only counted when they carry an SA
+    tag, as the split alignments of bwa mem -M do"""
+
+    if read.has_tag('SA'):
+        return(1 + len([alignment for alignment in read.get_tag('SA').split(';') if alignment != '']))
+    else:
+        return(1)
+
+
+def is_counted(read):
+    """Function that returns True if the alignment is one of the alignments counted by counted_alignments"""
+
+    return(read.is_secondary == False or read.has_tag('SA'))
+
+
+def plain_secondaries(bam,prefix,threads=1):
+    """Function that takes as input a coordinate sorted bam file and returns, for every read name with secondary
+    alignments without SA tag, how many of them every mate has. No SA tag lists them, so the mate cache needs their
+    number to know when a read name is complete. samtools filters them into a temporary bam starting with prefix"""
+
+    filtered = "%s.bam" % prefix
+    # pysam takes -o as the file for the stdout of samtools, unless it is told not to catch it
+    ps.view("-u", "-f", "256", "-e", "![SA]", "-@", str(threads), "-o", filtered, bam, catch_stdout=False)
+
+    secondaries = {}
+    with ps.AlignmentFile(filtered, "rb", check_sq=False) as secondary_bam:
+        for read in secondary_bam:
+            mates = secondaries.setdefault(read.query_name, {})
+            mates[read.flag & 0xc0] = mates.get(read.flag & 0xc0, 0) + 1
+
+    os.remove(filtered)
+
+    return(secondaries)
+
+
+def expected_alignments(read,secondaries):
+    """Function that takes as input a counted alignment and the secondary alignments without SA tag of every read name,
+    and returns how many alignments its mate has"""
+
+    if secondaries is None or read.query_name not in secondaries:
+        return(counted_alignments(read))
+    return(counted_alignments(read) + secondaries[read.query_name].get(read.flag & 0xc0, 0))
+
+
+def is_complete(reads,secondaries=None):
+    """Function that takes as input the alignments of a read name and the secondary alignments without SA tag of every
+    read name, and returns True if every mate has all its alignments. Without secondaries, only the alignments counted
+    by counted_alignments are waited for"""
+
+    expected = {}
+    seen = {}
+    for read in reads:
+        mate = read.flag & 0xc0
+        if is_counted(read):
+            expected[mate] = expected_alignments(read, secondaries)
+        if is_counted(read) or secondaries is not None:
+            seen[mate] = seen.get(mate, 0) + 1
+
+    mates = (0x40, 0x80) if reads[0].is_paired else (0,)
+    return(all(mate in expected and seen[mate] >= expected[mate] for mate in mates))
+
+
+def queryname_order(reads):
+    """Function that takes as input the alignments of a read name in coordinate order, and returns them in the order
+    samtools sort -n gives them: read1 before read2, then the primary, the supplementary, the secondary and the
+    secondary supplementary alignments. Alignments of the same kind keep the coordinate order, as they do when the
+    coordinate sorted bam is sorted by read name"""
+
+    return(sorted(reads, key=lambda read: (read.flag & 0xc0, read.flag & 0x100, read.flag & 0x800)))
+
+
+class mate_cache:
+    """Class for the alignments of the read names that have not been completely seen in a coordinate sorted bam. A read
+    name is complete when every mate has all the alignments its SA tag lists, and the secondary alignments without SA
+    tag counted by plain_secondaries. When the alignments held take more than max_memory bytes, all of them are spilled
+    to disk and matched once the bam has been read"""
+
+    def __init__(self,header,spill_prefix,max_memory,secondaries=None):
+
+        self.header = header
+        self.spill_prefix = spill_prefix
+        self.max_memory = max_memory
+
+        # secondary alignments without SA tag of every read name. None when they could not be counted, as in a stream.
+        # They can then come after their read name has been completed
+        self.secondaries = secondaries
+
+        # read name: [alignments, alignments expected for every mate, alignments seen for every mate]
+        self.names = {}
+        self.nbytes = 0
+
+        self.spill_files = None
+        self.spills = 0
+
+    def add(self,read):
+        """Function that takes as input the next alignment of the coordinate sorted bam. It returns the alignments of
+        its read name in queryname order if they have all been seen, None otherwise"""
+
+        name = read.query_name
+        if name not in self.names:
+            self.names[name] = [[], {}, {}]
+        reads, expected, seen = self.names[name]
+
+        reads.append(read)
+        self.nbytes += READ_OVERHEAD + 2 * read.query_length
+
+        mate = read.flag & 0xc0
+        if is_counted(read):
+            expected[mate] = expected_alignments(read, self.secondaries)
+        if is_counted(read) or self.secondaries is not None:
+            seen[mate] = seen.get(mate, 0) + 1
+
+        mates = (0x40, 0x80) if read.is_paired else (0,)
+        if all(mate in expected and seen[mate] >= expected[mate] for mate in mates):
+            del self.names[name]
+            self.nbytes -= sum([READ_OVERHEAD + 2 * read.query_length for read in reads])
+            return(queryname_order(reads))
+
+        if self.nbytes > self.max_memory:
+            self.spill()
+
+        return(None)
+
+    def spill(self):
+        """Function that writes the alignments held to the spill files and empties the cache. The alignments of a read
+        name are always written to the same file, in the order they were added. Names whose alignments were spilled can
+        not be completed by the cache afterwards, since the spilled alignments are not seen again"""
+
+        if self.spill_files is None:
+            self.spill_files = [ps.AlignmentFile("%s.%s" % (self.spill_prefix, index), "wbu", header=self.header)
+                                for index in range(SPILL_FILES)]
+
+        for name, (reads, expected, seen) in self.names.items():
+            spill_file = self.spill_files[zlib.crc32(name.encode()) % SPILL_FILES]
+            for read in reads:
+                spill_file.write(read)
+
+        self.names = {}
+        self.nbytes = 0
+        self.spills += 1
+
+    def pending(self):
+        """Function that yields the alignments of every read name left in the cache and the spill files once the whole
+        bam has been added, in queryname order. These names have missing mates or were spilled to disk"""
+
+        if self.spill_files is None:
+            for name, (reads, expected, seen) in self.names.items():
+                yield(queryname_order(reads))
+            self.names = {}
+            return
+
+        self.spill()
+        for spill_file in self.spill_files:
+            spill_file.close()
+
+        for index in range(SPILL_FILES):
+            spill_name = "%s.%s" % (self.spill_prefix, index)
+
+            names = {}
+            with ps.AlignmentFile(spill_name, "rb", check_sq=False) as spill_file:
+                for read in spill_file:
+                    if read.query_name not in names:
+                        names[read.query_name] = []
+                    names[read.query_name].append(read)
+
+            os.remove(spill_name)
+
+            for reads in names.values():
+                yield(queryname_order(reads))
+
+        self.spill_files = None
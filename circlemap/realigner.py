@@ -25,21 +25,29 @@ from __future__ import division
 
 import os
 import sys
-from Bio.Seq import Seq
 import time
 from circlemap.utils import *
+from circlemap.genome_index import open_reference, open_minimizers, interval_cache
+from circlemap.depth_index import open_depth
+from circlemap.evidence import evidence_buffer, SPLIT_COLUMNS, DISCORDANT_COLUMNS, CIRCLE_COLUMNS
 import pandas as pd
 import traceback
+import resource
 
 
 
+#bam and fasta files opened once by every process of the realignment pool
+worker_files = {}
+
+
 class realignment:
     """Class for managing the realignment and eccDNA indetification of circle-map"""
 
     def __init__(self, input_bam,qname_bam,sorted_bam,genome_fasta,directory,mapq_cutoff,insert_size_mapq,std_extension,
                  insert_size_sample_size,gap_open,gap_ext,n_hits,prob_cutoff,min_soft_clipped_length,overlap_frac,
-                 interval_p_cut, output_name,ncores,af,locker,split,ratio,verbose,pid,edit_distance_frac,
-                 remap_splits,only_discordants,splits,score,insert_size,discordant_filter):
+                 interval_p_cut, output_name,ncores,af,split,ratio,verbose,pid,edit_distance_frac,
+                 remap_splits,only_discordants,splits,score,insert_size,discordant_filter,interval_cache_size,lonely_soft_clipped,
+                 max_memory,depth_index):
         #I/O
         self.edit_distance_frac = edit_distance_frac
         self.ecc_dna_str = input_bam
@@ -85,7 +93,6 @@ class realignment:
         #regular options
         self.cores = ncores
         self.verbose = verbose
-        self.lock = locker
 
         #this two parameters don't work on this class. They are here for printing the parameters
         self.split = split
@@ -95,6 +102,18 @@ class realignment:
 
         self.pid = pid
 
+        #realignment intervals cached by every process
+        self.interval_cache_size = interval_cache_size * 1024 * 1024
+
+        #rescue the soft-clipped reads whose only prior is the whole contig with the minimizer index
+        self.lonely_soft_clipped = lonely_soft_clipped
+
+        #bytes of evidence kept by every process before it is merged and written to disk
+        self.max_memory = max_memory * 1024 * 1024
+
+        #read the allele frequency depth from the depth index of the sorted bam
+        self.depth_index = depth_index
+
 
 
 
@@ -133,18 +152,45 @@ class realignment:
 
 
 
+    @staticmethod
+    def open_files(ecc_dna_str,sorted_bam_str,genome_fa,interval_cache_size,lonely_soft_clipped,depth_index,directory):
+        """Function that opens the bam and fasta files, together with their indexes, once for every process. It is used
+        as the initializer of the realignment pool, so that the handles are reused across the chunks"""
+
+        worker_files['sorted_bam'] = ps.AlignmentFile(sorted_bam_str, "rb")
+        worker_files['genome_fa'] = interval_cache(open_reference(genome_fa),interval_cache_size)
+        worker_files['ecc_dna'] = ps.AlignmentFile(ecc_dna_str, "rb")
+        worker_files['minimizers'] = open_minimizers(genome_fa) if lonely_soft_clipped else None
+        worker_files['depth'] = open_depth(sorted_bam_str,None,directory) if depth_index else None
+
+    def initargs(self):
+        """Arguments for the pool initializer"""
+        return((self.ecc_dna_str,self.sorted_bam_str,self.genome_fa,self.interval_cache_size,self.lonely_soft_clipped,
+                self.depth_index,self.directory))
+
+
+
     def realign(self,peaks):
         """Function that will iterate trough the bam file containing reads indicating eccDNA structural variants and
         will output a bed file containing the soft-clipped reads, the discordant and the coverage within the interval"""
 
-        #open files for every process
+        #files are opened once by every process
         try:
+            if len(worker_files) == 0:
+                self.open_files(*self.initargs())
+
             peaks_pd = pd.DataFrame.from_records(peaks,columns=['chrom', 'start', 'end'])
-            sorted_bam = ps.AlignmentFile(self.sorted_bam_str, "rb")
-            genome_fa = ps.FastaFile(self.genome_fa)
-            ecc_dna = ps.AlignmentFile(self.ecc_dna_str,"rb")
+            sorted_bam = worker_files['sorted_bam']
+            genome_fa = worker_files['genome_fa']
+            ecc_dna = worker_files['ecc_dna']
+            minimizers = worker_files['minimizers']
 
             begin = time.time()
+            cache_hits = genome_fa.hits
+            cache_misses = genome_fa.misses
+
+            #soft-clipped reads rejected by the q-gram filter and realigned
+            seed_stats = {'filtered':0,'aligned':0,'rescued':0}
 
 
 
@@ -165,8 +211,12 @@ class realignment:
             iteration = 0
 
 
-            results = []
-            only_discordants = []
+            #evidence of the chunk, with the contigs stored as ids of the bam header
+            results = evidence_buffer(CIRCLE_COLUMNS, ecc_dna.references)
+            only_discordants = evidence_buffer(DISCORDANT_COLUMNS, ecc_dna.references)
+            iteration_results = evidence_buffer(SPLIT_COLUMNS, ecc_dna.references)
+            iteration_discordants = evidence_buffer(DISCORDANT_COLUMNS, ecc_dna.references)
+            spills = 0
 
 
 
@@ -174,9 +224,13 @@ class realignment:
 
 
 
-                if check_size_and_write(results,only_discordants,self.output,self.lock,self.directory,self.overlap_fraction,self.pid) == True:
-                    results = []
-                    only_discordants = []
+                if check_size_and_write(results,only_discordants,self.max_memory,self.output,self.directory,
+                                        self.overlap_fraction,self.split,self.score,self.min_sc_length,sorted_bam,
+                                        self.af,insert_metrics[0],insert_metrics[1],self.discordant_filter,
+                                        self.pid,worker_files['depth']) == True:
+                    results.clear(shrink=True)
+                    only_discordants.clear(shrink=True)
+                    spills += 1
 
                 try:
 
@@ -198,13 +252,34 @@ class realignment:
                                                                                   self.verbose)
                         
 
+                        #the reads of the peak are fetched and decoded once, and evaluated against every mate interval
+                        peak_reads = None
+
+                        #no prior other than the whole contig: the mate intervals are taken from the seed hits of the
+                        #soft-clipped reads without SA tag
+                        if minimizers is not None and all(mate[3] == 'SC' for mate in candidate_mates) and \
+                                (realignment_interval_extended is None or len(realignment_interval_extended) == 0):
+
+                            peak_reads = get_peak_reads(ecc_dna,interval,self.mapq_cutoff)
+                            realignment_interval_extended = lonely_soft_clipped_intervals(peak_reads,minimizers,interval['chrom'],
+                                                                                          self.mapq_cutoff,self.min_sc_length,
+                                                                                          self.edit_distance_frac,self.n_hits)
+                            if realignment_interval_extended is not None:
+                                seed_stats['rescued'] += 1
+
                         if realignment_interval_extended is None:
                             continue
 
+                        if peak_reads is None:
+                            peak_reads = get_peak_reads(ecc_dna,interval,self.mapq_cutoff)
 
-                        iteration_results = []
-                        iteration_discordants = []
+                        iteration_results.clear()
+                        iteration_discordants.clear()
                         disorcordants_per_it = 0
+
+                        #reads are stored as ids, unique within the peak
+                        contig = ecc_dna.get_tid(interval['chrom'])
+                        read_ids = {}
                         for index,mate_interval in realignment_interval_extended.iterrows():
 
                             iteration += 1
@@ -214,31 +289,22 @@ class realignment:
                             #sample realignment intervals
                             #fasta file fetch is 1 based that why I do +1
 
-                            plus_coding_interval = genome_fa.fetch(str(mate_interval['chrom']),int(int(mate_interval['start'])+1),int(int(mate_interval['end'])+1)).upper()
-                            interval_length = len(plus_coding_interval)
-                            minus_coding_interval = str(Seq(plus_coding_interval).complement())
-
-                            # precompute the denominators of the error model. They will be constants for every interval
-                            plus_base_freqs = background_freqs(plus_coding_interval)
-
-                            minus_base_freqs = {'T':plus_base_freqs['A'],'A':plus_base_freqs['T'],
-                                                'C':plus_base_freqs['G'],'G':plus_base_freqs['C']}
-
-                            minus_base_freqs = np.array([plus_base_freqs['T'],plus_base_freqs['A'],plus_base_freqs['G'],plus_base_freqs['C']])
-                            plus_base_freqs = np.array([plus_base_freqs['A'],plus_base_freqs['T'],plus_base_freqs['C'],plus_base_freqs['G']])
+                            realignment_interval = genome_fa.entry(
+                                str(mate_interval['chrom']),int(int(mate_interval['start'])+1),int(int(mate_interval['end'])+1))
+                            interval_length = len(realignment_interval['plus_codes'])
 
 
                             #note that I am getting the reads of the interval. Not the reads of the mates
 
-                            for read in ecc_dna.fetch(interval['chrom'],int(interval['start']),int(interval['end']),multiple_iterators=True):
+                            for read in peak_reads:
 
 
-                                if is_soft_clipped(read):
+                                if read.soft_clipped:
 
                                     if read.mapq >= self.mapq_cutoff:
 
                                         # no need to realignment
-                                        if read.has_tag('SA') and self.remap != True:
+                                        if read.sa != None and self.remap != True:
 
 
                                             #check realignment from SA tag
@@ -253,11 +319,11 @@ class realignment:
 
                                                 if support['support'] == True:
 
-                                                    score = len(get_longest_soft_clipped_bases(read)['seq'])*  (1-phred_to_prob(np.array(int(read.get_tag('SA').split(',')[4]),dtype=np.float64)))
+                                                    score = read.sa_score
 
                                                     #compute mapping positions
 
-                                                    read_end = rightmost_from_read(read)
+                                                    read_end = read.read_end
 
                                                     supplementary_end = rightmost_from_sa(support['leftmost'],support['cigar'])
 
@@ -266,12 +332,13 @@ class realignment:
                                                     # I store the read name to the output, so that a read counts as 1 no matter it is SC in 2 pieces
                                                     if read.reference_start < support['leftmost']:
 
-                                                        iteration_results.append([interval['chrom'],read.reference_start,(supplementary_end-1),read.qname,iteration,float(round(score,2))])
+                                                        iteration_results.append(contig,read.reference_start,(supplementary_end-1),
+                                                                                 read_ids.setdefault(read.qname,len(read_ids)),iteration,float(round(score,2)))
 
                                                     elif read.reference_start > support['leftmost']:
 
                                                         iteration_results.append(
-                                                            [interval['chrom'], (support['leftmost']-1), read_end, read.qname,iteration,float(round(score,2))])
+                                                            contig, (support['leftmost']-1), read_end, read_ids.setdefault(read.qname,len(read_ids)),iteration,float(round(score,2)))
 
                                                     else:
                                                         #uninformative read
@@ -281,19 +348,30 @@ class realignment:
 
                                         else:
                                             #sc length
-                                            sc_len = len(get_longest_soft_clipped_bases(read)['seq'])
+                                            sc_len = read.sc_len
 
 
-                                            if non_colinearity(int(read.cigar[0][0]),int(read.cigar[-1][0]),int(read.pos),
+                                            if non_colinearity(read.cigar_start,read.cigar_end,read.reference_start,
                                                                int(mate_interval.start),int(mate_interval.end)) == True:
 
 
                                                 if sc_len >= self.min_sc_length:
                                                     edits_allowed = adaptative_myers_k(sc_len, self.edit_distance_frac)
+                                                #q-gram filter
+
+                                                    seeded = seed_filter(read.sc_codes,
+                                                                         interval_seeds(realignment_interval,read.is_reverse),
+                                                                         edits_allowed)
                                                 #realignment
 
-                                                    realignment_dict = realign(read,self.n_hits,plus_coding_interval,minus_coding_interval,
-                                                                               plus_base_freqs,minus_base_freqs,self.gap_open,self.gap_ext,self.verbose,edits_allowed)
+                                                    if seeded == False:
+                                                        seed_stats['filtered'] += 1
+                                                        realignment_dict = None
+                                                    else:
+                                                        seed_stats['aligned'] += 1
+                                                        realignment_dict = realign(read,self.n_hits,realignment_interval['plus_codes'],realignment_interval['minus_codes'],
+                                                                                   realignment_interval['plus_freqs'],realignment_interval['minus_freqs'],
+                                                                                   self.gap_open,self.gap_ext,self.verbose,edits_allowed)
 
 
                                                     if realignment_dict == None:
@@ -308,7 +386,7 @@ class realignment:
                                                             # here I have to retrieve the nucleotide mapping positions. Which should be the
                                                             # the left sampling pysam coordinate - edlib coordinates
 
-                                                            read_end = rightmost_from_read(read)
+                                                            read_end = read.read_end
 
 
                                                             soft_clip_start = int(mate_interval['start'])+ int(realignment_dict['alignments'][1][0][0])
@@ -322,12 +400,12 @@ class realignment:
                                                             if read.reference_start < int(mate_interval['start']) + int(
                                                                     realignment_dict['alignments'][1][0][0]):
 
-                                                                iteration_results.append([interval['chrom'], read.reference_start, soft_clip_end+1, read.qname,iteration,float(round(score,2))])
+                                                                iteration_results.append(contig, read.reference_start, soft_clip_end+1, read_ids.setdefault(read.qname,len(read_ids)),iteration,float(round(score,2)))
 
                                                             elif read.reference_start + int(mate_interval['start']) + int(
                                                                     realignment_dict['alignments'][1][0][0]):
 
-                                                                iteration_results.append([interval['chrom'], soft_clip_start, read_end, read.qname,iteration,float(round(score,2))])
+                                                                iteration_results.append(contig, soft_clip_start, read_end, read_ids.setdefault(read.qname,len(read_ids)),iteration,float(round(score,2)))
 
                                                             else:
                                                                 # uninformative read
@@ -351,7 +429,7 @@ class realignment:
                                             if read.reference_start < read.next_reference_start:
                                                 # discordant read
                                                 disorcordants_per_it +=1
-                                                iteration_discordants.append([interval['chrom'],read.reference_start,read.next_reference_start + read.infer_query_length(),read.qname])
+                                                iteration_discordants.append(contig,read.reference_start,read.next_reference_start + read.query_length,read_ids.setdefault(read.qname,len(read_ids)))
 
 
 
@@ -361,25 +439,17 @@ class realignment:
                                         if read.is_read2 == False:
                                             if read.next_reference_start < read.reference_start:
                                                 disorcordants_per_it +=1
-                                                iteration_discordants.append([interval['chrom'], read.next_reference_start,read.reference_start+read.infer_query_length(),                                                                              read.qname])
-
+                                                iteration_discordants.append(contig, read.next_reference_start,read.reference_start+read.query_length,read_ids.setdefault(read.qname,len(read_ids)))
 
                         #second pass to add discordant read info
                         if len(iteration_results) > 0:
 
 
-                            results = results + assign_discordants(iteration_results,iteration_discordants,insert_metrics[0],insert_metrics[1])
+                            results.extend(assign_discordants(iteration_results,iteration_discordants,insert_metrics[0],insert_metrics[1]))
 
 
                         elif len(iteration_discordants) > 0:
-                                discordant_bed = pd.DataFrame.from_records(iteration_discordants,columns=['chrom','start','end','read']).sort_values(['chrom','start','end'])
-
-                                discordant_bed = discordant_bed.groupby(merge_bed(discordant_bed)).agg(
-                                    {'chrom': 'first', 'start': 'first', 'end': 'last', 'read': 'count'})
-
-
-                                for index,disc_interval in discordant_bed.iterrows():
-                                    only_discordants.append([disc_interval['chrom'],disc_interval['start'],disc_interval['end'],disc_interval['read'],0])
+                                only_discordants.extend(merge_discordants(iteration_discordants))
 
 
 
@@ -392,16 +462,14 @@ class realignment:
                     return([1,1])
 
 
-            ecc_dna.close()
-            genome_fa.close()
-
 
             # Write process output to disk
             output = iteration_merge(only_discordants,results,
                                      self.overlap_fraction,self.split,self.score,
-                                     self.min_sc_length,sorted_bam,self.af,insert_metrics[0],insert_metrics[1],self.discordant_filter)
+                                     self.min_sc_length,sorted_bam,self.af,insert_metrics[0],insert_metrics[1],self.discordant_filter,
+                                     worker_files['depth'])
 
-            write_to_disk(output, self.output, self.lock, self.directory, self.pid)
+            write_to_disk(output, self.output, self.directory, self.pid)
 
 
         except:
@@ -409,9 +477,8 @@ class realignment:
             print(traceback.print_exc(file=sys.stdout))
             return([1,1])
 
-        sorted_bam.close()
-        genome_fa.close()
-        ecc_dna.close()
-
 
-        return([0,0])
\ No newline at end of file
+        # time spent by this worker in the chunk, used to report the load balance
+        return([0,0,{'pid':os.getpid(),'time':time.time() - begin,'cache_hits':genome_fa.hits - cache_hits,
+                     'cache_misses':genome_fa.misses - cache_misses,'seeds':seed_stats,'spills':spills,
+                     'max_rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}])
\ No newline at end of file
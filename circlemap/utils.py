@@ -21,23 +21,24 @@
 #SOFTWARE.
 
 import pysam as ps
-import pybedtools as bt
 import warnings
 import numpy as np
-import pandas as pd
 import itertools as it
-import edlib
 import os
 import subprocess as sp
 import glob
 import time
 import sys
-from scipy import stats as st
 import random
 import re
-from numba import jit
+from circlemap.lazy import jit
 import math
 import datetime
+from functools import partial
+import heapq
+
+# pandas, pybedtools, edlib and multiprocessing are imported by the functions using them, so that the subcommands that
+# do not need them start faster
 
 
 
@@ -219,9 +220,210 @@ def genome_alignment_from_cigar(sa_cigar):
 
 
 
+def coverage_peaks(bam_name,clusters,contig):
+    """Function that takes as input an indexed bam file, the clustering distance and a contig and returns the regions of
+    the contig covered by the reads, merging the regions closer than the clustering distance. Every region is reported
+    with the mean of its coverage runs, as the bedtools genomecov -bg | mergeBed -d -c 4 -o mean pipeline would do.
+    Regions longer than 500 bp are split into 300 bp windows, and every window gets a realignment cost estimate"""
+
+    bam = ps.AlignmentFile(bam_name, "rb")
+
+    starts = []
+    ends = []
+    # reads that will need a probabilistic realignment and the interval (prior) every read points to
+    realign = []
+    prior_starts = []
+    prior_ends = []
+    for read in bam.fetch(contig):
+        if read.is_unmapped == False and read.reference_end != None:
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+
+            prior_start = -1
+            prior_end = -1
+            if read.has_tag('SA'):
+                supl_info = [x.strip() for x in read.get_tag('SA').split(',')]
+                if supl_info[0] == contig:
+                    ref_alignment_length = genome_alignment_from_cigar(supl_info[3])
+                    prior_start = int(supl_info[1]) - ref_alignment_length
+                    prior_end = int(supl_info[1]) + ref_alignment_length
+
+            elif read.mate_is_unmapped == False and read.next_reference_id == read.reference_id:
+                prior_start = read.next_reference_start
+                prior_end = read.next_reference_start + read.infer_query_length()
+
+            realign.append(is_soft_clipped(read) and read.has_tag('SA') == False)
+            prior_starts.append(prior_start)
+            prior_ends.append(prior_end)
+
+    bam.close()
+
+    if len(starts) == 0:
+        return([])
+
+    # +1 when a read starts, -1 when it ends. The coverage changes only at those positions
+    positions, inverse = np.unique(np.array(starts + ends, dtype=np.int64), return_inverse=True)
+    changes = np.bincount(inverse, weights=np.concatenate((np.ones(len(starts)), -np.ones(len(ends))))).astype(np.int64)
+
+    # positions where the reads starting and ending cancel out do not break the coverage runs
+    positions = positions[changes != 0]
+    depth = np.cumsum(changes[changes != 0])
+
+    # coverage runs (bedgraph), depth[i] spans from positions[i] to positions[i+1]
+    covered = depth[:-1] > 0
+    run_start = positions[:-1][covered]
+    run_end = positions[1:][covered]
+    run_depth = depth[:-1][covered]
+
+    # a new cluster starts when the gap to the previous run is bigger than the clustering distance
+    cluster = np.cumsum(np.concatenate(([0], (run_start[1:] - run_end[:-1]) > clusters)))
+
+    first = np.concatenate(([0], np.flatnonzero(np.diff(cluster)) + 1))
+    last = np.concatenate((first[1:], [len(cluster)])) - 1
+    mean = np.bincount(cluster, weights=run_depth) / np.bincount(cluster)
+
+    # the reads come sorted by start from the index
+    starts = np.array(starts, dtype=np.int64)
+    realign = np.array(realign, dtype=bool)
+    prior_starts = np.array(prior_starts, dtype=np.int64)
+    prior_ends = np.array(prior_ends, dtype=np.int64)
+
+    windows = []
+    for f, l, m in zip(first, last, mean):
+
+        start = int(run_start[f])
+        end = int(run_end[l])
+
+        if end - start > 500:
+            w_starts = range(start, end, 300)
+            w_ends = [w_start + 300 for w_start in w_starts]
+        else:
+            w_starts = [start]
+            w_ends = [end]
+
+        for w_start,w_end in zip(w_starts,w_ends):
+            reads = slice(np.searchsorted(starts, w_start), np.searchsorted(starts, w_end))
+            cost = peak_cost(realign[reads], prior_starts[reads], prior_ends[reads])
+            windows.append([contig, w_start, w_end, float(m), cost])
+
+    return(windows)
+
+
+def peak_cost(realign,prior_starts,prior_ends):
+    """Function that takes as input which reads of a peak need to be realigned and the priors (mate intervals) the reads
+    point to, and returns the estimated cost of realigning the peak. Every read is evaluated against the mate intervals,
+    and the reads needing a realignment are aligned to the whole length covered by the mate intervals"""
+
+    has_prior = prior_starts >= 0
+    order = np.argsort(prior_starts[has_prior], kind='mergesort')
+    p_starts = prior_starts[has_prior][order]
+    p_ends = np.maximum.accumulate(prior_ends[has_prior][order]) if len(order) > 0 else p_starts
+
+    # length of the union of the mate intervals
+    if len(p_starts) > 0:
+        new_interval = np.concatenate(([True], p_starts[1:] > p_ends[:-1]))
+        interval_starts = p_starts[new_interval]
+        interval_ends = p_ends[np.concatenate((np.flatnonzero(new_interval)[1:] - 1, [len(p_ends) - 1]))]
+        width = int(np.sum(interval_ends - interval_starts))
+    else:
+        width = 0
+
+    return(float(len(realign) + np.count_nonzero(realign) * (1 + width / 1000)))
+
+
+def schedule_peaks(peaks,chunks):
+    """Function that takes as input the peaks with their estimated cost and the number of chunks, and packs the peaks
+    longest first into the chunk with the lowest load. Returns the chunks sorted by cost, from high to low, together with
+    their estimated costs"""
+
+    peaks = sorted(peaks, key=lambda peak: peak[4], reverse=True)
+
+    chunks = min(chunks, len(peaks))
+    split_peaks = [[] for i in range(0, chunks)]
+    chunk_costs = [0.0 for i in range(0, chunks)]
+
+    load = [(0.0, i) for i in range(0, chunks)]
+    for chrom,start,end,mean,cost in peaks:
+        lowest, i = heapq.heappop(load)
+        split_peaks[i].append([chrom, str(start), str(end)])
+        chunk_costs[i] += cost
+        heapq.heappush(load, (lowest + cost, i))
+
+    order = sorted(range(0, chunks), key=lambda i: chunk_costs[i], reverse=True)
+
+    return([split_peaks[i] for i in order], [chunk_costs[i] for i in order])
+
+
+def worker_loads(costs,cores):
+    """Function that takes as input the cost of every chunk, in the order they are dispatched, and the number of workers
+    and returns the load every worker will get when every chunk goes to the first worker getting free"""
+
+    load = [0.0 for i in range(0, cores)]
+    heapq.heapify(load)
+    for cost in costs:
+        heapq.heappush(load, heapq.heappop(load) + cost)
+
+    return(load)
+
+
+def report_balance(predicted_costs,chunk_stats,cores):
+    """Function that takes as input the estimated cost of every chunk and the statistics returned by the realignment
+    workers and prints the predicted and the observed load balance (mean worker load / max worker load)"""
+
+    predicted = worker_loads(predicted_costs, cores)
+
+    observed = {}
+    for stats in chunk_stats:
+        observed[stats['pid']] = observed.get(stats['pid'], 0.0) + stats['time']
+
+    observed = list(observed.values()) + [0.0] * (cores - len(observed))
+
+    if max(predicted) > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Predicted load balance across %s workers: %s" % (cores, round(np.mean(predicted) / max(predicted), 3)))
+    if max(observed) > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Observed load balance across %s workers: %s. Busiest worker %s s, least busy worker %s s" % (
+                  cores, round(np.mean(observed) / max(observed), 3), round(max(observed), 2), round(min(observed), 2)))
+
+
+def report_cache(chunk_stats):
+    """Function that takes as input the statistics returned by the realignment workers and prints the hits and misses
+    of the realignment interval cache"""
+
+    hits = sum([stats['cache_hits'] for stats in chunk_stats])
+    misses = sum([stats['cache_misses'] for stats in chunk_stats])
+
+    if hits + misses > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Realignment interval cache: %s hits, %s misses (hit rate %s)" % (hits, misses,
+                                                                               round(hits / (hits + misses), 3)))
+
+
+def report_seeds(chunk_stats):
+    """Function that takes as input the statistics returned by the realignment workers and prints how many soft-clipped
+    reads were rejected by the q-gram filter and realigned, and how many peaks with only soft-clipped priors were
+    rescued with the minimizer index"""
+
+    filtered = sum([stats['seeds']['filtered'] for stats in chunk_stats])
+    aligned = sum([stats['seeds']['aligned'] for stats in chunk_stats])
+
+    if filtered + aligned > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Soft-clipped realignments: %s filtered, %s realigned" % (filtered, aligned))
+
+    rescued = sum([stats['seeds']['rescued'] for stats in chunk_stats])
+
+    if rescued > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Peaks with only soft-clipped priors realigned to their minimizer hits: %s" % rescued)
+
+
 def bam_circ_sv_peaks(bam,input_bam_name,cores,verbose,pid,clusters):
-    """Function that takes as input a bam file and returns a merged bed file of the genome covered by the bam, it will create
-    and index too"""
+    """Function that takes as input a bam file and returns the regions of the genome covered by the bam, split into
+    chunks for the realignment. The coverage of every contig is clustered in parallel"""
+
+    import multiprocessing as mp
 
     # check bam header for sorting state
 
@@ -280,41 +482,23 @@ def bam_circ_sv_peaks(bam,input_bam_name,cores,verbose,pid,clusters):
                 "As sanity check, sort your bam file coordinate with the following command:\n\n\tsamtools sort -o output.bam input.bam")
 
 
-    #from bam to BedGraph
+    #cluster the coverage of every contig in parallel, one contig per worker
 
-    sp.call("bedtools genomecov -bg -ibam %s | sort -T temp_files_%s -k 1,1 -k2,2n | mergeBed -d %s -c 4 -o mean | sort -r -n -k 4,4 > temp_files_%s/peaks.bed" %
-            (input_bam_name,pid,clusters,pid),shell=True)
+    contigs = [stat.contig for stat in sorted_bam.get_index_statistics() if stat.mapped > 0]
 
-    #Decide number of chunks
-    chunks = cores * 100
-    #Create empty list
-    split_peaks = []
-    for i in range(0, chunks):
-        split_peaks.append([])
+    pool = mp.Pool(processes=cores)
+    contig_peaks = pool.map(partial(coverage_peaks,input_bam_name,clusters),contigs)
+    pool.close()
+    pool.join()
 
-    #put chunks in the list
-    counter = 0
-    for interval in bt.BedTool("temp_files_%s/peaks.bed" % pid):
-        if counter == chunks:
-            counter = 0
-
-        if int(interval[2]) - int(interval[1]) > 500:
-            w_start = int(interval[1])
-            while w_start < int(interval[2]):
-                splitted = [interval.chrom, str(w_start), str(w_start + 300)]
-                w_start += 300
-                if counter == chunks:
-                    counter = 0
-                    split_peaks[counter].append(splitted)
-                else:
-                    split_peaks[counter].append(splitted)
-                    counter +=1
-        else:
-            split_peaks[counter].append([interval.chrom, str(interval.start), str(interval.end)])
-            counter += 1
+    #sort the clusters by mean coverage, from high to low
+    peaks = sorted([peak for peaks in contig_peaks for peak in peaks],key=lambda peak: peak[3],reverse=True)
+
+    #pack the peaks into chunks by their estimated cost
+    split_peaks,chunk_costs = schedule_peaks(peaks, cores * 100)
 
 
-    return(sorted_bam,split_peaks)
+    return(sorted_bam,split_peaks,chunk_costs)
 
 
 def get_mate_intervals(sorted_bam,interval,mapq_cutoff,verbose,only_discordants):
@@ -327,7 +511,8 @@ def get_mate_intervals(sorted_bam,interval,mapq_cutoff,verbose,only_discordants)
 
 
         candidate_mates = []
-        for read in sorted_bam.fetch(interval['chrom'], int(interval['start']), int(interval['end']),multiple_iterators=True):
+        #the handle of the worker is only iterated here, so the fetch does not need to reopen the bam file
+        for read in sorted_bam.fetch(interval['chrom'], int(interval['start']), int(interval['end'])):
 
             if read.mapq >= mapq_cutoff:
 
@@ -582,6 +767,8 @@ def get_realignment_intervals(bed_prior,interval_extension,interval_p_cutoff,ver
             are more informative priors (DR,SA). If there are only soft-clipped reads, they will be saved to a bed file to attemp
             lonely soft-clipped read rescue"""
 
+    import pandas as pd
+
     try:
 
         labels = ['chrom', 'start', 'end', 'read_type', 'orientation','probability']
@@ -730,17 +917,59 @@ def get_realignment_intervals(bed_prior,interval_extension,interval_p_cutoff,ver
 
 
 
+def lonely_soft_clipped_intervals(peak_reads,seed_index,chrom,mapq_cutoff,min_sc_length,edit_distance_frac,n_hits):
+    """Function that takes as input the reads of a peak whose only prior is the whole contig (soft-clipped reads without
+    SA tag) and the minimizer index of the reference, and returns the realignment intervals around the seed hits of the
+    soft-clipped reads. Every read contributes its n_hits best supported hits. Returns None if no read has seed hits"""
+
+    import pandas as pd
+
+    hits = []
+
+    for read in peak_reads:
+
+        if read.soft_clipped and read.mapq >= mapq_cutoff and read.sa is None and read.sc_codes is not None:
+
+            sc_len = read.sc_len
+            if sc_len < min_sc_length:
+                continue
+
+            diagonals = np.sort(seed_index.diagonals(chrom, read.sc_codes, read.is_reverse))
+            if len(diagonals) == 0:
+                continue
+
+            # the seeds of an alignment with k edits lie within k diagonals
+            k = int(adaptative_myers_k(sc_len, edit_distance_frac))
+            breaks = np.flatnonzero(np.diff(diagonals) > k) + 1
+            cluster_starts = np.concatenate(([0], breaks))
+            cluster_ends = np.concatenate((breaks, [len(diagonals)]))
+            n_seeds = cluster_ends - cluster_starts
+
+            for cluster in np.argsort(-n_seeds, kind='stable')[:n_hits]:
+                # the interval holds the whole alignment, and as much sequence on every side
+                start = diagonals[cluster_starts[cluster]] - k - sc_len
+                end = diagonals[cluster_ends[cluster] - 1] + 2 * sc_len + k
+                hits.append([chrom, max(int(start), 0), int(end), int(n_seeds[cluster])])
+
+    if len(hits) == 0:
+        return(None)
+
+    hits = pd.DataFrame.from_records(hits, columns=['chrom', 'start', 'end', 'probability']).sort_values(by=['start', 'end'])
+    intervals = hits.groupby(merge_bed(hits)).agg({'chrom': 'first', 'start': 'first', 'end': 'max', 'probability': 'sum'})
+    intervals['probability'] = intervals['probability'] / intervals['probability'].sum()
+
+    return(intervals.sort_values(by=['probability'], ascending=[False]))
+
+
 def circle_from_SA(read,mapq_cutoff,mate_interval):
 
-    """Function that takes as input a read (soft-clipped) with a Suplementary alignment the mapping quality cut-off
-    and the mate intervals and checks if it fits the conditions to call a circle. Will return True if the supplementary
+    """Function that takes as input a read (soft-clipped) from the peak batch with a Suplementary alignment the mapping
+    quality cut-off and the mate intervals and checks if it fits the conditions to call a circle. Will return True if the supplementary
     alignment matches the interval"""
 
-    suplementary = read.get_tag('SA')
-
     #this list will have the following information [chr,left_most start,"strand,CIGAR,mapq, edit_distance]
 
-    supl_info = [x.strip() for x in suplementary.split(',')]
+    supl_info = read.sa
 
     #mapq filter
     if int(supl_info[4]) > mapq_cutoff:
@@ -767,23 +996,6 @@ def circle_from_SA(read,mapq_cutoff,mate_interval):
 
     else:
         return{'support' : False}
-@jit(nopython=True)
-def number_encoding(seq):
-    """Function that takes as input a DNA sequence, and encodes the sequence to numbers, so that it can be accelerated
-    with numba"""
-    encoded = []
-    for i in seq:
-        if i == "A":
-            encoded.append(1)
-        elif i == "T":
-            encoded.append(2)
-        elif i == "C":
-            encoded.append(3)
-        elif i == "G":
-            encoded.append(4)
-    return(np.array(encoded))
-
-
 def check_alphabet(sequence):
     """Function that takes as input a sequence and it will check that there is at least a letter matching the alphabet
      in the sequence, returning true."""
@@ -809,12 +1021,31 @@ def check_compatibility(seq1,seq2):
 
     return(False)
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def phred_to_prob(values):
     """Function that takes as input a numpy array with phred base quality scores and returns an array with base probabi-
     lity scores"""
     return(10**((values*-1)/10))
 
+# log2 probability of a match and of a mismatch given the phred base quality. A match of a Q0 base scores -inf
+with np.errstate(divide='ignore'):
+    MATCH_LOG2 = np.log2(1 - 10**(-np.arange(256, dtype=np.float64)/10))
+    MISMATCH_LOG2 = np.log2(10**(-np.arange(256, dtype=np.float64)/10)/3)
+
+# A,T,C,G codes, the order of the background frequencies. Anything else is ambiguous
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ATCG'):
+    BASE_CODES[ord(base)] = code
+
+CIGAR_OPERATIONS = {'=': 0, 'X': 1, 'I': 2, 'D': 3}
+
+# q-gram length of the realignment seeds and the 2-bit codes used to build them. Anything else is ambiguous
+SEED_LENGTH = 8
+QGRAM_BASES = np.full(256, 4, dtype=np.int64)
+for code, base in enumerate('ACGT'):
+    QGRAM_BASES[ord(base)] = code
+
+
 def get_longest_soft_clipped_bases(read):
     """Function that takes as input the cigar string and returns a dictionary containing the longest soft-clipped part of
      the read, the quality values and  the read mapping quality"""
@@ -870,234 +1101,412 @@ def get_longest_soft_clipped_bases(read):
 
             print(e)
 
-def background_freqs(seq):
-    """Function that takes as input the sequence of the nucletide frequencies in the realignment interval"""
+class peak_read:
+    """Read of a peak batch. Only the fields used to evaluate the read against the mate intervals are kept: the flag,
+    the positions, the supplementary alignment fields and the longest soft-clipped part of the read (as base codes,
+    scoring classes and base qualities)"""
 
-    return{nucleotide: seq.count(nucleotide)/len(seq) for nucleotide in 'ATCG'}
+    __slots__ = ('qname','flag','mapq','soft_clipped','reference_start','next_reference_start','query_length',
+                 'read_end','cigar_start','cigar_end','sa','sa_score','sc_len','sc_codes','sc_bases','sc_qual','index')
 
+    def __init__(self,read,soft_clipped):
 
+        self.qname = read.qname
+        self.flag = read.flag
+        self.mapq = read.mapq
+        self.soft_clipped = soft_clipped
+        self.reference_start = read.reference_start
 
+        for field in ('next_reference_start','query_length','read_end','cigar_start','cigar_end','sa','sa_score',
+                      'sc_len','sc_codes','sc_bases','sc_qual','index'):
+            setattr(self,field,None)
 
+    @property
+    def is_reverse(self):
+        return(bool(self.flag & 0x10))
 
-def realign(read,n_hits,plus_strand,minus_strand,plus_base_freqs,minus_base_freqs,gap_open,gap_extend,verbose,max_edit):
+    @property
+    def mate_is_reverse(self):
+        return(bool(self.flag & 0x20))
 
+    @property
+    def is_read2(self):
+        return(bool(self.flag & 0x80))
 
-    """Function that takes as input a read, the number of hits to find and the plus and minus strand and will return
-    the number of hits, the sequencing qualities for that read and the g+c content of the realignment interval"""
 
+def get_peak_reads(ecc_dna,interval,mapq_cutoff,alignments=None):
+    """Function that takes as input the circle bam, a peak interval and the mapping quality cut-off and returns the
+    reads of the peak as a list of peak_read records. The CIGAR ends, the supplementary alignment fields, the mate
+    information and the longest soft-clipped part of the read (with its base qualities) are computed once, so that every
+    mate interval of the peak can be evaluated without touching the bam file again. If a list of alignments is passed,
+    the pysam reads are appended to it and every record stores its index in the list"""
 
-    #get soft-clipped read
-    soft_clipped_read = get_longest_soft_clipped_bases(read)
+    batch = []
 
-    #encoding of DNA and operations A,T,C,G,=,X,DI. THis is done for Numba
-    nuc_and_ops =  np.array([1,2,3,4,5,6,7])
-    encoded_nucs = number_encoding(soft_clipped_read['seq'])
+    for read in ecc_dna.fetch(interval['chrom'],int(interval['start']),int(interval['end'])):
 
-    hits = 0
+        if is_soft_clipped(read):
+
+            record = peak_read(read,True)
 
-    min_score = len(soft_clipped_read['seq'])
+            # the mapping quality filter is applied before anything is computed
+            if read.mapq >= mapq_cutoff:
 
+                record.cigar_start = int(read.cigar[0][0])
+                record.cigar_end = int(read.cigar[-1][0])
+                record.read_end = rightmost_from_read(read)
 
-    top_hits = {}
+                if read.has_tag('SA'):
+                    # [chr,left_most start,strand,CIGAR,mapq, edit_distance]
+                    record.sa = [x.strip() for x in read.get_tag('SA').split(',')]
 
+                soft_clipped_read = get_longest_soft_clipped_bases(read)
+                if soft_clipped_read is not None:
 
-    if read.is_reverse:
+                    record.sc_codes = np.frombuffer(soft_clipped_read['seq'].encode(), dtype=np.uint8)
+                    record.sc_bases = BASE_CODES[record.sc_codes]
+                    record.sc_qual = np.array(soft_clipped_read['qual'], dtype=np.uint8)
+                    record.sc_len = len(soft_clipped_read['seq'])
 
-        while hits < n_hits and min_score >= -10:
+                    if record.sa != None:
+                        record.sa_score = record.sc_len * (
+                                1 - phred_to_prob(np.array(int(record.sa[4]), dtype=np.float64)))
 
-            alignment = edlib.align(soft_clipped_read['seq'], minus_strand, mode='HW', task='path')
-            if hits ==0:
-                if alignment['editDistance'] > max_edit:
-                    return(None)
+        else:
+            record = peak_read(read,False)
+            record.next_reference_start = read.next_reference_start
+            record.query_length = read.infer_query_length()
 
+        if alignments is not None:
+            record.index = len(alignments)
+            alignments.append(read)
 
+        batch.append(record)
 
-            for location in alignment['locations']:
+    return(batch)
 
 
+def background_freqs(seq):
+    """Function that takes as input the sequence of the nucletide frequencies in the realignment interval"""
 
-                mask_bases = 'X' * ( location[1] - location[0])
+    return{nucleotide: seq.count(nucleotide)/len(seq) for nucleotide in 'ATCG'}
 
 
-                minus_strand = minus_strand[:location[0]] + mask_bases + minus_strand[location[1]:]
 
-                hits += 1
 
 
-                score = pssm(phred_to_prob(np.array(soft_clipped_read['qual'],dtype=np.float64)), encoded_nucs,
-                             edlib_cigar_to_iterable(alignment['cigar']),minus_base_freqs,gap_open,gap_extend,nuc_and_ops,verbose)
+@jit(nopython=True, cache=True)
+def popcount(word):
+    """Function that returns the number of bits set in a 64 bit word"""
 
-                if score < min_score:
-                    min_score = score
+    count = 0
+    while word:
+        word &= word - np.uint64(1)
+        count += 1
+    return(count)
 
 
-                top_hits[hits] = (location,alignment['cigar'],score,alignment['editDistance'],"-")
+@jit(nopython=True, cache=True)
+def myers_end_distances(query,text):
+    """Function that takes as input the query and the text as arrays of characters and returns, for every position of
+    the text, the edit distance of the best alignment of the whole query ending there (edlib HW mode). The text is
+    scanned once with the Myers bit-vector algorithm, with one 64 bit word for every 64 bases of the query"""
 
-        else:
-            # the search was exaustive
-            hits +=n_hits
+    one = np.uint64(1)
+    high_bit = one << np.uint64(63)
+
+    query_length = len(query)
+    blocks = (query_length + 63) // 64
+
+    #match bit-vectors of every character
+    peq = np.zeros((256, blocks), dtype=np.uint64)
+    for i in range(query_length):
+        peq[query[i], i // 64] |= one << np.uint64(i % 64)
 
+    #vertical deltas and the score of the last row of every block. The first column is 0,1,2... (global on the query)
+    pv = np.zeros(blocks, dtype=np.uint64)
+    mv = np.zeros(blocks, dtype=np.uint64)
+    score = np.zeros(blocks, dtype=np.int64)
+    for block in range(blocks):
+        pv[block] = ~np.uint64(0)
+        score[block] = (block + 1) * 64
+
+    #rows of the last block past the end of the query
+    last = blocks - 1
+    rows = query_length - last * 64
+    if rows < 64:
+        padding = ~np.uint64(0) << np.uint64(rows)
     else:
-        #min socre stops the search if the score is orders of magnitude smaller that the top score given the edit
-        #distance
-        while hits < n_hits and min_score >= -10:
+        padding = np.uint64(0)
 
+    distances = np.zeros(len(text), dtype=np.int64)
 
+    for j in range(len(text)):
 
-            alignment = edlib.align(soft_clipped_read['seq'], plus_strand, mode='HW', task='path')
-            #stop search if edit distance is to high
-            if hits ==0:
-                if alignment['editDistance'] > max_edit:
-                    return (None)
+        #the first row is 0 for every column, the alignment can start anywhere in the text
+        hin = 0
 
+        for block in range(blocks):
 
-            for location in alignment['locations']:
+            eq = peq[text[j], block]
+            p = pv[block]
+            m = mv[block]
 
-                mask_bases = 'X' * ( location[1] - location[0])
+            xv = eq | m
+            if hin < 0:
+                eq |= one
+            xh = (((eq & p) + p) ^ p) | eq
+            ph = m | ~(xh | p)
+            mh = p & xh
 
-                plus_strand = plus_strand[:location[0]] + mask_bases + plus_strand[location[1]:]
+            hout = 0
+            if ph & high_bit:
+                hout = 1
+            elif mh & high_bit:
+                hout = -1
 
-                hits += 1
+            ph = ph << one
+            mh = mh << one
+            if hin < 0:
+                mh |= one
+            elif hin > 0:
+                ph |= one
 
-                score = pssm(phred_to_prob(np.array(soft_clipped_read['qual'],dtype=np.float64)), encoded_nucs,
-                             edlib_cigar_to_iterable(alignment['cigar']), plus_base_freqs,gap_open,gap_extend,nuc_and_ops,verbose)
+            pv[block] = mh | ~(xv | ph)
+            mv[block] = ph & xv
+            score[block] += hout
+            hin = hout
 
-                if score < min_score:
-                    min_score = score
+        distances[j] = score[last] - popcount(pv[last] & padding) + popcount(mv[last] & padding)
 
-                top_hits[hits] = (location,alignment['cigar'],score,alignment['editDistance'],"+")
+    return(distances)
 
-        else:
 
-            hits +=n_hits
+def hit_traceback(query,text,end,edit_distance):
+    """Function that takes as input the query, the text and the end position and edit distance of a hit and returns
+    the start of the hit and its edlib cigar. As edlib does in HW mode, the start is the leftmost one of the reversed
+    query aligned to the reversed text in prefix mode, and the path is computed from there. Both alignments are only
+    computed in the window that can hold the hit"""
 
+    import edlib
 
+    window_start = max(0, end + 1 - len(query) - edit_distance)
 
+    starts = edlib.align(query[::-1].tobytes(), text[window_start:end + 1][::-1].tobytes(), mode='SHW',
+                         task='locations', k=edit_distance)
+    start = end - starts['locations'][-1][1]
 
-    return({'alignments':top_hits,'mapq_prior': soft_clipped_read['mapq']})
+    alignment = edlib.align(query.tobytes(), text[start:end + 1].tobytes(), mode='NW', task='path')
 
+    return(start, alignment['cigar'])
 
-def edlib_cigar_to_iterable(edlib_cigar):
-    """Function that takes as input the edlib cigar and parses it to get it in a iterable manner"""
-    #encoding of DNA and operations A,T,C,G,=,X,ID
-    #nuc_and_ops =  np.array([1,2,3,4,5,6,7])
 
-    length = []
-    operations = []
+def qgram_codes(sequence,q):
+    """Function that takes as input a sequence as an array of characters and returns the 2-bit code of every q-gram
+    and whether the q-gram is made only of A,C,G,T"""
+
+    bases = QGRAM_BASES[sequence]
+    n_qgrams = len(sequence) - q + 1
+
+    if n_qgrams <= 0:
+        return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
 
-    for i in re.findall(r'\d+[IDX=]',edlib_cigar):
-        length.append(int(i[0]))
-        if i[1] == '=':
-            operations.append(5)
-        elif i[1] == 'X':
-            operations.append(6)
-        elif i[1] == 'I' or 'D':
-            operations.append(7)
+    codes = np.zeros(n_qgrams, dtype=np.int64)
+    for offset in range(0, q):
+        codes = (codes << 2) | (bases[offset:offset + n_qgrams] & 3)
 
+    ambiguous = np.concatenate(([0], np.cumsum(bases > 3)))
+    valid = (ambiguous[q:] - ambiguous[:n_qgrams]) == 0
 
-    return(np.array(length),np.array(operations))
+    return(codes, valid)
 
 
-@jit(nopython=True)
-def pssm(seq_prob,seq_nucl,iterable_cigar,base_freqs,gap_open,gap_extend,nuc_and_ops,verbose):
-    """Function that takes as input the sequencing probabilities and cigar string and returns the log2 pssm of the read"""
+def build_seed_index(text):
+    """Function that takes as input the realignment interval as an array of characters and returns its q-gram index:
+    the q-gram codes sorted, and the interval position of every one of them"""
 
+    codes, valid = qgram_codes(text, SEED_LENGTH)
+    positions = np.flatnonzero(valid)
+    order = np.argsort(codes[positions], kind='mergesort')
 
+    return({'codes': codes[positions][order], 'positions': positions[order], 'length': len(text)})
 
 
+def interval_seeds(realignment_interval,reverse):
+    """Function that takes as input the cache entry of a realignment interval and the strand, and returns the q-gram
+    index of the strand. The index is built once and kept on the cache entry"""
 
-    #start positon to operate in the pssm. This is done to iterate over the operations in the cigar, and keep track of
-    # were I am in the seq and quality values
-    seq_pos = 0
-    indel_penalty = 0
+    strand = 'minus' if reverse else 'plus'
 
+    if '%s_seeds' % strand not in realignment_interval:
+        realignment_interval['%s_seeds' % strand] = build_seed_index(realignment_interval['%s_codes' % strand])
 
+    return(realignment_interval['%s_seeds' % strand])
 
-    #iterate trough CIGAR operations
-    for index in range(0,len(iterable_cigar[0])):
 
-        operation_length = iterable_cigar[0][index]
-        end = operation_length + seq_pos
+def seed_filter(query,seeds,max_edit):
+    """Function that takes as input the soft-clipped read as an array of characters, the q-gram index of the
+    realignment interval and the edit distance allowed, and applies the q-gram lemma: an alignment of the read with k
+    edits shares at least len(read) + 1 - q(k+1) q-grams with the interval. Returns False if the read can not be
+    realigned with k edits. Reads that pass are realigned to the whole interval, as the hits after the best one can
+    have more edits and lie away from the seeds"""
 
+    k = int(max_edit)
+    threshold = len(query) + 1 - SEED_LENGTH * (k + 1)
 
+    # the lemma does not hold any information for short reads or lots of edits
+    if threshold <= 0:
+        return(True)
+
+    codes, valid = qgram_codes(query, SEED_LENGTH)
 
-        operation = iterable_cigar[1][index]
+    first = np.searchsorted(seeds['codes'], codes, side='left')
+    last = np.searchsorted(seeds['codes'], codes, side='right')
+    found = valid & (last > first)
 
+    # q-grams with ambiguous bases might match, and count as shared
+    return(np.count_nonzero(found) + np.count_nonzero(~valid) >= threshold)
 
-        #match, 1 minus prob(base called wrong)
-        if operation == nuc_and_ops[4]:
 
-            for nucleotide in range(seq_pos,end):
+def realign(read,n_hits,plus_strand,minus_strand,plus_base_freqs,minus_base_freqs,gap_open,gap_extend,verbose,max_edit):
+
 
-                if seq_nucl[nucleotide] == nuc_and_ops[0]:
+    """Function that takes as input a read from the peak batch, the number of hits to find and the plus and minus strand
+    (as arrays of characters) and will return the number of hits, the sequencing qualities for that read and the g+c
+    content of the realignment interval"""
 
-                    seq_prob[nucleotide] = np.log2((1 - (seq_prob[nucleotide]))/base_freqs[0])
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[1]:
+    #the soft-clipped part of the read is decoded once for the peak
+    if read.is_reverse:
+        strand = minus_strand
+        base_freqs = minus_base_freqs
+        orientation = "-"
+    else:
+        strand = plus_strand
+        base_freqs = plus_base_freqs
+        orientation = "+"
+
+    log2_base_freqs = np.log2(base_freqs)
+
+    if len(strand) == 0:
+        return(None)
+
+    #edit distance of the best alignment ending at every position of the interval
+    distances = myers_end_distances(read.sc_codes, strand)
+
+    #positions that are not covered by a reported hit
+    available = np.ones(len(distances), dtype=bool)
+
+    hits = 0
 
-                    seq_prob[nucleotide] = np.log2((1 - (seq_prob[nucleotide])) / base_freqs[1])
+    min_score = read.sc_len
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[2]:
 
-                    seq_prob[nucleotide] = np.log2((1 - (seq_prob[nucleotide])) / base_freqs[2])
+    top_hits = {}
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[3]:
+    #min socre stops the search if the score is orders of magnitude smaller that the top score given the edit
+    #distance
+    while hits < n_hits and min_score >= -10 and available.any():
 
-                    seq_prob[nucleotide] = np.log2((1 - (seq_prob[nucleotide])) / base_freqs[3])
+        # every round reports all the hits with the best edit distance left
+        edit_distance = int(distances[available].min())
 
+        #stop search if edit distance is to high
+        if hits == 0:
+            if edit_distance > max_edit:
+                return(None)
 
+        locations = []
+        cigars = []
+        for end in np.flatnonzero(available & (distances == edit_distance)):
 
-            seq_pos += operation_length
+            start, cigar = hit_traceback(read.sc_codes, strand, int(end), edit_distance)
 
+            # the hit is taken out of the search
+            available[max(start, 0):end + len(read.sc_codes)] = False
 
+            locations.append((start, int(end)))
+            cigars.append(cigar)
 
-        elif operation == nuc_and_ops[5]:
+        #all the hits of the round are scored at once
+        scores = pssm(read.sc_qual, read.sc_bases, *edlib_cigar_to_iterable(cigars),
+                      log2_base_freqs, gap_open, gap_extend)
 
+        for location, cigar, score in zip(locations, cigars, scores):
 
-            for nucleotide in range(seq_pos,end):
+            hits += 1
 
-                if seq_nucl[nucleotide] == nuc_and_ops[0]:
+            if score < min_score:
+                min_score = score
 
-                    seq_prob[nucleotide] = np.log2(
-                        (seq_prob[nucleotide]/3)/base_freqs[0])
+            top_hits[hits] = (location, cigar, float(score), edit_distance, orientation)
 
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[1]:
+    return({'alignments':top_hits,'mapq_prior': read.mapq})
 
-                    seq_prob[nucleotide] = np.log2(
-                        (seq_prob[nucleotide]/3)/base_freqs[1])
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[2]:
+def edlib_cigar_to_iterable(edlib_cigars):
+    """Function that takes as input a list of edlib cigars and parses them into arrays that can be used with numba: the
+    length and the operation of every element and the offset of the first element of every cigar"""
 
-                    seq_prob[nucleotide] = np.log2(
-                        (seq_prob[nucleotide]/3)/base_freqs[2])
+    length = []
+    operations = []
+    offsets = [0]
 
+    for edlib_cigar in edlib_cigars:
+        for count, operation in re.findall(r'(\d+)([IDX=])', edlib_cigar):
+            length.append(int(count))
+            operations.append(CIGAR_OPERATIONS[operation])
+        offsets.append(len(length))
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[3]:
+    return(np.array(length, dtype=np.int64), np.array(operations, dtype=np.int64), np.array(offsets, dtype=np.int64))
 
-                    seq_prob[nucleotide] = np.log2(
-                        (seq_prob[nucleotide]/3)/base_freqs[3])
 
+@jit(nopython=True, nogil=True, cache=True)
+def pssm(quals,bases,lengths,operations,offsets,log2_base_freqs,gap_open,gap_extend):
+    """Function that takes as input the base qualities and bases of a read, the parsed cigars of its hits and the log2
+    background frequencies of the realignment interval and returns the log2 pssm score of every hit. Ambiguous bases
+    score 0"""
 
+    scores = np.zeros(len(offsets) - 1)
 
+    for hit in range(len(offsets) - 1):
 
-                elif seq_nucl[nucleotide] == nuc_and_ops[6]:
+        #position in the read
+        seq_pos = 0
+        score = 0.0
+        indel_penalty = 0.0
 
-                    if verbose < 2:
+        for index in range(offsets[hit], offsets[hit + 1]):
 
-                        seq_prob[nucleotide] = 0
-                        print("Warning:Ambiguous base found in nucleotide sequence. Assigning score of 0 in the log2 pssm")
+            operation_length = lengths[index]
+            operation = operations[index]
 
-            seq_pos += operation_length
+            #match, 1 minus prob(base called wrong)
+            if operation == 0:
+                for nucleotide in range(seq_pos, seq_pos + operation_length):
+                    if bases[nucleotide] < 4:
+                        score += MATCH_LOG2[quals[nucleotide]] - log2_base_freqs[bases[nucleotide]]
+                seq_pos += operation_length
 
+            #mismatch, prob(base called wrong)/3
+            elif operation == 1:
+                for nucleotide in range(seq_pos, seq_pos + operation_length):
+                    if bases[nucleotide] < 4:
+                        score += MISMATCH_LOG2[quals[nucleotide]] - log2_base_freqs[bases[nucleotide]]
+                seq_pos += operation_length
 
-        elif operation == nuc_and_ops[6]:
+            #affine gap scoring model. Insertions consume the read, deletions do not
+            elif operation == 2:
+                indel_penalty += gap_open + gap_extend * (operation_length - 1)
+                seq_pos += operation_length
 
-            #affine gap scoring model
-            indel_penalty += gap_open + gap_extend*(operation_length-1)
+            else:
+                indel_penalty += gap_open + gap_extend * (operation_length - 1)
 
+        scores[hit] = score - indel_penalty
 
-    return(np.sum(seq_prob)-indel_penalty)
+    return(scores)
 
 
 def realignment_probability(hit_dict,interval_length):
@@ -1106,9 +1515,11 @@ def realignment_probability(hit_dict,interval_length):
 
     best_hit = hit_dict['alignments'][1][2]
 
-    #this might be included on the denominator
+    #this might be included on the denominator. Log-sum-exp, so that long reads do not overflow
 
-    posterior = 2**best_hit/(np.sum((2**value[2]) for key,value in hit_dict['alignments'].items()))
+    scores = np.array([value[2] for key,value in hit_dict['alignments'].items()], dtype=np.float64)
+
+    posterior = 2**(best_hit - np.logaddexp2.reduce(scores))
 
     return(posterior)
 
@@ -1141,6 +1552,8 @@ def fraction(start1,start2,end1,end2,read1,read2):
 def merge_fraction(chrom1,x1,x2,chrom2,y1,y2):
     """compute overlap (reciprocal) of the interval y over interval x"""
 
+    import pandas as pd
+
     distance = (np.minimum(x2.values,y2.values) - np.maximum(x1.values,y1.values))
 
 
@@ -1154,70 +1567,137 @@ def merge_fraction(chrom1,x1,x2,chrom2,y1,y2):
     return(pd.Series(chrom1 == chrom2) + pd.Series(two_overlap_one.clip(0)) + pd.Series(one_overlap_two.clip(0)))
 
 
-def iteration_merge(only_discordants,results,fraction,splits,score,sc_len,bam,af,insert,std,n_discordant):
-    """finction that merges the results of every iteration and filters the data by allele frequency"""
+# breakpoints closer than this are resolved by a single fetch
+DEPTH_FETCH_GAP = 1000
 
-    norm_fraction = 3
 
-    parsed_discordants = []
-    for interval in only_discordants:
-        interval.append(0)
-        parsed_discordants.append(interval)
+def breakpoint_depth(bam,positions,index=None):
+    """Function that takes as input a coordinate sorted bam and a list of (contig,position) tuples, and returns a
+    dictionary with the number of reads overlapping every position, as bam.count(read_callback='nofilter') would do.
+    The positions are read from the depth index of the bam if it is given, and are otherwise sorted and resolved with a
+    single forward sweep over every group of nearby positions. Contigs that can not be fetched are left out of the
+    dictionary"""
+
+    depth = {}
+
+    by_contig = {}
+    for contig, position in positions:
+        by_contig.setdefault(contig, set()).add(position)
+
+    for contig, contig_positions in by_contig.items():
+
+        sorted_positions = np.array(sorted(contig_positions), dtype=np.int64)
+
+        if index is not None:
+            try:
+                depth.update(zip(zip(it.repeat(contig), sorted_positions.tolist()),
+                                 index.depth(contig, sorted_positions).tolist()))
+                continue
+            except ValueError:
+                pass
+        first = np.flatnonzero(np.concatenate(([True], np.diff(sorted_positions) > DEPTH_FETCH_GAP)))
+        last = np.append(first[1:], len(sorted_positions))
 
+        try:
+            contig_depth = np.zeros(len(sorted_positions), dtype=np.int64)
+            for begin, finish in zip(first, last):
+                window = sorted_positions[begin:finish]
+                read_starts = []
+                read_ends = []
+                for read in bam.fetch(contig=contig, start=int(window[0]), stop=int(window[-1]) + 1):
+                    read_starts.append(read.reference_start)
+                    # htslib gives unmapped reads and reads without reference bases a span of one
+                    read_end = read.reference_end
+                    read_ends.append(read.reference_start + 1 if read_end is None or read_end <= read.reference_start
+                                     else read_end)
 
-    discordant_bed = bt.BedTool(parsed_discordants)
+                # every read adds one to the positions of the window within [start,end)
+                coverage = np.zeros(len(window) + 1, dtype=np.int64)
+                np.add.at(coverage, np.searchsorted(window, read_starts, side='left'), 1)
+                np.add.at(coverage, np.searchsorted(window, read_ends, side='left'), -1)
+                contig_depth[begin:finish] = np.cumsum(coverage)[:-1]
 
+        except (ValueError, KeyError):
+            continue
 
+        depth.update(zip(zip(it.repeat(contig), sorted_positions.tolist()), contig_depth.tolist()))
 
+    return(depth)
 
 
-    unparsed_pd = pd.DataFrame.from_records(results,
-        columns=['chrom', 'start', 'end', 'read', 'iteration','score', 'discordants'])
+def iteration_merge(only_discordants,results,fraction,splits,score,sc_len,bam,af,insert,std,n_discordant,depth_index=None):
+    """finction that merges the results of every iteration and filters the data by allele frequency"""
 
-    unparsed_pd = unparsed_pd.sort_values(['iteration','chrom','start','end']).reset_index()
+    norm_fraction = 3
 
+    allele_free = []
 
-    grouped = unparsed_pd.groupby(merge_fraction(unparsed_pd.iteration.shift(), unparsed_pd.start.shift(),
-                                           unparsed_pd.end.shift(), unparsed_pd.iteration,
-                                           unparsed_pd.start,
-                                           unparsed_pd.end).lt(norm_fraction).cumsum()).agg(
-        {'chrom': 'first', 'start': 'min', 'end': 'max', 'discordants': 'max', 'read': 'sum','score':'sum'})
+    if len(results) > 0:
 
-    bedtool_output = bt.BedTool.from_dataframe(grouped)
+        order = np.lexsort((results['end'], results['start'], results['chrom'], results['iteration']))
+        chrom = results['chrom'][order]
+        start = results['start'][order].astype(np.int64)
+        end = results['end'][order].astype(np.int64)
+        iteration = results['iteration'][order]
 
+        # same as merge_fraction over consecutive intervals, but with the iteration instead of the chromosome
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = (np.minimum(end[:-1], end[1:]) - np.maximum(start[:-1], start[1:])).astype(np.float64)
+            one_overlap_two = distance / (end[1:] - start[1:])
+            two_overlap_one = distance / (end[:-1] - start[:-1])
+            overlap = (iteration[:-1] == iteration[1:]) + np.clip(two_overlap_one, 0, None) + \
+                      np.clip(one_overlap_two, 0, None)
 
+        first = np.flatnonzero(np.concatenate(([True], overlap < norm_fraction)))
 
+        grouped = zip(chrom[first].tolist(), np.minimum.reduceat(start, first).tolist(),
+                      np.maximum.reduceat(end, first).tolist(),
+                      np.maximum.reduceat(results['discordants'][order], first).tolist(),
+                      np.add.reduceat(results['read'][order].astype(np.int64), first).tolist(),
+                      np.add.reduceat(np.round(results['score'][order].astype(np.float64), 2), first).tolist())
 
+        for contig, circle_start, circle_end, discordants, reads, circle_score in grouped:
+            allele_free.append([results.contigs[contig], circle_start, circle_end, discordants, reads, circle_score])
+
+    for contig, discordant_start, discordant_end, reads in zip(only_discordants['chrom'].tolist(),
+                                                               only_discordants['start'].tolist(),
+                                                               only_discordants['end'].tolist(),
+                                                               only_discordants['read'].tolist()):
+        allele_free.append([only_discordants.contigs[contig], discordant_start, discordant_end, reads, 0, 0])
+
+    # the coverage at both breakpoints of every candidate passing the read filters is resolved in one sweep
+    breakpoints = []
+    for interval in allele_free:
+        if (int(interval[4]) != 0 and int(interval[4]) >= splits and float(interval[5]) > score) or \
+                (int(interval[4]) == 0 and int(interval[3]) >= n_discordant):
+            breakpoints.append((interval[0], int(interval[1])))
+            breakpoints.append((interval[0], int(interval[2]) - 1))
 
+    depth = breakpoint_depth(bam, breakpoints, depth_index)
+
+    def count(contig, position):
+        if (contig, position) in depth:
+            return(depth[(contig, position)])
+        return(bam.count(contig=contig, start=position, stop=position + 1, read_callback='nofilter'))
 
-    allele_free = bedtool_output.cat(discordant_bed, postmerge=False)
     write = []
 
     for interval in allele_free:
         try:
             if int(interval[4]) != 0:
                 if (int(interval[4])) >= splits and float(interval[5]) > score:
-                    start_cov = bam.count(contig=interval[0],
-                                                   start=int(interval[1]), stop=int(interval[1])+1
-                                                   ,read_callback='nofilter')
-
-                    end_cov = bam.count(contig=interval[0],
-                                                 start=int(interval[2])-1, stop=int(interval[2])
-                                                 ,read_callback='nofilter')
-
+                    start_cov = count(interval[0], int(interval[1]))
 
+                    end_cov = count(interval[0], int(interval[2]) - 1)
 
                     circle_af = ((int(interval[4]) * 2)) / ((start_cov+end_cov+0.01)/2)
                     if circle_af >=af:
                         write.append(interval)
             else:
                 if int(interval[3]) >= n_discordant:
-                        start_cov = bam.count(contig=interval[0],start=int(interval[1]), stop=int(interval[1]) + 1,
-                                                   read_callback='nofilter')
+                        start_cov = count(interval[0], int(interval[1]))
 
-                        end_cov = bam.count(contig=interval[0],
-                                                 start=int(interval[2]) - 1, stop=int(interval[2]),
-                                                 read_callback='nofilter')
+                        end_cov = count(interval[0], int(interval[2]) - 1)
 
                         circle_af = (int(interval[3])) / ((start_cov+end_cov+0.01)/2)
 
@@ -1227,7 +1707,7 @@ def iteration_merge(only_discordants,results,fraction,splits,score,sc_len,bam,af
             print(e)
             pass
 
-    return(bt.BedTool(write))
+    return(write)
 
 
 
@@ -1238,6 +1718,8 @@ def merge_final_output(bam,results,begin,splits,dir,fraction,pid):
     """Function that takes as input the final results, and merge reciprocal intervals (this is done to combine the output
     of different clusters)"""
 
+    import pybedtools as bt
+
 
 
     bam = ps.AlignmentFile(bam, "rb")
@@ -1246,20 +1728,11 @@ def merge_final_output(bam,results,begin,splits,dir,fraction,pid):
     # multiply *2 for reciprocal overlap +1 to check chromosome
     norm_fraction = (fraction*2)+1
 
-    unparsed_bed = bt.BedTool(os.path.basename(results))
-
-
-
-
     print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),"Writting final output to disk")
 
+    # the shards of all the processes, merged in genomic order
+    second_merging_round = read_shards(results)
 
-    unparsed_pd = unparsed_bed.to_dataframe(
-        names=['chrom', 'start', 'end', 'discordants', 'sc','score'])
-
-
-
-    second_merging_round = unparsed_pd.sort_values(['chrom', 'start', 'end']).reset_index()
     #merge the output
     # merge_fraction calculates the degree of overlap between the two genomic intervals
     #lt(norm_freaction) looks the ones that surpass the merging threshold (returns 0 if true, 1 if not)
@@ -1302,23 +1775,75 @@ def merge_final_output(bam,results,begin,splits,dir,fraction,pid):
     return(filtered_output)
 
 
-def write_to_disk(partial_bed,output,locker,dir,pid):
+def shard_name(output,dir,pid):
+    """Function that returns the name of the output shard of the calling process. Every process of the realignment pool
+    appends its results to its own shard, so no lock is needed"""
 
-    """function that writes to disk the results of every worker thread"""
+    return("%s/temp_files_%s/%s.%s" % (dir,pid,os.path.basename(output),os.getpid()))
 
 
-    locker.acquire()
-    os.chdir("%s/temp_files_%s/" % (dir,pid))
-    output_bed = bt.BedTool('%s' % os.path.basename(output))
-    writer_bed = output_bed.cat(partial_bed,postmerge=False)
-    writer_bed.saveas('%s' % os.path.basename(output))
-    os.chdir("%s" % dir)
-    locker.release()
+def write_to_disk(partial_bed,output,dir,pid):
+
+    """function that appends to disk the results of every worker thread"""
+
+    with open(shard_name(output,dir,pid), 'a') as shard:
+        for interval in partial_bed:
+            shard.write("\t".join([str(field) for field in interval]) + "\n")
+
+
+def shard_row(line):
+    """Function that takes as input a line of a shard and returns its chromosome, start, end, discordant reads, split
+    reads and score"""
+
+    fields = line.rstrip("\n").split("\t")
+    return((fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]), float(fields[5])))
+
+
+def sort_shard(shard):
+    """Function that takes as input a shard and sorts its lines by chromosome, start and end. The processes append the
+    results of chunks from anywhere in the genome, so the shards are sorted once the realignment has finished"""
+
+    with open(shard) as lines:
+        rows = sorted(lines, key=lambda line: shard_row(line)[:3])
+
+    with open(shard, 'w') as lines:
+        lines.writelines(rows)
+
+
+def read_shards(output):
+    """Function that takes as input the output name and reads the shards written by the realignment processes to the
+    working directory into a single dataframe sorted by chromosome, start and end. Every shard is sorted on its own,
+    and the sorted shards are streamed through a k-way merge"""
+
+    import pandas as pd
+
+    names = ['chrom', 'start', 'end', 'discordants', 'sc', 'score']
+
+    shards = [shard for shard in sorted(glob.glob("%s.*" % os.path.basename(output))) if os.path.getsize(shard) > 0]
+
+    if len(shards) == 0:
+        return(pd.DataFrame(columns=names))
+
+    for shard in shards:
+        sort_shard(shard)
+
+    handles = [open(shard) for shard in shards]
+
+    # the merge is stable, so equal intervals keep the order of the shards
+    rows = heapq.merge(*[map(shard_row, handle) for handle in handles], key=lambda row: row[:3])
+    merged = pd.DataFrame.from_records(rows, columns=names)
+
+    for handle in handles:
+        handle.close()
+
+    return(merged)
 
 def start_realign(circle_bam,output,threads,verbose,pid,clusters):
     """Function that start the realigner function
         - Splits the clusters to cores and removes the from disk the bedtools intermediates"""
 
+    import pybedtools as bt
+
     begin = time.time()
 
     print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),"Realigning reads using Circle-Map\n")
@@ -1331,21 +1856,17 @@ def start_realign(circle_bam,output,threads,verbose,pid,clusters):
     sp.call("mkdir temp_files_%s" % pid, shell=True)
 
 
-    sorted_bam,splitted = bam_circ_sv_peaks(eccdna_bam,circle_bam,threads,verbose,pid,clusters)
+    sorted_bam,splitted,chunk_costs = bam_circ_sv_peaks(eccdna_bam,circle_bam,threads,verbose,pid,clusters)
 
 
 
 
     # split to cores
     print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),"Splitting clusters to to processors\n")
-    os.chdir("temp_files_%s" % pid)
-    sp.call("touch %s" % os.path.basename(output), shell=True)
-    os.chdir("../")
-
     #this releases from tmp file the unmerged and peak file
     bt.cleanup()
 
-    return(splitted,sorted_bam,begin)
+    return(splitted,sorted_bam,begin,chunk_costs)
 
 def start_simulate(pid):
     """Function for starting Circle-Map simulate"""
@@ -1376,28 +1897,71 @@ def mutate(genome,pid,indel,snp,java_mem):
 
 
 
-def check_size_and_write(results,only_discortants,output,lock,directory,fraction,pid):
-    """Function that checks if the intervals in memory are to big. And writes them to disk to release memory."""
+def check_size_and_write(results,only_discortants,max_memory,output,directory,fraction,splits,score,sc_len,bam,af,
+                         insert,std,n_discordant,pid,depth_index=None):
+    """Function that checks if the evidence buffers have allocated more than max_memory bytes. If they have, the
+    intervals are merged and written to disk to release memory"""
 
 
-    if sys.getsizeof(results) < 100000000:
+    if results.nbytes() + only_discortants.nbytes() < max_memory:
         return(False)
 
 
     else:
 
-        partial_bed = iteration_merge(only_discortants, results,fraction)
+        partial_bed = iteration_merge(only_discortants,results,fraction,splits,score,sc_len,bam,af,insert,std,
+                                      n_discordant,depth_index)
 
         print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),"Writting %s circular intervals to disk" % len(partial_bed))
-        write_to_disk(partial_bed,output,lock,directory,pid)
+        write_to_disk(partial_bed,output,directory,pid)
 
         return(True)
 
+
+def report_memory(chunk_stats):
+    """Function that takes as input the statistics returned by the realignment workers and prints the peak resident
+    memory of every worker and how many times they spilled their results to disk"""
+
+    peak_rss = {}
+    spills = {}
+    for stats in chunk_stats:
+        peak_rss[stats['pid']] = max(peak_rss.get(stats['pid'], 0), stats['max_rss'])
+        spills[stats['pid']] = spills.get(stats['pid'], 0) + stats['spills']
+
+    for pid in sorted(peak_rss):
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "Realignment worker %s: peak memory %s MB, %s spills to disk" % (pid, round(peak_rss[pid] / 1024, 1),
+                                                                             spills[pid]))
+
+
+def report_latency(warm_up,launch,pool_start,first_result,chunk_stats):
+    """Function that takes as input the seconds spent warming up the numba kernels, the times when Realign started, when
+    the pool started and when the first chunk came back, and the statistics returned by the realignment workers. It
+    prints the startup latency and how much longer the first chunk of every worker took than the median chunk"""
+
+    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+          "Startup latency: numba kernels ready in %s s, pool started %s s after launch, first chunk back %s s after "
+          "the pool started" % (round(warm_up, 2), round(pool_start - launch, 2), round(first_result - pool_start, 2)))
+
+    # the chunks of every worker come back in the order the worker processed them
+    first_chunks = {}
+    for stats in chunk_stats:
+        first_chunks.setdefault(stats['pid'], stats['time'])
+
+    if len(chunk_stats) > 0:
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S:"),
+              "First chunk latency: %s s on average across %s workers, median chunk %s s" % (
+                  round(np.mean(list(first_chunks.values())), 3), len(first_chunks),
+                  round(np.median([stats['time'] for stats in chunk_stats]), 3)))
+
 def merge_coverage_bed(results,frac,number):
 
     """Function that takes as bed file containing the coordinates of the double mapped reads and
     returns the merged bed file containing the information about the clusters"""
 
+    import pandas as pd
+    import pybedtools as bt
+
     fraction = (frac*2)+1
 
     unparsed_pd = pd.DataFrame.from_records(results,columns=['chrom', 'start', 'end','item'])
@@ -1435,6 +1999,8 @@ def filter_by_ratio(eccdna_bed,cutoff):
     """Function that takes as input the eccDNA bed and returns the data filtered by tha change at the start and the end
     """
 
+    import pandas as pd
+
     #circle list is a shared memory object
     circle_list = []
     unparsed_pd = eccdna_bed.to_dataframe(
@@ -1462,50 +2028,140 @@ def merge_bed(discordants_pd):
     #if both bools are succesful returns a 2
     return ((overlap * 1 + chr_overlap * 1).lt(2).cumsum())
 
+def group_starts(*keys):
+    """Function that takes as input sorted key arrays and returns a boolean array that is True where a new group of
+    equal keys starts"""
+
+    new_group = np.ones(len(keys[0]), dtype=bool)
+    if len(keys[0]) > 0:
+        new_group[1:] = False
+        for key in keys:
+            new_group[1:] |= key[1:] != key[:-1]
+
+    return(new_group)
+
+
+# contigs are packed with the coordinates into a single key, so that windows never span two contigs
+CONTIG_OFFSET = 1 << 34
+
+
+@jit(nopython=True, cache=True)
+def window_counts(point_x,point_y,x_low,x_high,y_low,y_high):
+    """Function that takes as input points (x,y) and windows, and returns for every window the number of points with
+    x_low < x < x_high and y_low < y < y_high. The windows are swept by x, inserting the points in a Fenwick tree
+    indexed by the rank of y, so it runs in O((points + windows) log points)"""
+
+    n_points = len(point_x)
+    n_windows = len(x_low)
+
+    x_order = np.argsort(point_x)
+    sorted_x = point_x[x_order]
+    sorted_y = np.sort(point_y)
+    y_rank = np.searchsorted(sorted_y, point_y[x_order])
+
+    # every window is the difference of two prefixes in x: points with x < x_high minus points with x <= x_low. At the
+    # same threshold, the strict prefixes (listed first, and kept first by the stable sort) are taken before the points
+    # at the threshold are inserted
+    thresholds = np.concatenate((x_high, x_low))
+    inclusive = np.concatenate((np.zeros(n_windows, dtype=np.int64), np.ones(n_windows, dtype=np.int64)))
+    events = np.argsort(thresholds, kind='mergesort')
+
+    tree = np.zeros(n_points + 1, dtype=np.int64)
+    prefix = np.zeros((2, n_windows), dtype=np.int64)
+    inserted = 0
+    for event in events:
+        window = event % n_windows
+        threshold = thresholds[event]
+
+        while inserted < n_points and (sorted_x[inserted] < threshold or
+                                       (inclusive[event] == 1 and sorted_x[inserted] == threshold)):
+            position = y_rank[inserted] + 1
+            while position <= n_points:
+                tree[position] += 1
+                position += position & (-position)
+            inserted += 1
+
+        # points with y < y_high minus points with y <= y_low
+        counts = 0
+        position = np.searchsorted(sorted_y, y_high[window])
+        while position > 0:
+            counts += tree[position]
+            position -= position & (-position)
+        position = np.searchsorted(sorted_y, y_low[window], side='right')
+        while position > 0:
+            counts -= tree[position]
+            position -= position & (-position)
+
+        prefix[inclusive[event], window] = max(counts, 0)
+
+    return(np.maximum(prefix[0] - prefix[1], 0))
+
+
 def assign_discordants(split_bed,discordant_bed,insert_mean,insert_std):
-    """Function that takes as input the the discordant reads supporting an interval and assigns them to the
-    interval if they are close by (using the insert size estimate)"""
+    """Function that takes as input the split read and the discordant read evidence buffers of a peak, merges the split
+    reads realigned to the same interval in the same iteration and assigns them the discordant reads close by (using
+    the insert size estimate). Returns the columns of the circular intervals"""
 
     max_dist = (insert_mean) + (5 * insert_std)
 
-    splits = pd.DataFrame.from_records(split_bed, columns=['chrom', 'start', 'end', 'read', 'iteration',
-                                                           'score']).sort_values(['chrom', 'start', 'end'])
+    order = np.lexsort((split_bed['iteration'], split_bed['end'], split_bed['start'], split_bed['chrom']))
+    chrom = split_bed['chrom'][order]
+    start = split_bed['start'][order]
+    end = split_bed['end'][order]
+    iteration = split_bed['iteration'][order]
+    read = split_bed['read'][order]
+    # scores are rounded to 2 decimals when they are stored
+    score = np.round(split_bed['score'][order].astype(np.float64), 2)
 
-    splits['score'] = splits['score'].astype(float)
+    new_group = group_starts(chrom, start, end, iteration)
+    first = np.flatnonzero(new_group)
+    group = np.cumsum(new_group) - 1
 
-    merged_splits = splits.groupby(['chrom', 'start', 'end', 'iteration']).agg(
-        {'chrom': 'first', 'start': 'first', 'end': 'max', 'read': 'nunique', 'iteration': 'first', 'score': 'sum'})
+    # a read counts as 1 no matter it is split in 2 pieces
+    pairs = np.lexsort((read, group))
+    new_read = group_starts(group[pairs], read[pairs])
+    n_reads = np.bincount(group[pairs][new_read], minlength=len(first))
 
-    merged_splits['read'] = merged_splits['read'].astype(int)
-    discordant_bed = pd.DataFrame.from_records(discordant_bed,columns=['chrom', 'start', 'end', 'read'])
+    circles = {'chrom': chrom[first], 'start': start[first], 'end': end[first], 'read': n_reads,
+               'iteration': iteration[first], 'score': np.add.reduceat(score, first),
+               'discordants': np.zeros(len(first), dtype=np.int32)}
 
-    if len(discordant_bed) > 0:
-        assigned_splits = []
+    # discordant reads starting after the interval start and ending before the interval end, within max_dist
+    if len(discordant_bed) > 0 and np.isfinite(max_dist):
 
-        for index, row in merged_splits.iterrows():
-            chrom_filt = discordant_bed[(discordant_bed['chrom'] == row['chrom'])]
-            start_filt = chrom_filt[
-                (chrom_filt['start'] > row['start']) & ((chrom_filt['start'] - row['start']) < max_dist)]
-            end_filt = start_filt[(start_filt['end'] < row['end']) & ((row['end'] - start_filt['end']) < max_dist)]
+        d_offset = discordant_bed['chrom'].astype(np.float64) * CONTIG_OFFSET
+        c_offset = circles['chrom'].astype(np.float64) * CONTIG_OFFSET
+        c_start = c_offset + circles['start']
+        c_end = c_offset + circles['end']
 
-            assigned_splits.append(
-                [row['chrom'], row['start'], row['end'], row['read'], row['iteration'], float(row['score']), len(end_filt)])
+        circles['discordants'] = window_counts(d_offset + discordant_bed['start'], d_offset + discordant_bed['end'],
+                                               c_start, c_start + max_dist, c_end - max_dist, c_end).astype(np.int32)
 
-        return (assigned_splits)
+    return(circles)
 
-    else:
-        assigned_splits = []
-        for index,row in merged_splits.iterrows():
-            assigned_splits.append(
-                [row['chrom'], row['start'], row['end'], row['read'], row['iteration'], float(row['score']),
-                 0])
 
-        return(assigned_splits)
+def merge_discordants(discordant_bed):
+    """Function that takes as input the discordant read evidence buffer of a peak and merges the overlapping discordant
+    intervals. Returns their columns, with the number of reads of every interval"""
+
+    order = np.lexsort((discordant_bed['end'], discordant_bed['start'], discordant_bed['chrom']))
+    chrom = discordant_bed['chrom'][order]
+    start = discordant_bed['start'][order].astype(np.int64)
+    end = discordant_bed['end'][order].astype(np.int64)
+
+    # same merging rule as merge_bed: a read overlapping the previous one by at least 1bp
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (chrom[1:] != chrom[:-1]) | ((start[1:] - end[:-1] - 1) >= 0)
+    first = np.flatnonzero(new_group)
+    last = np.concatenate((first[1:], [len(order)])) - 1
+
+    return({'chrom': chrom[first], 'start': start[first], 'end': end[last], 'read': np.diff(np.append(first, len(order)))})
+
 
 def adaptative_myers_k(sc_len,edit_frac):
     """Calculate the edit distance allowed as a function of the read length"""
     return(float(sc_len*edit_frac))
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def non_colinearity(read_start_cigar,read_end_cigar,aln_start,mate_interval_start,mate_interval_end):
     """Input a read and the mate interval in the graph. The function checks whether the alignment would be linear (splicing)
     or colinear. Will return false, in order to not attemp realignment. This is mainly thought for skipping deletions and
@@ -1533,13 +2189,38 @@ def non_colinearity(read_start_cigar,read_end_cigar,aln_start,mate_interval_star
         else:
             return (False)
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def prob_to_phred(prob):
     """Function that takes as input a probability and returns a phred-scaled probability. Rounded to the nearest decimal"""
     if prob == 1.0:
         prob = 0.999999999
     return(int(np.around(-10*np.log10(1-prob))))
 
+
+def warm_up_kernels():
+    """Function that compiles the numba kernels with the argument types used by the realignment, or loads them from the
+    numba cache on disk. It is called before the pool forks, so that the processes inherit the compiled kernels instead
+    of compiling them again on their first chunk. It returns the seconds it took"""
+
+    begin = time.time()
+
+    codes = np.zeros(4, dtype=np.uint8)
+    # the strands served by the memory mapped genome index are read-only arrays, which numba types separately
+    read_only = codes.copy()
+    read_only.flags.writeable = False
+
+    phred_to_prob(np.array(30, dtype=np.float64))
+    phred_to_prob(30)
+    myers_end_distances(codes, codes)
+    myers_end_distances(read_only, read_only)
+    pssm(codes, codes, np.array([4], dtype=np.int64), np.zeros(1, dtype=np.int64), np.array([0, 1], dtype=np.int64),
+         np.log2(np.full(4, 0.25)), 5, 1)
+    window_counts(np.zeros(1), np.zeros(1), np.zeros(1), np.ones(1), np.zeros(1), np.ones(1))
+    non_colinearity(4, 0, 0, 0, 0)
+    prob_to_phred(0.5)
+
+    return(time.time() - begin)
+
 def realignment_read_to_SA_string(realignment_dict,prob,chrom,soft_clip_start):
     """Function that takes as input the realignment dict, the alignment posterior probability and the chromosome and
     returns an SA string"""
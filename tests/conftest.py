@@ -0,0 +1,152 @@
+#Helpers shared by the tests. They write small bam files with pysam, so the tests do not need any data on disk.
+
+import random
+import pysam as ps
+import pytest
+
+
+def random_sequence(length, rng):
+    """Function that takes as input a length and a random generator and returns a random DNA sequence"""
+
+    return("".join(rng.choice("ACGT") for base in range(length)))
+
+
+def aligned_read(name, flag, contig, start, cigar, sequence, mapq=60, qualities=None, mate=None, tags=()):
+    """Function that takes as input the fields of an alignment and returns it as a pysam AlignedSegment. The contig
+    and the mate contig are reference ids"""
+
+    read = ps.AlignedSegment()
+    read.query_name = name
+    read.flag = flag
+    read.query_sequence = sequence
+    read.query_qualities = ps.qualitystring_to_array(qualities if qualities is not None else "I" * len(sequence))
+    if flag & 0x4:
+        read.reference_id = -1 if contig is None else contig
+        read.reference_start = -1 if start is None else start
+    else:
+        read.reference_id = contig
+        read.reference_start = start
+        read.cigarstring = cigar
+        read.mapping_quality = mapq
+    if mate is not None:
+        read.next_reference_id, read.next_reference_start = mate
+    for tag, value in tags:
+        read.set_tag(tag, value)
+    return(read)
+
+
+def random_cigar(length, rng):
+    """Function that takes as input a read length and a random generator and returns a cigar string with soft clips,
+    insertions and deletions"""
+
+    clip_start = rng.choice([0, 0, 0, rng.randint(1, length // 3)])
+    clip_end = rng.choice([0, 0, 0, rng.randint(1, length // 3)])
+    aligned = length - clip_start - clip_end
+    cigar = "%sS" % clip_start if clip_start else ""
+    if aligned > 20 and rng.random() < 0.3:
+        first = rng.randint(5, aligned - 10)
+        if rng.random() < 0.5:
+            deletion = rng.randint(1, 5)
+            cigar += "%sM%sD%sM" % (first, deletion, aligned - first)
+        else:
+            insertion = rng.randint(1, 5)
+            cigar += "%sM%sI%sM" % (first, insertion, aligned - first - insertion)
+    else:
+        cigar += "%sM" % aligned
+    cigar += "%sS" % clip_end if clip_end else ""
+    return(cigar)
+
+
+def random_pairs(lengths, pairs, seed, read_length=100):
+    """Function that takes as input the contig lengths, a number of read pairs and a seed, and returns random pairs of
+    alignments with clips, indels, N bases, low base and mapping qualities, supplementary and secondary alignments,
+    duplicates and unmapped mates"""
+
+    rng = random.Random(seed)
+    reads = []
+    for pair in range(pairs):
+        name = "read%s" % pair
+        contig = rng.randrange(len(lengths))
+        positions = []
+        for mate in range(2):
+            positions.append(rng.randint(0, lengths[contig] - 2 * read_length))
+        unmapped = rng.random() < 0.05
+        duplicate = 0x400 if rng.random() < 0.05 else 0
+        segments = []
+        for mate in range(2):
+            sequence = random_sequence(read_length, rng)
+            if rng.random() < 0.1:
+                sequence = sequence[:20] + "N" + sequence[21:]
+            qualities = "".join(rng.choice("#+5I") for base in range(read_length))
+            flag = 0x1 | (0x40 if mate == 0 else 0x80) | duplicate
+            if rng.random() < 0.5:
+                flag |= 0x10
+            if unmapped and mate == 1:
+                flag |= 0x4
+            if unmapped and mate == 0:
+                flag |= 0x8
+            cigar = random_cigar(read_length, rng)
+            segments.append([flag, positions[mate], cigar, sequence, qualities])
+
+        for mate, (flag, position, cigar, sequence, qualities) in enumerate(segments):
+            other = segments[1 - mate]
+            if other[0] & 0x4:
+                mate_position = (contig, position)
+            else:
+                mate_position = (contig, other[1])
+            if flag & 0x4:
+                # unmapped mates are placed at their mapped mate
+                read = aligned_read(name, flag, contig, segments[1 - mate][1], None, sequence, qualities=qualities,
+                                    mate=(contig, segments[1 - mate][1]))
+            else:
+                read = aligned_read(name, flag, contig, position, cigar, sequence, mapq=rng.choice([0, 20, 60, 60]),
+                                    qualities=qualities, mate=mate_position)
+            reads.append(read)
+
+            if not flag & 0x4 and rng.random() < 0.05:
+                # a supplementary alignment of the mate, and its SA tag in the primary
+                start = rng.randint(0, lengths[contig] - read_length)
+                clipped = "50S50M" if rng.random() < 0.5 else "50M50S"
+                supplementary = aligned_read(name, (flag & 0xd3) | 0x800, contig, start, clipped, sequence,
+                                             mapq=60, qualities=qualities, mate=mate_position,
+                                             tags=[("SA", "chr%s,%s,+,%s,60,0;" % (contig + 1, position + 1, cigar))])
+                read.set_tag("SA", "chr%s,%s,+,%s,60,0;" % (contig + 1, start + 1, clipped))
+                reads.append(supplementary)
+
+            if not flag & 0x4 and rng.random() < 0.03:
+                start = rng.randint(0, lengths[contig] - read_length)
+                reads.append(aligned_read(name, (flag & 0xd3) | 0x100, contig, start, "%sM" % read_length,
+                                          sequence, mapq=0, qualities=qualities, mate=mate_position))
+    return(reads)
+
+
+def write_bam(path, lengths, reads, sort_order="coordinate"):
+    """Function that takes as input a path, the contig lengths and a list of alignments, and writes them as a bam
+    sorted by coordinate, and indexed, or by read name, as samtools sort -n does"""
+
+    header = {'HD': {'VN': '1.6', 'SO': 'unsorted'},
+              'SQ': [{'SN': 'chr%s' % (contig + 1), 'LN': length} for contig, length in enumerate(lengths)]}
+
+    unsorted = str(path) + ".unsorted.bam"
+    with ps.AlignmentFile(unsorted, "wb", header=header) as bam:
+        for read in reads:
+            bam.write(read)
+
+    if sort_order == "coordinate":
+        ps.sort("-o", str(path), unsorted)
+        ps.index(str(path))
+    else:
+        ps.sort("-n", "-o", str(path), unsorted)
+    return(str(path))
+
+
+@pytest.fixture(scope="session")
+def simulated_bams(tmp_path_factory):
+    """Fixture with a coordinate sorted and a read name sorted bam of random read pairs on three contigs"""
+
+    directory = tmp_path_factory.mktemp("bams")
+    lengths = [20000, 15000, 3000]
+    reads = random_pairs(lengths, 3000, 1)
+    return({'directory': str(directory), 'lengths': lengths,
+            'sorted': write_bam(directory / "sorted.bam", lengths, reads),
+            'qname': write_bam(directory / "qname.bam", lengths, reads, "queryname")})
@@ -0,0 +1,140 @@
+import random
+import numpy as np
+import pysam as ps
+import pybedtools as bt
+from circlemap.Coverage import coverage
+
+
+def merged_intervals(circles):
+    """Function that takes as input a list of circles and returns their merged intervals, as bedtools merge does"""
+
+    merged = []
+    for chrom, start, end in sorted(circles):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, start, end])
+    return(bt.BedTool([bt.create_interval_from_list([chrom, str(start), str(end)]) for chrom, start, end in merged]))
+
+
+def circle_bed(circles):
+    """Function that takes as input a list of circles and returns them as a bed file"""
+
+    return(bt.BedTool([bt.create_interval_from_list([chrom, str(start), str(end)]) for chrom, start, end in
+                       circles]).saveas())
+
+
+def circle_coverage(bam, circles, extension, quality, inside_length, depth_index=False):
+    """Function that takes as input a bam and a list of circles, and returns every circle written by compute_coverage
+    with its coverage fields"""
+
+    object = coverage(bam['sorted'].split("/")[-1], circle_bed(circles), extension, quality, inside_length,
+                      bam['directory'], depth_index)
+    object.merged = merged_intervals(circles)
+
+    return([((interval.chrom, interval.start, interval.end), interval.fields[3:]) for interval in
+            object.compute_coverage(object.get_wg_coverage())])
+
+
+def count_coverage_fields(bam, circles, extension, quality, inside_length):
+    """Function that computes the coverage fields of the circles with count_coverage and all_hits, as Circle-Map did
+    before the coverage was computed from the aligned blocks and prefix sums"""
+
+    alignments = ps.AlignmentFile(bam['sorted'])
+    lengths = dict(zip(alignments.references, alignments.lengths))
+    bed = circle_bed(circles)
+    fields = []
+    for interval in merged_intervals(circles):
+        start = max(interval.start - extension, 0)
+        end = interval.end + extension if lengths[interval.chrom] < interval.end + extension else interval.end
+        depth = np.uint32(np.array(alignments.count_coverage(contig=interval.chrom, start=start, end=end,
+                                                             quality_threshold=quality)).sum(axis=0))
+
+        for circle in bed.all_hits(bt.Interval(interval.chrom, start, end)):
+            region_start = circle.start - start
+            region_end = circle.end - start
+            ext_start = max(region_start - extension, 0)
+            ext_end = lengths[circle.chrom] if lengths[circle.chrom] < region_end + extension else \
+                region_end + extension
+            region = depth[region_start:region_end]
+            ext_array = depth[ext_start:ext_end]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.mean(region) if len(region) > 0 else np.nan
+                sd = np.std(region) if len(region) > 0 else np.nan
+                start_ratio = np.sum(region[0:inside_length]) / np.sum(ext_array[0:inside_length + extension])
+                end_ratio = np.sum(region[-inside_length:]) / np.sum(ext_array[-(inside_length + extension):])
+            zero_frac = np.count_nonzero(region == 0) / len(region) if len(region) > 0 else 'NA'
+            fields.append(((circle.chrom, circle.start, circle.end),
+                           [str(mean), str(sd), str(start_ratio), str(end_ratio), str(zero_frac)]))
+    return(fields)
+
+
+def assert_same_fields(computed, expected):
+    """Function that checks the coverage fields of the circles. The sd is computed from integer sums, so it can differ
+    from np.std in the last digits"""
+
+    assert [circle for circle, fields in computed] == [circle for circle, fields in expected]
+    for (circle, fields), (circle, expected_fields) in zip(computed, expected):
+        assert fields[:1] + fields[2:] == expected_fields[:1] + expected_fields[2:]
+        assert np.isclose(float(fields[1]), float(expected_fields[1]), rtol=1e-12, atol=0, equal_nan=True)
+
+
+def random_circles(lengths, number, seed):
+    """Function that takes as input the contig lengths and returns random circles, some of them overlapping, of zero
+    length, or at the ends of the contigs"""
+
+    rng = random.Random(seed)
+    circles = set()
+    for circle in range(number):
+        contig = rng.randrange(len(lengths))
+        start = rng.randint(0, lengths[contig] - 1)
+        end = min(start + rng.choice([0, rng.randint(1, 50), rng.randint(1, 3000)]), lengths[contig])
+        circles.add(("chr%s" % (contig + 1), start, end))
+    for contig, length in enumerate(lengths):
+        circles.add(("chr%s" % (contig + 1), length - 150, length))
+    return(sorted(circles))
+
+
+def test_zero_length_circle(simulated_bams):
+    circles = [("chr1", 5000, 5000), ("chr1", 8000, 9000), ("chr2", 100, 100)]
+    computed = circle_coverage(simulated_bams, circles, 200, 0, 100)
+
+    for circle, fields in computed:
+        if circle[1] == circle[2]:
+            mean, sd, start_ratio, end_ratio, zero_frac = fields
+            assert (mean, sd, zero_frac) == ('nan', 'nan', 'NA')
+            assert start_ratio == end_ratio == '0.0'
+
+    assert_same_fields(computed, count_coverage_fields(simulated_bams, circles, 200, 0, 100))
+
+
+def test_zero_length_window(simulated_bams):
+    object = coverage(simulated_bams['sorted'].split("/")[-1], bt.BedTool([]), 0, 0, 100, simulated_bams['directory'])
+    depths = object.window_depth("chr1", [(5000, 5000), (5000, 5010)])
+
+    assert len(depths[0]) == 0
+    assert len(depths[1]) == 10
+
+
+def test_circles_of_neighbouring_intervals(simulated_bams):
+    # the extended intervals overlap the circles of the intervals next to them, which are written again with the
+    # coverage array of the interval they were found in
+    circles = [("chr1", 4000, 4500), ("chr1", 4600, 4700), ("chr1", 4700, 4700), ("chr1", 5300, 5800),
+               ("chr2", 100, 400)]
+    computed = circle_coverage(simulated_bams, circles, 200, 0, 100)
+
+    assert len(computed) > len(circles)
+    assert_same_fields(computed, count_coverage_fields(simulated_bams, circles, 200, 0, 100))
+
+
+def test_coverage_matches_count_coverage(simulated_bams):
+    circles = random_circles(simulated_bams['lengths'], 40, 2)
+    for quality in (0, 20, 0.6):
+        expected = count_coverage_fields(simulated_bams, circles, 200, quality, 100)
+        assert_same_fields(circle_coverage(simulated_bams, circles, 200, quality, 100), expected)
+        assert_same_fields(circle_coverage(simulated_bams, circles, 200, quality, 100, depth_index=True), expected)
+
+    # without flanks, and with the whole circle as the inside region of the ratios
+    for extension, inside_length in [(0, 100), (200, 0), (1000, 50)]:
+        expected = count_coverage_fields(simulated_bams, circles, extension, 0, inside_length)
+        assert_same_fields(circle_coverage(simulated_bams, circles, extension, 0, inside_length), expected)
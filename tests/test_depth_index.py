@@ -0,0 +1,69 @@
+import os
+import shutil
+import numpy as np
+import pysam as ps
+import pytest
+import circlemap.depth_index as depth_index
+from circlemap.depth_index import load_depth, open_depth
+
+
+def test_reads_track_matches_bam_count(simulated_bams):
+    index = load_depth(simulated_bams['sorted'])
+    rng = np.random.default_rng(6)
+
+    with ps.AlignmentFile(simulated_bams['sorted'], "rb") as bam:
+        for chrom, length in zip(bam.references, bam.lengths):
+            positions = np.unique(np.concatenate(([0, length - 1], rng.integers(0, length, 500))))
+            expected = [bam.count(contig=chrom, start=position, stop=position + 1, read_callback='nofilter')
+                        for position in positions.tolist()]
+            assert index.depth(chrom, positions).tolist() == expected
+
+
+@pytest.mark.parametrize("quality", [0, 20, 0.6])
+def test_bases_track_matches_count_coverage(simulated_bams, quality):
+    index = load_depth(simulated_bams['sorted'], quality)
+    rng = np.random.default_rng(7)
+
+    with ps.AlignmentFile(simulated_bams['sorted'], "rb") as bam:
+        for chrom, length in zip(bam.references, bam.lengths):
+            # whole contigs, random regions and regions past the end of the contig
+            regions = [(0, length), (length - 50, length + 300), (length, length + 10)]
+            for region in range(30):
+                start = int(rng.integers(0, length))
+                regions.append((start, start + int(rng.integers(1, 3000))))
+
+            for start, end in regions:
+                if start >= length:
+                    # count_coverage does not take empty regions
+                    expected = []
+                else:
+                    expected = np.sum(bam.count_coverage(chrom, start, min(end, length), quality_threshold=quality,
+                                                         read_callback='all'), axis=0).tolist()
+                assert index.region(chrom, start, end).tolist() == expected
+
+
+def test_index_of_a_bam_in_a_read_only_directory(simulated_bams, tmp_path, monkeypatch):
+    archive = tmp_path / "archive"
+    working = tmp_path / "working"
+    archive.mkdir()
+    working.mkdir()
+    bam = str(archive / "sorted.bam")
+    shutil.copy(simulated_bams['sorted'], bam)
+    shutil.copy(simulated_bams['sorted'] + ".bai", bam + ".bai")
+
+    # the tests can run as root, who can write anywhere
+    access = os.access
+    monkeypatch.setattr(depth_index.os, "access", lambda path, mode: False if os.path.samefile(path, archive) and
+                        mode == os.W_OK else access(path, mode))
+
+    index = load_depth(bam, 20, str(working))
+    assert sorted(os.listdir(archive)) == ["sorted.bam", "sorted.bam.bai"]
+    assert len(os.listdir(working)) > 0
+
+    # the index is found again in the working directory, and serves the same depth
+    assert open_depth(bam, 20, str(working)) is not None
+    assert open_depth(bam, 20, str(tmp_path)) is None
+    expected = load_depth(simulated_bams['sorted'], 20)
+    for contig, length in enumerate(simulated_bams['lengths']):
+        chrom = "chr%s" % (contig + 1)
+        assert index.region(chrom, 0, length).tolist() == expected.region(chrom, 0, length).tolist()
@@ -0,0 +1,63 @@
+import os
+import subprocess as sp
+import sys
+import pysam as ps
+import pytest
+from circlemap.mate_cache import mate_cache, plain_secondaries
+from conftest import aligned_read, write_bam
+
+
+def extract(input_bam, output_bam, *options):
+    """Function that runs ReadExtractor on a bam and returns its output alignments, sorted, and its stderr"""
+
+    # the bams are relative to the working directory
+    run = sp.run([sys.executable, "-m", "circlemap.circle_map", "ReadExtractor", "-i", os.path.basename(input_bam),
+                  "-o", output_bam, "-dir", os.path.dirname(input_bam)] + list(options),
+                 stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True)
+    assert run.returncode == 0, run.stderr
+
+    with ps.AlignmentFile(os.path.join(os.path.dirname(input_bam), output_bam), "rb", check_sq=False) as bam:
+        return(sorted(read.to_string() for read in bam), run.stderr)
+
+
+@pytest.mark.parametrize("options", [[], ["-p", "3"], ["-M", "0"], ["-p", "3", "-M", "0"]])
+def test_coordinate_extraction_matches_queryname(simulated_bams, options):
+    expected, stderr = extract(simulated_bams['qname'], "qname_circle.bam")
+    extracted, stderr = extract(simulated_bams['sorted'], "sorted_circle_%s.bam" % "".join(options), *options)
+
+    # the late secondary alignments of a read name are not classified on their own
+    assert "Unpaired" not in stderr
+    assert len(expected) > 0
+    assert extracted == expected
+
+
+@pytest.mark.parametrize("processes", ["2", "5"])
+def test_partitioned_extraction_matches_serial(simulated_bams, processes):
+    expected, stderr = extract(simulated_bams['qname'], "qname_circle.bam")
+    extracted, stderr = extract(simulated_bams['qname'], "qname_circle_%s.bam" % processes, "-p", processes)
+
+    assert extracted == expected
+
+
+def test_late_secondary_joins_its_read_name(tmp_path):
+    sequence = "ACGT" * 25
+    reads = [aligned_read("pair", 0x63, 0, 100, "100M", sequence, mate=(0, 300)),
+             aligned_read("pair", 0x93, 0, 300, "100M", sequence, mate=(0, 100)),
+             # a secondary alignment without SA tag, after the primary alignments of both mates
+             aligned_read("pair", 0x163, 0, 5000, "100M", sequence, mapq=0, mate=(0, 300)),
+             aligned_read("single", 0x63, 0, 6000, "100M", sequence, mate=(0, 6100)),
+             aligned_read("single", 0x93, 0, 6100, "100M", sequence, mate=(0, 6000))]
+    bam = write_bam(tmp_path / "late.bam", [10000], reads)
+
+    secondaries = plain_secondaries(bam, str(tmp_path / "late.secondaries"))
+    assert secondaries == {"pair": {0x40: 1}}
+    assert not any(name.startswith("late.secondaries") for name in os.listdir(tmp_path))
+
+    with ps.AlignmentFile(bam, "rb") as handle:
+        cache = mate_cache(handle.header, str(tmp_path / "late.mates"), 1000000, secondaries)
+        matched = [cache.add(read) for read in handle]
+
+    # the read name waits for its secondary alignment, and is given in the order of samtools sort -n
+    assert [group is None for group in matched] == [True, True, False, True, False]
+    assert [read.flag for read in matched[2]] == [0x63, 0x163, 0x93]
+    assert list(cache.pending()) == []
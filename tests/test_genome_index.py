@@ -0,0 +1,107 @@
+import os
+import random
+import numpy as np
+import pysam as ps
+import pytest
+from circlemap.genome_index import build_index, open_reference, update_index, genome_index, fasta_reference, \
+    interval_cache, entry_bytes
+from circlemap.utils import interval_seeds
+from conftest import random_sequence
+
+
+def write_fasta(path, contigs):
+    """Function that takes as input a path and a dictionary of contig sequences, and writes them as an indexed fasta"""
+
+    with open(path, 'w') as fasta:
+        for name, sequence in contigs.items():
+            fasta.write(">%s\n" % name)
+            for start in range(0, len(sequence), 60):
+                fasta.write("%s\n" % sequence[start:start + 60])
+    if os.path.isfile("%s.fai" % path):
+        os.remove("%s.fai" % path)
+    ps.faidx(str(path))
+    return(str(path))
+
+
+def random_contigs(rng, lengths):
+    """Function that returns random contigs with N runs and soft-masked (lower case) regions"""
+
+    contigs = {}
+    for index, length in enumerate(lengths):
+        sequence = list(random_sequence(length, rng))
+        for run in range(5):
+            start = rng.randrange(length)
+            end = min(length, start + rng.randint(1, 3000))
+            masked = rng.choice(["N", "lower"])
+            sequence[start:end] = ["N"] * (end - start) if masked == "N" else [base.lower() for base in sequence[start:end]]
+        contigs["chr%s" % (index + 1)] = "".join(sequence)
+    return(contigs)
+
+
+def assert_same_intervals(fasta, rng, n_intervals=200):
+    """Function that checks that the reference opened for a fasta serves the same intervals as the fasta file"""
+
+    indexed = interval_cache(open_reference(fasta), 0)
+    plain = interval_cache(fasta_reference(fasta), 0)
+    assert isinstance(indexed.reference, genome_index)
+
+    with ps.FastaFile(fasta) as handle:
+        for interval in range(n_intervals):
+            contig = rng.choice(handle.references)
+            length = handle.get_reference_length(contig)
+            start = rng.randrange(length)
+            # intervals past the end of the contig are clipped, as FastaFile.fetch does
+            end = start + rng.randint(1, 5000)
+
+            expected = plain.entry(contig, start, end)
+            served = indexed.entry(contig, start, end)
+            for strand in ['plus_codes', 'minus_codes']:
+                assert served[strand].tobytes() == expected[strand].tobytes()
+            for strand in ['plus_freqs', 'minus_freqs']:
+                assert np.allclose(served[strand], expected[strand])
+
+
+def test_index_serves_the_fasta_intervals(tmp_path):
+    rng = random.Random(8)
+    fasta = write_fasta(tmp_path / "ref.fa", random_contigs(rng, [40000, 5001, 1027]))
+
+    assert isinstance(open_reference(fasta), fasta_reference)
+    build_index(fasta)
+    assert_same_intervals(fasta, rng)
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    rng = random.Random(9)
+    fasta = write_fasta(tmp_path / "ref.fa", random_contigs(rng, [20000, 3000]))
+    build_index(fasta)
+    assert isinstance(open_reference(fasta), genome_index)
+
+    # a new assembly of the reference, written after the index
+    write_fasta(fasta, random_contigs(rng, [20000, 3500, 700]))
+
+    # the workers do not use the stale index, and the index is rebuilt once before they start
+    assert isinstance(open_reference(fasta), fasta_reference)
+    update_index(fasta)
+    assert_same_intervals(fasta, rng)
+
+
+def test_interval_cache_is_bounded_by_bytes(tmp_path):
+    rng = random.Random(10)
+    fasta = write_fasta(tmp_path / "ref.fa", random_contigs(rng, [50000]))
+    build_index(fasta)
+
+    max_bytes = 300000
+    cache = interval_cache(open_reference(fasta), max_bytes)
+    for interval in range(100):
+        start = rng.randrange(45000)
+        entry = cache.entry("chr1", start, start + rng.randint(100, 5000))
+        # the q-gram tables stored on the entries count in the size of the cache
+        interval_seeds(entry, rng.random() < 0.5)
+
+        assert cache.total == sum(entry_bytes(cached) for key, cached in cache.intervals.items() if key != cache.last) \
+               + cache.bytes[cache.last]
+        assert cache.total <= max_bytes or len(cache.intervals) == 1
+
+    cache.entry("chr1", 0, 100)
+    assert cache.total == sum(entry_bytes(cached) for cached in cache.intervals.values())
+    assert cache.misses > 0
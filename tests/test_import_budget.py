@@ -0,0 +1,105 @@
+#Checks the imports of every Circle-Map subcommand. Running a subcommand without arguments imports its modules, prints
+#its help and exits. The heavy modules a subcommand does not need must not be imported by its help, and with
+#CIRCLEMAP_IMPORT_BUDGET=1 the import time, measured with python -X importtime, is checked against its budget too.
+
+import os
+import re
+import subprocess as sp
+import sys
+import pytest
+
+# milliseconds of imports allowed for every subcommand. The empty subcommand is the help of the dispatcher
+budget = {'': 80, 'ReadExtractor': 300, 'Realign': 950, 'bam2bam': 950, 'Repeats': 350, 'Index': 350,
+          'Simulate': 450}
+
+# heavy modules that the help of every subcommand must not import. numba is only imported when a kernel runs
+HEAVY = ['numba', 'pandas', 'pybedtools', 'scipy', 'Bio', 'numpy', 'pysam']
+not_imported = {'': HEAVY,
+                'ReadExtractor': ['numba', 'pandas', 'pybedtools', 'scipy', 'Bio'],
+                'Realign': ['numba', 'scipy'],
+                'bam2bam': ['numba', 'pybedtools', 'scipy'],
+                'Repeats': ['numba', 'pandas', 'scipy', 'Bio'],
+                'Index': ['numba', 'pandas', 'pybedtools', 'scipy'],
+                'Simulate': ['numba', 'pandas', 'scipy']}
+
+# runs of every subcommand. The fastest one is measured, the others pay for cold file system caches
+RUNS = 3
+
+
+def imported_modules(subcommand):
+    """Function that runs the help of a subcommand and returns the heavy modules it imported"""
+
+    script = """
+import sys
+sys.argv = ['Circle-Map'] + sys.argv[1:]
+from circlemap.circle_map import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.stderr.write('\\nimported: %s\\n' % ' '.join(module for module in {heavy} if module in sys.modules))
+""".format(heavy=HEAVY)
+
+    run = sp.run([sys.executable, "-c", script] + ([subcommand] if subcommand else []), stdout=sp.DEVNULL,
+                 stderr=sp.PIPE, stdin=sp.DEVNULL, universal_newlines=True)
+
+    last = run.stderr.rstrip('\n').split('\n')[-1]
+    assert last.startswith('imported:'), run.stderr
+    return(last.split(':', 1)[1].split())
+
+
+def import_time(subcommand):
+    """Function that runs a subcommand under python -X importtime and returns the milliseconds spent importing the
+    top level modules"""
+
+    run = sp.run([sys.executable, "-X", "importtime", "-m", "circlemap.circle_map"] + ([subcommand] if subcommand else []),
+                 stdout=sp.DEVNULL, stderr=sp.PIPE, stdin=sp.DEVNULL, universal_newlines=True)
+
+    total = 0
+    for line in run.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package. Nested imports are indented
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)$", line)
+        if match:
+            total += int(match.group(1))
+
+    return(total / 1000)
+
+
+@pytest.mark.parametrize("subcommand", list(not_imported))
+def test_help_does_not_import_heavy_modules(subcommand):
+    imported = imported_modules(subcommand)
+    assert [module for module in not_imported[subcommand] if module in imported] == []
+
+
+# the import time depends on the load of the machine, so the budget is only checked on demand
+@pytest.mark.skipif(os.environ.get('CIRCLEMAP_IMPORT_BUDGET') != '1', reason="set CIRCLEMAP_IMPORT_BUDGET=1 to check "
+                                                                           "the import time budgets")
+@pytest.mark.parametrize("subcommand", list(budget))
+def test_import_budget(subcommand):
+    measured = min(import_time(subcommand) for run in range(RUNS))
+    assert measured <= budget[subcommand], "%s imports in %.1f ms, budget %s ms" % (subcommand or "help", measured,
+                                                                                  budget[subcommand])
+
+
+def test_lazy_kernels_dispatch_after_the_first_call():
+    # a fresh interpreter, where the kernels have not been compiled yet. realigner imports them with
+    # from circlemap.utils import *
+    script = """
+import circlemap.realigner as realigner
+import circlemap.utils as utils
+from circlemap.lazy import lazy_kernel
+
+kernel = realigner.non_colinearity
+assert isinstance(kernel, lazy_kernel) and kernel.dispatcher is None
+colinear = kernel(4, 0, 100, mate_interval_start=0, mate_interval_end=50)
+
+# the module of the kernels holds the dispatchers, the modules importing them keep the lazy kernels
+assert not isinstance(utils.non_colinearity, lazy_kernel)
+assert not isinstance(utils.myers_end_distances, lazy_kernel)
+assert realigner.non_colinearity is kernel
+assert kernel.dispatcher is utils.non_colinearity
+assert realigner.myers_end_distances.dispatcher is utils.myers_end_distances
+assert kernel(4, 0, 100, 0, 50) == utils.non_colinearity(4, 0, 100, 0, 50) == colinear
+"""
+    run = sp.run([sys.executable, "-c", script], stdin=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True)
+    assert run.returncode == 0, run.stderr
@@ -0,0 +1,110 @@
+import random
+import pysam as ps
+import pytest
+from circlemap.bgzf import bam_partitions
+from circlemap.extract_circle_SV_reads import partition_reads
+from conftest import aligned_read, random_pairs, random_sequence, write_bam
+
+
+@pytest.fixture(scope="module")
+def grouped_bam(tmp_path_factory):
+    """Fixture with a read name sorted bam of short read pairs, long reads spanning many BGZF blocks and read names with
+    many alignments. It returns the bam and its records with the virtual offsets where they start"""
+
+    rng = random.Random(5)
+    lengths = [400000, 200000]
+    reads = random_pairs(lengths, 2000, 2)
+
+    for name in range(20):
+        # long reads larger than a BGZF block, and their supplementary alignments
+        length = rng.randint(20000, 150000)
+        sequence = random_sequence(length, rng)
+        contig = rng.randrange(len(lengths))
+        start = rng.randint(0, lengths[contig] - length)
+        reads.append(aligned_read("long%s" % name, 0, contig, start, "%sM" % length, sequence))
+        for supplementary in range(rng.randint(0, 3)):
+            clip = rng.randint(1000, length - 1000)
+            position = rng.randint(0, lengths[contig] - length)
+            reads.append(aligned_read("long%s" % name, 0x800, contig, position, "%sM%sH" % (clip, length - clip),
+                                      sequence[:clip]))
+
+    for name in range(30):
+        # read names whose alignments take more than a BGZF block
+        sequence = random_sequence(150, rng)
+        for alignment in range(rng.randint(200, 600)):
+            flag = 0x1 | (0x40 if alignment % 2 == 0 else 0x80) | (0x100 if alignment > 1 else 0)
+            reads.append(aligned_read("group%s" % name, flag, 0, rng.randint(0, lengths[0] - 150), "150M", sequence,
+                                      mate=(0, 0)))
+
+    bam = write_bam(tmp_path_factory.mktemp("partitions") / "grouped.bam", lengths, reads, "queryname")
+
+    records = []
+    with ps.AlignmentFile(bam, "rb") as handle:
+        while True:
+            offset = handle.tell()
+            try:
+                read = next(handle)
+            except StopIteration:
+                break
+            records.append((offset, read.query_name, read.to_string()))
+
+    return(bam, records)
+
+
+def partitioned_reads(bam, starts):
+    """Function that takes as input a bam and the virtual offsets where its partitions start, and returns the reads of
+    every partition"""
+
+    partitions = []
+    with ps.AlignmentFile(bam, "rb") as handle:
+        for index, start in enumerate(starts):
+            end = starts[index + 1] if index + 1 < len(starts) else None
+            partitions.append([read.to_string() for read in partition_reads(handle, start, end, index > 0)])
+    return(partitions)
+
+
+@pytest.mark.parametrize("n_partitions", [2, 3, 7, 16, 64, 300])
+def test_partitions_cover_the_bam_once(grouped_bam, n_partitions):
+    bam, records = grouped_bam
+    offsets = [offset for offset, name, read in records]
+
+    starts = bam_partitions(bam, n_partitions)
+
+    # every partition starts at a record, in file order
+    assert starts[0] == offsets[0]
+    assert set(starts) <= set(offsets)
+    assert starts == sorted(starts)
+    assert len(starts) > 1
+
+    # the byte ranges split read name groups
+    first = {offset: index for index, offset in enumerate(offsets)}
+    assert any(records[first[start]][1] == records[first[start] - 1][1] for start in starts[1:])
+
+    partitions = partitioned_reads(bam, starts)
+    assert sum(partitions, []) == [read for offset, name, read in records]
+
+    # the read names are not split between partitions
+    names = [set(read.split('\t')[0] for read in partition) for partition in partitions]
+    for index in range(1, len(names)):
+        assert names[index - 1].isdisjoint(names[index])
+
+
+def test_name_group_crossing_a_partition(grouped_bam):
+    bam, records = grouped_bam
+
+    # partitions starting inside read name groups, as the byte ranges of bam_partitions do. One for every group
+    inside = {}
+    for index in range(1, len(records)):
+        if records[index][1] == records[index - 1][1]:
+            inside.setdefault(records[index][1], []).append(index)
+    rng = random.Random(1)
+    starts = sorted(rng.choice(inside[group]) for group in rng.sample(sorted(inside), 40))
+    partitions = partitioned_reads(bam, [records[0][0]] + [records[index][0] for index in starts])
+
+    assert sum(partitions, []) == [read for offset, name, read in records]
+
+    # the group is finished by the partition it starts in
+    for index, start in enumerate(starts):
+        group = records[start][1]
+        assert [read for read in partitions[index] if read.split('\t')[0] == group] == \
+               [read for offset, name, read in records if name == group]
@@ -0,0 +1,293 @@
+import math
+import random
+import re
+from types import SimpleNamespace
+import edlib
+import numpy as np
+from circlemap.utils import realign, realignment_probability, seed_filter, interval_seeds, adaptative_myers_k, \
+    myers_end_distances, hit_traceback, peak_read, BASE_CODES, pssm, edlib_cigar_to_iterable
+from circlemap.evidence import evidence_buffer, DISCORDANT_COLUMNS
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+
+
+def mutate_sequence(sequence, edits, rng):
+    """Function that takes as input a sequence and returns it with the given number of random substitutions,
+    insertions and deletions"""
+
+    sequence = list(sequence)
+    for edit in range(edits):
+        position = rng.randrange(len(sequence))
+        operation = rng.choice("SID")
+        if operation == "S":
+            sequence[position] = rng.choice([base for base in "ACGT" if base != sequence[position]])
+        elif operation == "I":
+            sequence.insert(position, rng.choice("ACGT"))
+        elif len(sequence) > 1:
+            del sequence[position]
+    return("".join(sequence))
+
+
+def interval_entry(plus):
+    """Function that takes as input the plus strand of a realignment interval and returns its cache entry"""
+
+    minus = "".join(COMPLEMENT[base] for base in plus)
+    frequencies = {base: plus.count(base) / len(plus) for base in "ATCG"}
+    return({'plus': plus, 'minus': minus,
+            'plus_freqs': np.array([frequencies['A'], frequencies['T'], frequencies['C'], frequencies['G']]),
+            'minus_freqs': np.array([frequencies['T'], frequencies['A'], frequencies['G'], frequencies['C']]),
+            'plus_codes': np.frombuffer(plus.encode(), dtype=np.uint8),
+            'minus_codes': np.frombuffer(minus.encode(), dtype=np.uint8)})
+
+
+def soft_clipped_read(sequence, reverse, rng):
+    """Function that takes as input a soft-clipped sequence and returns it as a read of the peak batch"""
+
+    read = peak_read(SimpleNamespace(qname="read", flag=0x10 if reverse else 0, mapq=60, reference_start=0), True)
+    read.sc_codes = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    read.sc_bases = BASE_CODES[read.sc_codes]
+    read.sc_qual = np.array([rng.choice([2, 20, 30, 40]) for base in sequence], dtype=np.uint8)
+    read.sc_len = len(sequence)
+    return(read)
+
+
+def test_seed_filter_keeps_the_full_scan_hits():
+    rng = random.Random(7)
+    filtered = 0
+    secondary = 0
+
+    for interval in range(30):
+        plus = "".join(rng.choice("ACGT") for base in range(rng.randint(500, 3000)))
+
+        # copies of a segment with more and more edits, so that the reads have secondary hits away from their seeds
+        segment = "".join(rng.choice("ACGT") for base in range(rng.randint(20, 120)))
+        for copy in range(rng.randint(0, 4)):
+            position = rng.randrange(len(plus) - len(segment))
+            plus = plus[:position] + mutate_sequence(segment, rng.randint(0, len(segment) // 5), rng) + \
+                   plus[position + len(segment):]
+        if rng.random() < 0.2:
+            plus = plus[:100] + "N" + plus[101:]
+        entry = interval_entry(plus)
+
+        for read in range(30):
+            reverse = rng.random() < 0.5
+            strand = entry['minus'] if reverse else entry['plus']
+            length = rng.randint(10, 150)
+            if rng.random() < 0.5:
+                sequence = segment[:length]
+            else:
+                start = rng.randrange(len(strand) - length)
+                sequence = strand[start:start + length]
+            sequence = mutate_sequence(sequence, rng.randint(0, len(sequence) // 6), rng)
+            if rng.random() < 0.05:
+                sequence = sequence[:5] + "N" + sequence[6:]
+            read = soft_clipped_read(sequence, reverse, rng)
+
+            edits_allowed = adaptative_myers_k(len(sequence), 0.05)
+            full_scan = realign(read, 10, entry['plus_codes'], entry['minus_codes'], entry['plus_freqs'],
+                                entry['minus_freqs'], 5, 1, 0, edits_allowed)
+
+            if seed_filter(read.sc_codes, interval_seeds(entry, reverse), edits_allowed):
+                seeded = realign(read, 10, entry['plus_codes'], entry['minus_codes'], entry['plus_freqs'],
+                                 entry['minus_freqs'], 5, 1, 0, edits_allowed)
+            else:
+                filtered += 1
+                seeded = None
+
+            assert seeded == full_scan
+            if full_scan is not None:
+                assert realignment_probability(seeded, len(plus)) == realignment_probability(full_scan, len(plus))
+                secondary += len(full_scan['alignments']) > 1
+
+    # the reads exercise both the filter and the secondary hits
+    assert filtered > 0
+    assert secondary > 0
+
+
+def random_hits(seed, cases):
+    """Function that takes as input a seed and a number of cases and yields random queries and texts, most of them with
+    an edited copy of the query in the text. The queries take one or more 64 bit words"""
+
+    rng = random.Random(seed)
+    for case in range(cases):
+        text = "".join(rng.choice("ACGT") for base in range(rng.randint(1, 400)))
+        if rng.random() < 0.3:
+            text = text[:5] + "N" + text[6:]
+        length = rng.randint(1, 150)
+        if rng.random() < 0.7 and len(text) > length:
+            start = rng.randrange(len(text) - length)
+            query = mutate_sequence(text[start:start + length], rng.randint(0, length // 4), rng)
+        else:
+            query = "".join(rng.choice("ACGTN") for base in range(length))
+        yield(query, text)
+
+
+def test_myers_end_distances_match_edlib():
+    for query, text in random_hits(11, 300):
+        distances = myers_end_distances(np.frombuffer(query.encode(), dtype=np.uint8),
+                                        np.frombuffer(text.encode(), dtype=np.uint8))
+
+        # the best alignment of the whole query ending at every position of the text
+        expected = [edlib.align(query[::-1], text[:end + 1][::-1], mode='SHW')['editDistance']
+                    for end in range(len(text))]
+        assert distances.tolist() == expected
+
+        best = edlib.align(query, text, mode='HW', task='locations')
+        assert distances.min() == best['editDistance']
+        assert np.flatnonzero(distances == distances.min()).tolist() == sorted(set(end for start, end in
+                                                                                   best['locations']))
+
+
+def test_hit_traceback_matches_edlib():
+    for query, text in random_hits(12, 300):
+        query_codes = np.frombuffer(query.encode(), dtype=np.uint8)
+        text_codes = np.frombuffer(text.encode(), dtype=np.uint8)
+
+        best = edlib.align(query, text, mode='HW', task='path')
+        for location, (start, end) in enumerate(best['locations']):
+            # edlib also reports the query inserted before the text, which has no end position in the text
+            if end < 0:
+                continue
+            hit_start, cigar = hit_traceback(query_codes, text_codes, end, best['editDistance'])
+            assert hit_start == start
+            if location == 0:
+                assert cigar == best['cigar']
+
+
+def test_evidence_buffer_memory_follows_its_capacity():
+    buffer = evidence_buffer(DISCORDANT_COLUMNS, ['chr1'], capacity=4)
+    empty = buffer.nbytes()
+    assert empty == 4 * 16
+
+    # the spill check sees the memory of the grown columns, not only the filled records
+    buffer.extend({'chrom': np.zeros(5000), 'start': np.arange(5000), 'end': np.arange(5000) + 100,
+                   'read': np.arange(5000)})
+    grown = buffer.nbytes()
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.nbytes() == grown >= 5000 * 16
+
+    buffer.append(0, 10, 20, 1)
+    buffer.clear(shrink=True)
+    assert len(buffer) == 0 and buffer.nbytes() == empty
+    buffer.append(0, 30, 40, 2)
+    assert buffer['start'].tolist() == [30]
+
+
+def hit_scores(sequence, quals, cigars, freqs, gap_open=5, gap_extend=1):
+    """Function that takes as input a read sequence, its base qualities, the edlib cigars of its hits and the A,T,C,G
+    frequencies of the realignment interval and returns the pssm score of every hit"""
+
+    bases = BASE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    return(pssm(np.array(quals, dtype=np.uint8), bases, *edlib_cigar_to_iterable(cigars), np.log2(freqs), gap_open,
+                gap_extend).tolist())
+
+
+def base_score(quality, freq, match):
+    """Function that returns the log2 score of a base, 1 minus prob(base called wrong) for a match and prob(base called
+    wrong)/3 for a mismatch, over its background frequency"""
+
+    error = 10 ** (-quality / 10)
+    return(math.log2(((1 - error) if match else error / 3) / freq))
+
+
+def test_edlib_cigar_counts_take_every_digit():
+    lengths, operations, offsets = edlib_cigar_to_iterable(["12=3I101X2D", "7="])
+    assert lengths.tolist() == [12, 3, 101, 2, 7]
+    assert operations.tolist() == [0, 2, 1, 3, 0]
+    assert offsets.tolist() == [0, 4, 5]
+
+    # the 12 matching bases are scored, not only the first one
+    freqs = np.array([0.25, 0.25, 0.25, 0.25])
+    score, = hit_scores("ACGTACGTACGT", [30] * 12, ["12="], freqs)
+    assert math.isclose(score, 12 * base_score(30, 0.25, True), rel_tol=1e-12)
+    score, = hit_scores("ACGTACGTACGT", [30] * 12, ["10=1X1="], freqs)
+    assert math.isclose(score, 11 * base_score(30, 0.25, True) + base_score(30, 0.25, False), rel_tol=1e-12)
+
+
+def test_insertions_advance_the_read():
+    freqs = np.array([0.1, 0.2, 0.3, 0.4])
+    sequence = "ATCGGCTA"
+    quals = [10, 20, 2, 2, 40, 30, 20, 10]
+
+    # the inserted bases are not scored, and the bases after them are scored with their own qualities
+    expected = sum(base_score(quals[position], freqs["ATCG".index(sequence[position])], True)
+                   for position in [0, 1, 4, 5, 6, 7]) - 5 - 1
+    score, = hit_scores(sequence, quals, ["2=2I4="], freqs)
+    assert math.isclose(score, expected, rel_tol=1e-12)
+
+    # deletions only take the gap penalty
+    expected = sum(base_score(quality, freqs["ATCG".index(base)], True) for base, quality in zip(sequence, quals)) - 5
+    score, = hit_scores(sequence, quals, ["4=1D4="], freqs)
+    assert math.isclose(score, expected, rel_tol=1e-12)
+
+
+def test_ambiguous_bases_keep_the_read_positions():
+    freqs = np.array([0.1, 0.2, 0.3, 0.4])
+    quals = [30, 2, 20, 40, 10]
+
+    # the N scores 0 and the bases after it keep their qualities
+    expected = base_score(30, 0.1, True) + base_score(20, 0.1, True) + base_score(40, 0.3, False) + \
+               base_score(10, 0.4, True)
+    first, second = hit_scores("ANACG", quals, ["3=1X1=", "1=1X1=1X1="], freqs)
+    assert math.isclose(first, expected, rel_tol=1e-12)
+    assert math.isclose(second, expected, rel_tol=1e-12)
+
+
+def per_base_pssm(quals, sequence, cigar, freqs, gap_open, gap_extend):
+    """Function that scores a hit one base at a time, as pssm did before the lookup tables, with full cigar counts,
+    insertions advancing the read and ambiguous bases kept in place. Inserted and ambiguous bases score 0"""
+
+    seq_prob = 10 ** ((np.array(quals, dtype=np.float64) * -1) / 10)
+    seq_pos = 0
+    indel_penalty = 0
+    for count, operation in re.findall(r'(\d+)([IDX=])', cigar):
+        end = seq_pos + int(count)
+        if operation in "=X":
+            for nucleotide in range(seq_pos, end):
+                if sequence[nucleotide] in "ATCG":
+                    probability = 1 - seq_prob[nucleotide] if operation == "=" else seq_prob[nucleotide] / 3
+                    with np.errstate(divide='ignore'):
+                        seq_prob[nucleotide] = np.log2(probability / freqs["ATCG".index(sequence[nucleotide])])
+                else:
+                    seq_prob[nucleotide] = 0
+            seq_pos = end
+        else:
+            indel_penalty += gap_open + gap_extend * (int(count) - 1)
+            if operation == "I":
+                seq_prob[seq_pos:end] = 0
+                seq_pos = end
+    return(np.sum(seq_prob) - indel_penalty)
+
+
+def test_lookup_tables_match_the_per_base_scoring():
+    rng = random.Random(13)
+
+    for interval in range(20):
+        plus = "".join(rng.choice("ACGT") for base in range(rng.randint(300, 2000)))
+        freqs = interval_entry(plus)['plus_freqs']
+        for case in range(20):
+            length = rng.randint(20, 150)
+            start = rng.randrange(len(plus) - length)
+            sequence = mutate_sequence(plus[start:start + length], rng.randint(0, length // 5), rng)
+            sequence = "".join("N" if rng.random() < 0.02 else base for base in sequence)
+            quals = [rng.randint(0, 60) for base in sequence]
+
+            hits = edlib.align(sequence, plus, mode='HW', task='path', k=length // 3)
+            if hits['cigar'] is None:
+                continue
+            cigars = [hits['cigar'], "%d=" % len(sequence), "%dX" % len(sequence)]
+            gap_open, gap_extend = rng.choice([(5, 1), (3, 2)])
+
+            # the tables take log2(1 - p) - log2(freq) instead of log2((1 - p)/freq), and add the bases in read order
+            scores = hit_scores(sequence, quals, cigars, freqs, gap_open, gap_extend)
+            expected = [per_base_pssm(quals, sequence, cigar, freqs, gap_open, gap_extend) for cigar in cigars]
+            assert np.allclose(scores, expected, rtol=1e-12, atol=1e-9)
+
+            # the log-sum-exp posterior is the ratio of the powers when they do not overflow. A match of a Q0 base
+            # scores -inf in both
+            alignments = {hit + 1: (None, cigar, score) for hit, (cigar, score) in
+                          enumerate(sorted(zip(cigars, scores), key=lambda pair: -pair[1]))}
+            if np.isfinite(scores).all() and max(scores) < 1000:
+                powers = [2 ** score for score in sorted(scores, reverse=True)]
+                assert math.isclose(realignment_probability({'alignments': alignments}, len(plus)),
+                                    powers[0] / sum(powers), rel_tol=1e-12)
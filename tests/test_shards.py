@@ -0,0 +1,34 @@
+import os
+import random
+import pandas as pd
+from circlemap.utils import read_shards
+
+
+def test_read_shards_merges_in_genomic_order(tmp_path, monkeypatch):
+    rng = random.Random(3)
+    monkeypatch.chdir(tmp_path)
+    names = ['chrom', 'start', 'end', 'discordants', 'sc', 'score']
+
+    # shards of the realignment processes, with the chunks appended in any order and repeated intervals
+    intervals = [("chr%s" % rng.choice([1, 2, 10, "X"]), rng.randint(0, 5000)) for interval in range(300)]
+    for process in range(5):
+        with open("out.bed.%s" % (1000 + process), 'w') as shard:
+            for row in range(rng.randint(0, 400)):
+                chrom, start = rng.choice(intervals)
+                shard.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (chrom, start, start + rng.choice([100, 200]), rng.randint(0, 9),
+                                                          rng.randint(0, 9), rng.random() * 100))
+    open("out.bed.999", 'w').close()
+
+    shards = [pd.read_csv(shard, sep='\t', header=None, names=names)
+              for shard in sorted(os.listdir(".")) if os.path.getsize(shard) > 0]
+    expected = pd.concat(shards, ignore_index=True).sort_values(['chrom', 'start', 'end']).reset_index(drop=True)
+
+    merged = read_shards("results/out.bed")
+    pd.testing.assert_frame_equal(merged, expected)
+
+
+def test_read_shards_without_results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    open("out.bed.1000", 'w').close()
+
+    assert len(read_shards("out.bed")) == 0
@@ -0,0 +1,35 @@
+import numpy as np
+from circlemap.utils import window_counts
+
+
+def brute_force_counts(point_x, point_y, x_low, x_high, y_low, y_high):
+    """Function that counts, for every window, the points with x_low < x < x_high and y_low < y < y_high one window at a
+    time"""
+
+    return(np.array([np.sum((x_low[window] < point_x) & (point_x < x_high[window]) &
+                            (y_low[window] < point_y) & (point_y < y_high[window])) for window in range(len(x_low))],
+                    dtype=np.int64))
+
+
+def test_window_counts_match_brute_force():
+    rng = np.random.default_rng(4)
+
+    for case in range(300):
+        n_points = int(rng.integers(0, 200))
+        n_windows = int(rng.integers(0, 100))
+        # small ranges, so that points share coordinates and lie on the window borders
+        span = int(rng.choice([5, 50, 10000]))
+
+        point_x = rng.integers(0, span, n_points).astype(np.float64)
+        point_y = point_x + rng.integers(0, span, n_points)
+        x_low = rng.integers(-2, span, n_windows).astype(np.float64)
+        x_high = x_low + rng.integers(-2, span, n_windows)
+        y_low = rng.integers(-2, 2 * span, n_windows).astype(np.float64)
+        y_high = y_low + rng.integers(-2, span, n_windows)
+        if case % 3 == 0:
+            # the windows of the discordant reads, fractional after the insert size
+            x_high += 0.5
+            y_low -= 0.5
+
+        expected = brute_force_counts(point_x, point_y, x_low, x_high, y_low, y_high)
+        assert window_counts(point_x, point_y, x_low, x_high, y_low, y_high).tolist() == expected.tolist()